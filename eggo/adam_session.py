@@ -0,0 +1,240 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long-lived ADAM (Spark) application that runs many ADAM commands.
+
+With execution.adam_executor set to session, the toast DAG runs its ADAM
+conversions here instead of starting an adam-submit application for each,
+so the Spark driver and executors start once and stay warm.  The session is
+an adam-shell running SESSION_SCRIPT, started on first use and shared by
+every toast on the host through a spool directory under work_path: a
+command is a <id>.cmd file (one argument per line), which the session claims
+by renaming it to <id>.running, runs on a thread pool of
+execution.adam_session_concurrency threads, each command in its own Spark
+fair scheduler pool, and answers with a <id>.done file holding its status
+and run time.  The session exits once it has been idle for
+execution.adam_session_idle_seconds.
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+from subprocess import Popen
+from contextlib import contextmanager
+
+from eggo.config import eggo_config, spark_master
+from eggo.error import AdamSessionError
+from eggo.util import random_id
+
+
+# the session touches its heartbeat file every second, and is taken for dead
+# if it has not for this many seconds
+HEARTBEAT_TIMEOUT = 60
+
+# how long a new session may take to start
+STARTUP_TIMEOUT = 600
+
+POLL_INTERVAL = 1
+
+# lines of the session log shown when it fails
+LOG_TAIL_LINES = 20
+
+# the ADAM commands the session can run; the toast DAG uses these
+SESSION_COMMANDS = {'vcf2adam': 'Vcf2ADAM', 'transform': 'Transform',
+                    'flatten': 'Flatten'}
+
+SESSION_SCRIPT = """
+import java.io.{{File, PrintWriter}}
+import java.util.concurrent.Executors
+import java.util.concurrent.atomic.AtomicInteger
+import scala.concurrent.{{ExecutionContext, Future}}
+import scala.io.Source
+import org.bdgenomics.adam.cli._
+
+val spool = new File("{spool}")
+val heartbeat = new File(spool, "session.alive")
+val pool = Executors.newFixedThreadPool({concurrency})
+val ec = ExecutionContext.fromExecutorService(pool)
+val commands = Map[String, Array[String] => BDGSparkCommand[_]]({commands})
+val running = new AtomicInteger(0)
+@volatile var lastActive = System.currentTimeMillis
+
+def answer(id: String, status: String) {{
+  val tmp = new File(spool, id + ".done.tmp")
+  val out = new PrintWriter(tmp)
+  out.println(status)
+  out.close()
+  tmp.renameTo(new File(spool, id + ".done"))
+}}
+
+def runCommand(id: String, claimed: File) {{
+  val args = Source.fromFile(claimed).getLines.toArray
+  val start = System.currentTimeMillis
+  try {{
+    // each command gets a fair share of the executors
+    sc.setLocalProperty("spark.scheduler.pool", id)
+    commands(args.head)(args.tail).run(sc)
+    answer(id, "ok\\t" + (System.currentTimeMillis - start))
+  }} catch {{
+    case e: Throwable =>
+      answer(id, "failed\\t" + (System.currentTimeMillis - start) + "\\t" +
+        e.toString.replace('\\n', ' '))
+  }} finally {{
+    claimed.delete()
+    lastActive = System.currentTimeMillis
+    running.decrementAndGet()
+  }}
+}}
+
+while (running.get > 0 ||
+       System.currentTimeMillis - lastActive < {idle_seconds} * 1000L) {{
+  new PrintWriter(heartbeat).close()
+  for (f <- Option(spool.listFiles).getOrElse(Array[File]())
+       if f.getName.endsWith(".cmd")) {{
+    val id = f.getName.stripSuffix(".cmd")
+    val claimed = new File(spool, id + ".running")
+    if (f.renameTo(claimed)) {{
+      running.incrementAndGet()
+      lastActive = System.currentTimeMillis
+      Future(runCommand(id, claimed))(ec)
+    }}
+  }}
+  Thread.sleep(1000)
+}}
+heartbeat.delete()
+pool.shutdown()
+sys.exit(0)
+"""
+
+
+def session_dir():
+    return os.path.join(eggo_config.get('worker_env', 'work_path'),
+                        'adam_session')
+
+
+def _path(name):
+    return os.path.join(session_dir(), name)
+
+
+def _alive():
+    try:
+        age = time.time() - os.path.getmtime(_path('session.alive'))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return age < HEARTBEAT_TIMEOUT
+
+
+@contextmanager
+def _session_lock():
+    with open(_path('session.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _log_tail():
+    try:
+        with open(_path('session.log'), 'r') as ip:
+            return ''.join(ip.readlines()[-LOG_TAIL_LINES:])
+    except IOError:
+        return ''
+
+
+def _start_session():
+    script = SESSION_SCRIPT.format(
+        spool=session_dir(),
+        concurrency=eggo_config.getint('execution',
+                                       'adam_session_concurrency'),
+        idle_seconds=eggo_config.getint('execution',
+                                        'adam_session_idle_seconds'),
+        commands=', '.join('"{0}" -> ((a: Array[String]) => {1}(a))'.format(
+            name, clazz) for (name, clazz) in
+            sorted(SESSION_COMMANDS.iteritems())))
+    with open(_path('session.scala'), 'w') as op:
+        op.write(script)
+    cmd = ('{adam_home}/bin/adam-shell --master {spark_master} '
+           '--conf spark.scheduler.mode=FAIR -i {script}').format(
+               adam_home=eggo_config.get('worker_env', 'adam_home'),
+               spark_master=spark_master(),
+               script=_path('session.scala'))
+    # in its own process group, so that it outlives the task that starts it
+    with open(os.devnull, 'r') as devnull:
+        with open(_path('session.log'), 'w') as log:
+            p = Popen(cmd, shell=True, stdin=devnull, stdout=log, stderr=log,
+                      preexec_fn=os.setsid)
+    start = time.time()
+    while not _alive():
+        if p.poll() is not None:
+            raise AdamSessionError('The ADAM session exited on startup:\n' +
+                                   _log_tail())
+        if time.time() - start > STARTUP_TIMEOUT:
+            p.kill()
+            raise AdamSessionError('The ADAM session did not start within '
+                                   '{0}s'.format(STARTUP_TIMEOUT))
+        time.sleep(POLL_INTERVAL)
+    print >> sys.stderr, 'eggo adam session: started in {0:.1f}s'.format(
+        time.time() - start)
+
+
+def ensure_session():
+    """Start the session, unless one is already running on this host."""
+    if not os.path.isdir(session_dir()):
+        os.makedirs(session_dir())
+    with _session_lock():
+        if not _alive():
+            _start_session()
+
+
+def run_command(command, args):
+    """Run an ADAM command (e.g. 'vcf2adam') with args in the session.
+
+    Returns {'queued': seconds waiting for a thread of the session (or for
+    it to start), 'run': seconds running}.
+    """
+    if command not in SESSION_COMMANDS:
+        raise AdamSessionError('The ADAM session cannot run ' + command)
+    submitted = time.time()
+    ensure_session()
+    id_ = random_id()
+    with open(_path(id_ + '.cmd.tmp'), 'w') as op:
+        op.write('\n'.join([command] + list(args)) + '\n')
+    os.rename(_path(id_ + '.cmd.tmp'), _path(id_ + '.cmd'))
+    while not os.path.exists(_path(id_ + '.done')):
+        if not _alive() and os.path.exists(_path(id_ + '.cmd')):
+            # submitted just as an idle session exited
+            ensure_session()
+        elif not _alive():
+            # the command is lost with the session
+            for suffix in ['.cmd', '.running']:
+                if os.path.exists(_path(id_ + suffix)):
+                    os.remove(_path(id_ + suffix))
+            raise AdamSessionError('The ADAM session died running {0}:\n'
+                                   '{1}'.format(command, _log_tail()))
+        time.sleep(POLL_INTERVAL)
+    with open(_path(id_ + '.done'), 'r') as ip:
+        fields = ip.read().strip().split('\t', 2)
+    os.remove(_path(id_ + '.done'))
+    run = int(fields[1]) / 1000.0
+    if fields[0] != 'ok':
+        raise AdamSessionError('ADAM {0} failed after {1:.1f}s: {2}'.format(
+            command, run, fields[2] if len(fields) > 2 else ''))
+    return {'queued': time.time() - submitted - run, 'run': run}
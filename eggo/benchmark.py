@@ -0,0 +1,113 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare Parquet codecs by converting the test resources with ADAM.
+
+Meant to be run on the master (see `eggo benchmark_codecs`).  Each resource is
+converted once per codec, and the size of the result, the time to write it,
+and the time for a full scan of it (adam-submit print) are reported.
+"""
+
+import os
+import sys
+import time
+from subprocess import check_call
+
+from eggo.config import eggo_config, supported_codecs, spark_master
+from eggo.dfs import list_files, delete_prefix
+from eggo.scratch import scratch_dir
+
+
+# test resource -> ADAM command that converts it
+benchmark_resources = [('test/resources/chr22.small.vcf.gz', 'vcf2adam'),
+                       ('test/resources/small.sam', 'transform')]
+
+
+def _adam_submit(args):
+    cmd = '{adam_home}/bin/adam-submit --master {spark_master} {args}'.format(
+        adam_home=eggo_config.get('worker_env', 'adam_home'),
+        spark_master=spark_master(),
+        args=args)
+    start = time.time()
+    check_call(cmd, shell=True)
+    return time.time() - start
+
+
+def _stage_resource(resource, dfs_dir, hadoop_bin):
+    # ADAM reads its input through Hadoop, so decompress and copy it to the dfs
+    local_path = os.path.join(eggo_config.get('worker_env', 'eggo_home'),
+                              resource)
+    name = os.path.basename(resource)
+    with scratch_dir() as tmp_dir:
+        if name.endswith('.gz'):
+            name = name[:-3]
+            check_call('gunzip -c {0} > {1}'.format(
+                local_path, os.path.join(tmp_dir, name)), shell=True)
+            local_path = os.path.join(tmp_dir, name)
+        dfs_path = os.path.join(dfs_dir, name)
+        check_call([hadoop_bin, 'fs', '-put', local_path, dfs_path])
+    return dfs_path
+
+
+def benchmark_codecs(codecs=None):
+    """Convert each test resource under each codec and return the results.
+
+    Returns a list of dicts with resource, codec, bytes, write_secs and
+    scan_secs keys.
+    """
+    codecs = codecs or supported_codecs
+    hadoop_bin = os.path.join(eggo_config.get('worker_env', 'hadoop_home'),
+                              'bin/hadoop')
+    dfs_dir = os.path.join(eggo_config.get('dfs', 'dfs_tmp_data_url'),
+                           'benchmark',
+                           eggo_config.get('execution', 'random_id'))
+    check_call([hadoop_bin, 'fs', '-mkdir', '-p', dfs_dir])
+    results = []
+    try:
+        for (resource, adam_command) in benchmark_resources:
+            source = _stage_resource(resource, dfs_dir, hadoop_bin)
+            for codec in codecs:
+                target = '{0}.{1}.adam'.format(source, codec)
+                write_secs = _adam_submit(
+                    '{command} {source} {target} '
+                    '-parquet_compression_codec {codec}'.format(
+                        command=adam_command, source=source, target=target,
+                        codec=codec.upper()))
+                scan_secs = _adam_submit(
+                    'print {target} > /dev/null'.format(target=target))
+                results.append({
+                    'resource': os.path.basename(resource), 'codec': codec,
+                    'bytes': sum(size for (_, size)
+                                 in list_files(target, hadoop_bin=hadoop_bin)),
+                    'write_secs': write_secs, 'scan_secs': scan_secs})
+    finally:
+        delete_prefix(dfs_dir, hadoop_bin=hadoop_bin)
+    return results
+
+
+def print_benchmark(results):
+    row = '{resource:<22}  {codec:<12}  {bytes:>12}  {write:>9}  {scan:>9}'
+    print row.format(resource='resource', codec='codec', bytes='bytes',
+                     write='write', scan='scan')
+    for r in results:
+        print row.format(resource=r['resource'], codec=r['codec'],
+                         bytes=r['bytes'],
+                         write='{0:.1f}s'.format(r['write_secs']),
+                         scan='{0:.1f}s'.format(r['scan_secs']))
+
+
+if __name__ == '__main__':
+    print_benchmark(benchmark_codecs(sys.argv[1:]))
@@ -0,0 +1,153 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading and writing BGZF, the blocked gzip format of BAM and bgzipped VCF.
+
+A BGZF file is a series of gzip members ("blocks") of at most 64 KB, each with
+an extra "BC" header field holding the block's compressed size, so that the
+blocks can be found (and a file split) without decompressing anything.
+"""
+
+import os
+import zlib
+import struct
+
+
+# the largest possible BGZF block, compressed or not
+BGZF_MAX_BLOCK_SIZE = 65536
+
+# the most data written to one block, small enough that even incompressible
+# data fits
+BGZF_MAX_PAYLOAD_SIZE = 0xff00
+
+# the BGZF end-of-file marker block
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+            '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+# how many blocks apart the entries of a .bgzfi block index are; this is the
+# Hadoop-BAM default
+BLOCK_INDEX_GRANULARITY = 4096
+
+
+def is_bgzf(head):
+    """Whether head (at least the first 18 bytes of a file) starts a BGZF
+    block: a gzip member with FEXTRA set and a BC extra subfield."""
+    return (len(head) >= 18 and head[:4] == '\x1f\x8b\x08\x04' and
+            head[12:14] == 'BC' and head[14:16] == '\x02\x00')
+
+
+def block_spans(data):
+    """Yield (start, end) offsets of each complete BGZF block in data; a
+    truncated block at the end is ignored."""
+    pos = 0
+    while pos + 18 <= len(data):
+        if data[pos:pos + 4] != '\x1f\x8b\x08\x04':
+            raise ValueError('Not a BGZF block at offset {0}'.format(pos))
+        (bsize,) = struct.unpack('<H', data[pos + 16:pos + 18])
+        end = pos + bsize + 1
+        if end > len(data):
+            return
+        yield (pos, end)
+        pos = end
+
+
+def inflate_block(block):
+    """The decompressed payload of a whole BGZF block."""
+    return zlib.decompress(block[18:-8], -15)
+
+
+def bgzf_blocks(data):
+    """Yield (offset, decompressed payload) for each complete BGZF block in
+    data; a truncated block at the end is ignored."""
+    for (start, end) in block_spans(data):
+        yield (start, inflate_block(data[start:end]))
+
+
+def bgzf_decompress(data):
+    return ''.join(payload for (_, payload) in bgzf_blocks(data))
+
+
+def deflate_block(payload):
+    """A whole BGZF block of payload (at most BGZF_MAX_PAYLOAD_SIZE bytes)."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(payload) + compressor.flush()
+    return ''.join([
+        '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00',
+        struct.pack('<H', len(deflated) + 25), deflated,
+        struct.pack('<II', zlib.crc32(payload) & 0xffffffff, len(payload))])
+
+
+def bgzf_compress(data):
+    return ''.join(deflate_block(data[i:i + BGZF_MAX_PAYLOAD_SIZE])
+                   for i in xrange(0, len(data), BGZF_MAX_PAYLOAD_SIZE)) + \
+        BGZF_EOF
+
+
+class BgzfWriter(object):
+    """Writes a stream of data to a file object as BGZF, a block at a time,
+    so that only the data of one block is held in memory."""
+
+    def __init__(self, op):
+        self.op = op
+        self._buffer = ''
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= BGZF_MAX_PAYLOAD_SIZE:
+            self.op.write(deflate_block(self._buffer[:BGZF_MAX_PAYLOAD_SIZE]))
+            self._buffer = self._buffer[BGZF_MAX_PAYLOAD_SIZE:]
+
+    def close(self):
+        if self._buffer:
+            self.op.write(deflate_block(self._buffer))
+            self._buffer = ''
+        self.op.write(BGZF_EOF)
+
+
+def block_offsets(path):
+    """Yield the offset of every block of the BGZF file at path, reading only
+    the block headers."""
+    with open(path, 'rb') as ip:
+        pos = 0
+        while True:
+            ip.seek(pos)
+            head = ip.read(18)
+            if len(head) < 18:
+                return
+            if not is_bgzf(head):
+                raise ValueError('Not a BGZF block at offset {0} of {1}'.format(
+                    pos, path))
+            yield pos
+            (bsize,) = struct.unpack('<H', head[16:18])
+            pos += bsize + 1
+
+
+def write_block_index(path, index_path,
+                      granularity=BLOCK_INDEX_GRANULARITY):
+    """Write a Hadoop-BAM .bgzfi block index for the BGZF file at path.
+
+    The index is the offset of every granularity-th block followed by the
+    file size, each as a 48-bit big-endian integer; Hadoop-BAM uses it to
+    split the file on block boundaries.
+    """
+    def write48(op, n):
+        op.write(struct.pack('>Q', n)[2:])
+
+    with open(index_path, 'wb') as op:
+        for (i, offset) in enumerate(block_offsets(path)):
+            if i % granularity == 0:
+                write48(op, offset)
+        write48(op, os.path.getsize(path))
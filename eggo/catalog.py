@@ -0,0 +1,160 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Materialized index of the toasted datasets on the dfs.
+
+The catalog is a directory of small JSON files at the dfs root (next to the
+<dataset-name>/<format>/<edition> directories described in docs/spec.md), so
+that listing the datasets is one listing and a few small reads instead of a
+recursive listing of every object.  Each dataset has its own files:
+
+    _catalog/<dataset-name>/dataset.json
+    _catalog/<dataset-name>/editions/<format>/<edition>.json
+    _catalog/<dataset-name>/stages/<stage>.json
+
+which are merged on read.  Every file is written whole by the one task that
+owns it, so toasts that record editions at the same moment never overwrite
+each other's updates, and there is no read-modify-write to serialize.  The
+toast DAG records each edition as soon as the edition is committed.
+"""
+
+import os
+import json
+import time
+from datetime import datetime
+
+from eggo.config import eggo_config
+from eggo.dfs import list_files, read_file, write_file, delete_prefix
+from eggo.error import CatalogError
+from eggo.parquet import parse_footer, read_footer, num_rows
+from eggo.preflight import sources_digest
+
+
+CATALOG_DIRNAME = '_catalog'
+
+# how often a catalog file that disappears while it is read (as one that is
+# replaced on HDFS briefly does) is looked for again
+CATALOG_READ_ATTEMPTS = 5
+
+
+def catalog_url():
+    return os.path.join(eggo_config.get('dfs', 'dfs_root_url'),
+                        CATALOG_DIRNAME)
+
+
+def _dataset_url(name):
+    return os.path.join(catalog_url(), name)
+
+
+def _read_catalog(url):
+    # None if a listed file is gone by the time it is read
+    catalog = {'datasets': {}}
+    for (name, _) in list_files(url):
+        if not name.endswith('.json'):
+            # e.g. the temporary file of a write in progress
+            continue
+        data = read_file(os.path.join(url, name))
+        if data is None:
+            return None
+        parts = name[:-len('.json')].split('/')
+        dataset = catalog['datasets'].setdefault(parts[0], {})
+        if parts[1:] == ['dataset']:
+            dataset.update(json.loads(data))
+        elif len(parts) == 4 and parts[1] == 'editions':
+            dataset.setdefault('editions', {})[
+                '{0}/{1}'.format(parts[2], parts[3])] = json.loads(data)
+        elif len(parts) == 3 and parts[1] == 'stages':
+            dataset.setdefault('stages', {})[parts[2]] = json.loads(data)
+    return catalog
+
+
+def load_catalog():
+    """The catalog of every dataset, as {'datasets': {name: entry}}."""
+    url = catalog_url()
+    for attempt in xrange(CATALOG_READ_ATTEMPTS):
+        catalog = _read_catalog(url)
+        if catalog is not None:
+            return catalog
+        time.sleep(2 ** attempt)
+    raise CatalogError(
+        'Catalog files under {0} kept disappearing while they were read; is '
+        'a toast replacing them?'.format(url))
+
+
+def _write_json(url, data):
+    write_file(url, json.dumps(data, indent=2, sort_keys=True))
+
+
+def _count_rows(url, files):
+    names = dict(files)
+    if '_metadata' in names:
+        # the summary file holds the footers of all the part files
+        return num_rows(parse_footer(read_file(
+            os.path.join(url, '_metadata'))))
+    return sum(num_rows(read_footer(os.path.join(url, name)))
+               for name in names if name.endswith('.parquet'))
+
+
+def summarize_edition(url):
+    files = list_files(url)
+    parquet_files = [(name, size) for (name, size) in files
+                     if name.endswith('.parquet')]
+    return {'url': url,
+            'files': len(parquet_files),
+            'bytes': sum(size for (_, size) in parquet_files),
+            'rows': _count_rows(url, files),
+            'updated': datetime.utcnow().isoformat()}
+
+
+def record_edition(config_data, format, edition, url):
+    """Add (or refresh) an edition of a dataset in the catalog."""
+    summary = summarize_edition(url)
+    dataset_url = _dataset_url(config_data['name'])
+    _write_json(os.path.join(dataset_url, 'dataset.json'), {
+        'title': config_data.get('title', config_data.get('description')),
+        'source_digest': sources_digest(config_data['sources'])})
+    _write_json(os.path.join(dataset_url, 'editions', format,
+                             edition + '.json'), summary)
+
+
+def record_stage(config_data, stage, source_bytes, seconds):
+    """Record how long a stage (e.g. download) of a toast took, so that
+    eggo.planner can size later clusters."""
+    _write_json(os.path.join(_dataset_url(config_data['name']), 'stages',
+                             stage + '.json'),
+                {'source_bytes': source_bytes,
+                 'seconds': seconds,
+                 'updated': datetime.utcnow().isoformat()})
+
+
+def remove_dataset(name):
+    delete_prefix(_dataset_url(name))
+
+
+def print_catalog(catalog):
+    row = '{dataset:<40}  {edition:<12}  {files:>6}  {bytes:>14}  {rows:>12}'
+    print row.format(dataset='dataset', edition='edition', files='files',
+                     bytes='bytes', rows='rows')
+    for name in sorted(catalog['datasets']):
+        editions = catalog['datasets'][name].get('editions', {})
+        for edition in sorted(editions):
+            e = editions[edition]
+            print row.format(dataset=name, edition=edition, files=e['files'],
+                             bytes=e['bytes'], rows=e['rows'])
+
+
+def print_dataset(catalog, name):
+    print json.dumps(catalog['datasets'][name], indent=2, sort_keys=True)
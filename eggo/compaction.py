@@ -0,0 +1,110 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rewriting the Parquet part files of an edition into fewer, larger files.
+
+rewrite() runs COMPACT_SCRIPT in a one-off adam-shell.  Each group of part
+files (consecutive in name order) is read with AvroParquetInputFormat and
+coalesced into a single partition without a shuffle, so that the rows keep
+their order, and the groups are written with AvroParquetOutputFormat under
+the edition's Parquet options.  Unlike a concatenation of the files (e.g.
+parquet-tools merge), this re-encodes the rows into row groups of the
+configured size, and the output committer writes the _metadata and
+_common_metadata summaries of the new files.
+
+The new files are staged in <edition>.compacted, next to the edition, and
+then swapped in at the edition's own url (see
+eggo.dag.CompactEditionTask), so that readers of the edition path find the
+compacted data there.
+"""
+
+import os
+from subprocess import check_call
+
+from eggo.config import eggo_config, spark_master
+from eggo.dfs import exists
+from eggo.util import random_id
+
+
+COMPACT_SCRIPT = """
+import org.apache.avro.generic.IndexedRecord
+import org.apache.hadoop.mapreduce.Job
+import org.apache.parquet.avro.{{AvroParquetInputFormat, AvroParquetOutputFormat}}
+import org.apache.parquet.hadoop.ParquetOutputFormat
+import org.apache.parquet.hadoop.metadata.CompressionCodecName
+
+try {{
+  val groups = Seq[String]({groups})
+  val records = sc.union(groups.map(paths => sc.newAPIHadoopFile(
+    paths, classOf[AvroParquetInputFormat[IndexedRecord]], classOf[Void],
+    classOf[IndexedRecord], sc.hadoopConfiguration).map(_._2).coalesce(1)))
+  val job = Job.getInstance(sc.hadoopConfiguration)
+  AvroParquetOutputFormat.setSchema(job, records.first.getSchema)
+  ParquetOutputFormat.setCompression(job, CompressionCodecName.{codec})
+  ParquetOutputFormat.setBlockSize(job, {block_size})
+  ParquetOutputFormat.setPageSize(job, {page_size})
+  job.getConfiguration.setBoolean(ParquetOutputFormat.ENABLE_JOB_SUMMARY, true)
+  records.map(r => (null, r)).saveAsNewAPIHadoopFile(
+    {target}, classOf[Void], classOf[IndexedRecord],
+    classOf[AvroParquetOutputFormat[IndexedRecord]], job.getConfiguration)
+  System.exit(0)
+}} catch {{
+  case e: Throwable =>
+    e.printStackTrace()
+    System.exit(1)
+}}
+"""
+
+# the directory a compacted edition is staged in, and the one its original
+# files are moved to while they are swapped out (where renames are atomic)
+STAGING_SUFFIX = '.compacted'
+SUPERSEDED_SUFFIX = '.superseded'
+STAGING_SUFFIXES = (STAGING_SUFFIX, SUPERSEDED_SUFFIX)
+
+
+def _scala_string(s):
+    return '"{0}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def rewrite(groups, target_url, options, hadoop_bin='hadoop'):
+    """Write the rows of groups (lists of Parquet file urls) to target_url,
+    a file per group, with options (see eggo.config.edition_parquet_options).
+    """
+    script_dir = os.path.join(eggo_config.get('worker_env', 'work_path'),
+                              'compaction')
+    if not os.path.isdir(script_dir):
+        os.makedirs(script_dir)
+    script_path = os.path.join(script_dir, random_id() + '.scala')
+    with open(script_path, 'w') as op:
+        op.write(COMPACT_SCRIPT.format(
+            groups=', '.join(_scala_string(','.join(g)) for g in groups),
+            codec=options['codec'].upper(),
+            block_size=options['row_group_mb'] * 1024 * 1024,
+            page_size=options['page_kb'] * 1024,
+            target=_scala_string(target_url)))
+    cmd = '{adam_home}/bin/adam-shell --master {spark_master} -i {script}'.format(
+        adam_home=eggo_config.get('worker_env', 'adam_home'),
+        spark_master=spark_master(),
+        script=script_path)
+    try:
+        # the shell reads its commands from stdin once the script is done
+        with open(os.devnull, 'r') as devnull:
+            check_call(cmd, shell=True, stdin=devnull)
+    finally:
+        os.remove(script_path)
+    # a script that does not compile is reported, but does not fail the shell
+    if not exists(os.path.join(target_url, '_SUCCESS'), hadoop_bin):
+        raise ValueError('Compaction did not write {0}'.format(target_url))
@@ -17,12 +17,16 @@
 import os
 from ConfigParser import SafeConfigParser
 
-from eggo.util import random_id
+from eggo.util import random_id, local_path
 from eggo.error import ConfigError
 
 
 # EGGO CONFIGURATION
 
+# the [parquet] section of configs that lack it (or some of its options)
+parquet_defaults = {'codec': 'gzip', 'row_group_mb': '128', 'page_kb': '1024'}
+
+
 def _init_eggo_config():
     defaults = {}
     eggo_config = SafeConfigParser(defaults=defaults,
@@ -32,6 +36,13 @@ def _init_eggo_config():
     with open(os.environ['EGGO_CONFIG'], 'r') as ip:
         eggo_config.readfp(ip, os.environ['EGGO_CONFIG'])
 
+    # Configs that predate the [parquet] section get its defaults
+    if not eggo_config.has_section('parquet'):
+        eggo_config.add_section('parquet')
+    for (option, value) in parquet_defaults.iteritems():
+        if not eggo_config.has_option('parquet', option):
+            eggo_config.set('parquet', option, value)
+
     # Generate the random identifier for this module load
     eggo_config.set('execution', 'random_id', random_id())
 
@@ -80,6 +91,7 @@ def assert_eggo_config_complete(c):
     assert_section_complete('versions')
     assert_section_complete('client_env')
     assert_section_complete('worker_env')
+    assert_section_complete('parquet')
     exec_ctx = c.get('execution', 'context')
     if ref.has_section(exec_ctx):
         assert_section_complete(exec_ctx)
@@ -100,6 +112,16 @@ validate_eggo_config(eggo_config)
 supported_formats = ['bdg']  # # TODO: support ga4gh
 
 
+def spark_master():
+    """The --master of the Spark applications that eggo starts, as a shell
+    word: every core of this machine in the local context, or else
+    worker_env.spark_master."""
+    if eggo_config.get('execution', 'context') == 'local':
+        # quoted so that the shell does not glob it
+        return "'local[*]'"
+    return eggo_config.get('worker_env', 'spark_master')
+
+
 def generate_luigi_cfg():
     cfg = ('[core]\n'
            'logging_conf_file:{eggo_home}/conf/luigi/luigi_logging.cfg\n'
@@ -110,6 +132,110 @@ def generate_luigi_cfg():
 
 # TOAST CONFIGURATION
 
+# registry "dag" values and the source formats that each of them accepts
+toast_dags = {'VCF2ADAMTask': ['vcf'],
+              'BAM2ADAMTask': ['sam', 'bam']}
+
+supported_editions = ['basic', 'flat']
+
+supported_codecs = ['uncompressed', 'snappy', 'gzip', 'lzo']
+
+parquet_options = ['codec', 'row_group_mb', 'page_kb']
+
+supported_source_schemes = ['http', 'https', 'ftp', 'file']
+
+
 def validate_toast_config(d):
     """Validate a JSON config file for an eggo dataset (a "toast")."""
-    pass
+    def check(condition, message):
+        if not condition:
+            raise ConfigError('Toast config {0}: {1}'.format(
+                d.get('name', '<unnamed>'), message))
+
+    check(isinstance(d.get('name'), basestring) and d['name'] != '',
+          'missing "name"')
+    check(d.get('dag') in toast_dags,
+          '"dag" must be one of {0}'.format(sorted(toast_dags)))
+    for entry in d.get('editions', []):
+        # an edition is either a name or an object with the edition name and
+        # its Parquet options
+        check(isinstance(entry, basestring) or
+              (isinstance(entry, dict) and 'edition' in entry),
+              'editions must be names or objects with an "edition" key')
+        options = {} if isinstance(entry, basestring) else entry
+        check(_edition_name(entry) in supported_editions,
+              'editions must be among {0}'.format(supported_editions))
+        check(set(options) <= set(['edition'] + parquet_options),
+              'edition options must be among {0}'.format(parquet_options))
+        # codecs are matched case-insensitively, as when the edition is
+        # written (see edition_parquet_options)
+        codec = options.get('codec', 'gzip')
+        check(isinstance(codec, basestring) and
+              codec.lower() in supported_codecs,
+              'codec must be one of {0}'.format(supported_codecs))
+        for option in ['row_group_mb', 'page_kb']:
+            check(isinstance(options.get(option, 1), int) and
+                  options.get(option, 1) > 0,
+                  '{0} must be a positive integer'.format(option))
+    sources = d.get('sources')
+    check(isinstance(sources, list) and len(sources) > 0, 'no "sources"')
+    for source in sources:
+        url = source.get('url', '')
+        # absolute paths are sources on a local or mounted filesystem
+        check(url.split(':')[0] in supported_source_schemes or
+              url.startswith('/'),
+              'unsupported source url {0}'.format(url))
+        check(not url.startswith('file:') or local_path(url) is not None,
+              'file url {0} must be on this host'.format(url))
+        check(source.get('format') in toast_dags[d['dag']],
+              'format of {0} must be one of {1}'.format(
+                  url, toast_dags[d['dag']]))
+        check(isinstance(source.get('compression'), bool),
+              '"compression" of {0} must be true or false'.format(url))
+        check(source['compression'] == url.endswith('.gz'),
+              '"compression" of {0} does not match its extension'.format(url))
+        if 'regions' in source:
+            # regions are read with the .bai/.tbi index of a BGZF file
+            check(source['format'] == 'bam' or
+                  (source['format'] == 'vcf' and source['compression']),
+                  'regions of {0} need an indexed BAM or bgzipped VCF'.format(
+                      url))
+            check(isinstance(source['regions'], list) and
+                  all(isinstance(r, basestring) for r in source['regions']),
+                  'regions of {0} must be a list of strings'.format(url))
+    # ADAMBasicTask converts all the sources with a single command
+    check(len(set(s['format'] for s in sources)) == 1,
+          'all sources must have the same format')
+
+
+def _edition_name(entry):
+    return entry if isinstance(entry, basestring) else entry['edition']
+
+
+def edition_names(d):
+    """The names of the editions requested by a toast config."""
+    return [_edition_name(entry) for entry in d.get('editions', [])]
+
+
+def edition_parquet_options(d, edition):
+    """The Parquet options for writing an edition of a toast.
+
+    Registry settings for the edition take precedence over edition-specific
+    settings in the [parquet] config section (e.g., flat_codec), which take
+    precedence over the section's defaults.
+    """
+    options = {}
+    for option in parquet_options:
+        specific = '{0}_{1}'.format(edition, option)
+        if eggo_config.has_option('parquet', specific):
+            options[option] = eggo_config.get('parquet', specific)
+        else:
+            options[option] = eggo_config.get('parquet', option)
+    for entry in d.get('editions', []):
+        if isinstance(entry, dict) and entry['edition'] == edition:
+            options.update((k, v) for (k, v) in entry.iteritems()
+                           if k in parquet_options)
+    options['codec'] = options['codec'].lower()
+    options['row_group_mb'] = int(options['row_group_mb'])
+    options['page_kb'] = int(options['page_kb'])
+    return options
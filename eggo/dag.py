@@ -19,19 +19,43 @@
 import os
 import sys
 import json
-from shutil import rmtree
-from tempfile import mkdtemp
-from subprocess import call, check_call
+from pipes import quote
+from urlparse import urlparse
+from subprocess import check_call
+from multiprocessing import Pool, cpu_count
 
-from luigi import Task, Config
+from luigi import Task, Config, Event
 from luigi.s3 import S3Target, S3FlagTarget, S3Client
 from luigi.hdfs import HdfsClient, HdfsTarget
 from luigi.file import LocalTarget
 from luigi.hadoop import JobTask, HadoopJobRunner
 from luigi.parameter import Parameter
 
-from eggo.config import eggo_config, validate_toast_config
-from eggo.util import random_id, build_dest_filename
+from eggo.config import (
+    eggo_config, validate_toast_config, edition_names, edition_parquet_options,
+    spark_master)
+from eggo.catalog import record_edition, record_stage
+from eggo.dfs import (
+    list_files, write_file, delete_prefix, delete_files, exists, make_dir,
+    rename, copy, put_file, renames_atomically)
+from eggo.error import PreflightError, ValidationError
+from eggo.parquet import read_footer, num_rows
+from eggo.index import write_index
+from eggo.compaction import rewrite, STAGING_SUFFIX, SUPERSEDED_SUFFIX
+from eggo.adam_session import run_command as run_in_adam_session
+from eggo.webhdfs import enabled as webhdfs_enabled
+from eggo.regions import subset
+from eggo.bgzf import is_bgzf, write_block_index
+from eggo.scratch import GZIP_EXPANSION, allocate, shrink, release
+from eggo.transfer import download_source
+from eggo.progress import Progress
+from eggo.validate import count_raw_files, edition_rows
+from eggo.profiling import (
+    PROFILE_ENV, profile_run, profiled, start_profile, stop_profile)
+from eggo.preflight import (
+    preflight, load_preflight, failed_sources, source_sizes, source_etags,
+    bgzf_sources, sidecar_path)
+from eggo.util import random_id, build_dest_filename, local_path
 
 
 class JsonFileParameter(Parameter):
@@ -63,6 +87,105 @@ class ToastConfig(Config):
                             eggo_config.get('execution', 'random_id'))
 
 
+def local_engine():
+    """Whether the toast runs in-process on this machine (the local context)
+    rather than as Hadoop jobs, so that file:// paths need no JVM."""
+    return eggo_config.get('execution', 'context') == 'local'
+
+
+def hadoop_cli():
+    return os.path.join(eggo_config.get('worker_env', 'hadoop_home'),
+                        'bin/hadoop')
+
+
+class FlagSnapshot(object):
+    """Which flag files (e.g. _SUCCESS) exist, listed once per dataset prefix.
+
+    Luigi calls complete() on every task in the DAG while scheduling, and for
+    HDFS and file:// each flag probe is a separate hadoop JVM.  Instead, the
+    first probe under a dataset prefix (e.g. <dfs_root_url>/<dataset>) lists
+    the whole prefix, and later probes under it are answered from that
+    listing.  The snapshot is dropped whenever a task succeeds, and it is never
+    shared with forked worker processes, so run-time dependency checks see
+    fresh state.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.listings = {}
+
+    def dataset_prefix(self, path):
+        roots = [eggo_config.get('dfs', option).rstrip('/')
+                 for option in ['dfs_root_url', 'dfs_raw_data_url',
+                                'dfs_tmp_data_url']]
+        # the raw/tmp roots are usually nested in the root url, so try the
+        # longest root first
+        for root in sorted(roots, key=len, reverse=True):
+            if path.startswith(root + '/'):
+                return os.path.join(root,
+                                    path[len(root) + 1:].split('/')[0])
+        return os.path.dirname(path)
+
+    def exists(self, path):
+        prefix = self.dataset_prefix(path)
+        if prefix not in self.listings:
+            self.listings[prefix] = set(
+                os.path.join(prefix, name) for (name, _) in list_files(prefix))
+        return path in self.listings[prefix]
+
+
+_flag_snapshot = FlagSnapshot()
+
+
+def flag_exists(path, flag):
+    global _flag_snapshot
+    if _flag_snapshot.pid != os.getpid():
+        _flag_snapshot = FlagSnapshot()
+    return _flag_snapshot.exists(os.path.join(path, flag))
+
+
+@Task.event_handler(Event.SUCCESS)
+def _invalidate_flag_snapshot(task):
+    global _flag_snapshot
+    _flag_snapshot = FlagSnapshot()
+
+
+# the tasks whose run times eggo.planner learns per-node throughput from
+timed_stages = {'DownloadDatasetHadoopTask': 'download',
+                'DownloadDatasetLocalTask': 'download',
+                'ADAMBasicTask': 'convert'}
+
+
+@Task.event_handler(Event.PROCESSING_TIME)
+def _record_stage_time(task, seconds):
+    stage = timed_stages.get(task.task_family)
+    if stage is None:
+        return
+    # time spent waiting for the warm ADAM session is not conversion time
+    seconds -= getattr(task, 'adam_wait_seconds', 0)
+    sources = ToastConfig().config['sources']
+    sidecar = load_preflight(preflight_sidecar_path(), sources)
+    if sidecar is None:
+        return
+    source_bytes = sum(size or 0 for size in source_sizes(sidecar).values())
+    record_stage(ToastConfig().config, stage, source_bytes, seconds)
+
+
+@Task.event_handler(Event.START)
+def _start_profile(task):
+    start_profile(task.task_id)
+
+
+@Task.event_handler(Event.SUCCESS)
+def _stop_profile(task):
+    stop_profile(task.task_id)
+
+
+@Task.event_handler(Event.FAILURE)
+def _stop_failed_profile(task, exception):
+    stop_profile(task.task_id, failed=True)
+
+
 class EggoS3FlagTarget(S3FlagTarget):
     # NOTE: we are implementing our own version of S3FlagTarget even though
     # Luigi supplies this class because the Luigi version requires paths to end
@@ -74,7 +197,15 @@ class EggoS3FlagTarget(S3FlagTarget):
         self.flag = flag
 
     def exists(self):
-        return self.fs.exists(os.path.join(self.path, self.flag))
+        return flag_exists(self.path, self.flag)
+
+
+class EggoHdfsTarget(HdfsTarget):
+    # checks existence through eggo.dfs, which can use WebHDFS instead of the
+    # hadoop CLI
+
+    def exists(self):
+        return exists(self.path, hadoop_cli())
 
 
 class HdfsFlagTarget(HdfsTarget):
@@ -83,7 +214,7 @@ class HdfsFlagTarget(HdfsTarget):
         self.flag = flag
 
     def exists(self):
-        return self.fs.exists(os.path.join(self.path, self.flag))
+        return flag_exists(self.path, self.flag)
 
 
 class LocalFlagTarget(LocalTarget):
@@ -92,21 +223,22 @@ class LocalFlagTarget(LocalTarget):
         self.flag = flag
 
     def exists(self):
-        return self.fs.exists(os.path.join(self.path, self.flag))
+        return flag_exists(self.path, self.flag)
 
 
-def flag_target(path):
+def flag_target(path, flag='_SUCCESS'):
     if (path.startswith('s3:') or path.startswith('s3n:')
             or path.startswith('s3a:')):
-        return EggoS3FlagTarget(path)
+        return EggoS3FlagTarget(path, flag=flag)
     elif path.startswith('hdfs:'):
-        return HdfsFlagTarget(path)
+        return HdfsFlagTarget(path, flag=flag)
     elif path.startswith('file:'):
         # Hadoop job runner requires either an HdfsTarget or an S3FlagTarget,
-        # which is why we cannot use the LocalFlagTarget.  Should be ok as long
-        # as we keep using the Hadoop client CLI
-        # return LocalFlagTarget(path)
-        return HdfsFlagTarget(path)
+        # which is why we cannot use the LocalFlagTarget, except with the
+        # local engine, which runs no Hadoop jobs
+        if local_engine():
+            return LocalFlagTarget(path, flag=flag)
+        return HdfsFlagTarget(path, flag=flag)
     else:
         raise ValueError('Unrecognized URI protocol: {path}'.format(path))
 
@@ -116,9 +248,9 @@ def file_target(path):
             or path.startswith('s3a:')):
         return S3Target(path)
     elif path.startswith('hdfs:'):
-        return HdfsTarget(path)
+        return EggoHdfsTarget(path)
     elif path.startswith('file:'):
-        return LocalTarget(path)
+        return LocalTarget(urlparse(path).path)
     else:
         raise ValueError('Unrecognized URI protocol: {path}'.format(path))
 
@@ -129,29 +261,123 @@ def create_SUCCESS_file(path):
         s3_client = S3Client(eggo_config.get('aws', 'aws_access_key_id'),
                             eggo_config.get('aws', 'aws_secret_access_key'))
         s3_client.put_string('', os.path.join(path, '_SUCCESS'))
+    elif path.startswith('hdfs:') and webhdfs_enabled():
+        write_file(os.path.join(path, '_SUCCESS'), '')
     elif path.startswith('hdfs:'):
         hdfs_client = HdfsClient()
         hdfs_client.put('/dev/null', os.path.join(path, '_SUCCESS'))
     elif path.startswith('file:'):
-        open(os.path.join(path, '_SUCCESS'), 'a').close()
-
-
-def _dnload_to_local_upload_to_dfs(source, destination, compression):
-    # source: (string) URL suitable for curl
+        open(os.path.join(urlparse(path).path, '_SUCCESS'), 'a').close()
+
+
+def _upload_to_dfs(uploads):
+    # uploads: (local path, full URL of destination, whether it may be a hard
+    # link) triples, uploaded in order to a tmp distributed filesystem
+    # location (e.g. S3) and then renamed into place
+    tmp_staged_dir = os.path.join(
+        eggo_config.get('dfs', 'dfs_tmp_data_url'),
+        'staged',
+        random_id())
+    # ensure the dfs directory exists; this cmd may fail if the dir
+    # already exists, but that's ok (though it shouldn't already exist)
+    make_dir(tmp_staged_dir, hadoop_cli())
+    for (local_file, final_path, link) in uploads:
+        staged_path = os.path.join(tmp_staged_dir,
+                                   os.path.basename(local_file))
+        progress = Progress(local_file, 'upload',
+                            os.path.getsize(local_file))
+        put_file(local_file, staged_path, hadoop_cli(), progress, link=link)
+        progress.finish()
+        rename(staged_path, final_path, hadoop_cli())
+    # TODO: clean up dfs tmp dir
+
+
+def _check_bgzf(local_file, source):
+    with open(local_file, 'rb') as ip:
+        if not is_bgzf(ip.read(18)):
+            raise ValueError('{0} is not BGZF-compressed; run the '
+                             'preflight again'.format(source))
+
+
+def _dnload_to_local_upload_to_dfs(source, destination, compression,
+                                   format=None, regions=None, keep_bgzf=False,
+                                   size=None, etag=None):
+    # source: (string) URL suitable for curl, or a local path
     # destination: (string) full URL of destination file name
     # compression: (bool) whether file needs to be decompressed
-    tmp_local_dir = mkdtemp(
-        prefix='tmp_eggo_',
-        dir=eggo_config.get('worker_env', 'work_path'))
+    # format: (string) source format; only needed with regions
+    # regions: (list) if given, only download the records in these regions
+    # keep_bgzf: (bool) whether to keep a BGZF file compressed and index it
+    # size: (int) size of the source in bytes, if known
+    # etag: (string) ETag of the source, if known; a download only resumes
+    #     a partial file of the same ETag
+    source_path = local_path(source)
+    if source_path is not None and not regions and (keep_bgzf or
+                                                     not compression):
+        # a local or mounted source that is staged as it is goes straight
+        # to the destination, without a scratch copy; only its block index
+        # is written to scratch
+        link = eggo_config.getboolean('execution', 'link_local_sources')
+        if not keep_bgzf:
+            _upload_to_dfs([(source_path, destination, link)])
+            return
+        (tmp_local_dir, reservation) = allocate()
+        try:
+            _check_bgzf(source_path, source)
+            index_file = os.path.join(
+                tmp_local_dir, os.path.basename(source_path) + '.bgzfi')
+            write_block_index(source_path, index_file)
+            # the index goes first, so that it exists once the file does
+            _upload_to_dfs([(index_file, destination + '.bgzfi', False),
+                            (source_path, destination, link)])
+        finally:
+            release(tmp_local_dir, reservation)
+        return
+
+    reserve = size
+    if size is not None and regions:
+        reserve = None  # only a fraction of the source is downloaded
+    elif size is not None and compression and not keep_bgzf:
+        # the gzipped and the gunzipped file are on disk together
+        reserve = size * (1 + GZIP_EXPANSION)
+        if source_path is not None:
+            reserve = size * GZIP_EXPANSION  # only the gunzipped file
+    (tmp_local_dir, reservation) = allocate(reserve)
     try:
         # 1. dnload file
-        dnload_cmd = 'pushd {tmp_local_dir} && curl -L -O {source} && popd'
-        check_call(dnload_cmd.format(tmp_local_dir=tmp_local_dir,
-                                     source=source),
-                   shell=True)
+        local_name = os.path.basename(urlparse(source).path)
+        if regions:
+            # ranged reads of the indexed blocks; the subset VCF is written
+            # uncompressed, as if it had been gunzipped
+            if compression:
+                local_name = os.path.splitext(local_name)[0]
+            subset(source, format, regions,
+                   os.path.join(tmp_local_dir, local_name))
+        elif source_path is not None:
+            # a local source is gunzipped straight from where it is
+            with open(os.path.join(tmp_local_dir,
+                                   os.path.splitext(local_name)[0]),
+                      'wb') as op:
+                check_call(['gunzip', '-c', source_path], stdout=op)
+        else:
+            # resumes, and retries transient errors; see eggo.transfer
+            download_source(source, os.path.join(tmp_local_dir, local_name),
+                            size, etag)
+        # the download is on disk now, so only the gunzipped file (if any)
+        # is left to reserve space for
+        shrink(tmp_local_dir, reservation)
 
         # 2. decompress if necessary
-        if compression:
+        if compression and not regions and source_path is not None:
+            pass  # gunzipped as it was copied
+        elif compression and not regions and keep_bgzf:
+            # BGZF is splittable, so keep it compressed and write the block
+            # index that Hadoop-BAM splits it with
+            local_file = os.path.join(tmp_local_dir,
+                                      os.listdir(tmp_local_dir)[0])
+            _check_bgzf(local_file, source)
+            write_block_index(local_file, local_file + '.bgzfi')
+        elif compression and not regions:
             compression_type = os.path.splitext(source)[-1]
             if compression_type == '.gz':
                 decompr_cmd = ('pushd {tmp_local_dir} && gunzip *.gz && popd')
@@ -160,44 +386,63 @@ def _dnload_to_local_upload_to_dfs(source, destination, compression):
                     compression_type))
             check_call(decompr_cmd.format(tmp_local_dir=tmp_local_dir),
                        shell=True)
+        shrink(tmp_local_dir, reservation, 0)
+
+        # 3. upload to tmp distributed filesystem location (e.g. S3), and
+        # rename to final target location; get the name of the local file
+        # that we're uploading, and of its block index, if any
+        local_files = os.listdir(tmp_local_dir)
+        filename = [f for f in local_files if not f.endswith('.bgzfi')][0]
+        uploads = [(os.path.join(tmp_local_dir, filename), destination,
+                    False)]
+        if filename + '.bgzfi' in local_files:
+            # the index goes first, so that it exists once the file does
+            uploads.insert(0, (os.path.join(tmp_local_dir,
+                                            filename + '.bgzfi'),
+                               destination + '.bgzfi', False))
+        _upload_to_dfs(uploads)
+    finally:
+        release(tmp_local_dir, reservation)
 
-        try:
-            # 3. upload to tmp distributed filesystem location (e.g. S3)
-            tmp_staged_dir = os.path.join(
-                eggo_config.get('dfs', 'dfs_tmp_data_url'),
-                'staged',
-                random_id())
-            # get the name of the local file that we're uploading
-            local_files = os.listdir(tmp_local_dir)
-            if len(local_files) != 1:
-                # TODO: generate warning/error here
-                pass
-            filename = local_files[0]
-            # ensure the dfs directory exists; this cmd may fail if the dir
-            # already exists, but that's ok (though it shouldn't already exist)
-            create_dir_cmd = '{hadoop_home}/bin/hadoop fs -mkdir -p {tmp_dfs_dir}'
-            call(create_dir_cmd.format(
-                     hadoop_home=eggo_config.get('worker_env', 'hadoop_home'),
-                     tmp_dfs_dir=tmp_staged_dir),
-                 shell=True)
-            upload_cmd = '{hadoop_home}/bin/hadoop fs -put {tmp_local_file} {tmp_dfs_file}'
-            check_call(upload_cmd.format(
-                           hadoop_home=eggo_config.get('worker_env', 'hadoop_home'),
-                           tmp_local_file=os.path.join(tmp_local_dir, filename),
-                           tmp_dfs_file=os.path.join(tmp_staged_dir, filename)),
-                       shell=True)
 
-            # 4. rename to final target location
-            rename_cmd = '{hadoop_home}/bin/hadoop fs -mv {tmp_path} {final_path}'
-            check_call(rename_cmd.format(
-                           hadoop_home=eggo_config.get('worker_env', 'hadoop_home'),
-                           tmp_path=os.path.join(tmp_staged_dir, filename),
-                           final_path=destination),
-                       shell=True)
-        finally:
-            pass # TODO: clean up dfs tmp dir
-    finally:
-        rmtree(tmp_local_dir)
+def keep_bgzf(source):
+    """Whether a source is staged BGZF-compressed instead of decompressed."""
+    return (source['compression'] and bool(source.get('bgzf')) and
+            not source.get('regions') and
+            eggo_config.getboolean('execution', 'keep_bgzf'))
+
+
+def raw_dest_filename(source):
+    return build_dest_filename(
+        source['url'],
+        decompress=source['compression'] and not keep_bgzf(source))
+
+
+def preflight_sidecar_path():
+    return sidecar_path(
+        os.path.join(eggo_config.get('worker_env', 'work_path'), 'preflight'),
+        ToastConfig().config)
+
+
+class PreflightTask(Task):
+    """Probe all sources of the toast before any of them is downloaded."""
+
+    def complete(self):
+        # a cached sidecar is only reused if it matches the current sources
+        return load_preflight(preflight_sidecar_path(),
+                              ToastConfig().config['sources']) is not None
+
+    def run(self):
+        sidecar = preflight(ToastConfig().config['sources'],
+                            preflight_sidecar_path())
+        failed = failed_sources(sidecar)
+        if failed:
+            raise PreflightError('Preflight failed for {0} sources: {1}'.format(
+                len(failed), '; '.join('{url}: {error}'.format(**r)
+                                       for r in failed)))
+
+    def output(self):
+        return LocalTarget(preflight_sidecar_path())
 
 
 class DownloadFileToDFSTask(Task):
@@ -206,10 +451,16 @@ class DownloadFileToDFSTask(Task):
     source = Parameter()  # string: URL suitable for curl
     target = Parameter()  # string: full URL path of destination file name
     compression = Parameter()  # bool: whether file needs to be decompressed
+    format = Parameter(default=None)  # string: source format
+    regions = Parameter(default=None)  # list: only download these regions
+    keep_bgzf = Parameter(default=False)  # bool: keep BGZF compressed
+    size = Parameter(default=None)  # int: source size in bytes, if known
+    etag = Parameter(default=None)  # string: source ETag, if known
 
     def run(self):
         _dnload_to_local_upload_to_dfs(
-            self.source, self.target, self.compression)
+            self.source, self.target, self.compression, self.format,
+            self.regions, self.keep_bgzf, self.size, self.etag)
 
     def output(self):
         return file_target(path=self.target)
@@ -221,13 +472,25 @@ class DownloadDatasetTask(Task):
     destination = Parameter()  # full S3 prefix to put data
 
     def requires(self):
+        yield PreflightTask()
+        # BGZF sources are only known once the preflight has run
+        sidecar = load_preflight(preflight_sidecar_path(),
+                                 ToastConfig().config['sources'])
+        bgzf = bgzf_sources(sidecar) if sidecar is not None else set()
+        sizes = source_sizes(sidecar) if sidecar is not None else {}
+        etags = source_etags(sidecar) if sidecar is not None else {}
         for source in ToastConfig().config['sources']:
-            dest_name = build_dest_filename(source['url'],
-                                            decompress=source['compression'])
+            source = dict(source, bgzf=source['url'] in bgzf)
             yield DownloadFileToDFSTask(
                 source=source['url'],
-                target=os.path.join(self.destination, dest_name),
-                compression=source['compression'])
+                target=os.path.join(self.destination,
+                                    raw_dest_filename(source)),
+                compression=source['compression'],
+                format=source['format'],
+                regions=source.get('regions'),
+                keep_bgzf=keep_bgzf(source),
+                size=sizes.get(source['url']),
+                etag=etags.get(source['url']))
 
     def run(self):
         create_SUCCESS_file(self.destination)
@@ -239,26 +502,39 @@ class DownloadDatasetTask(Task):
 class PrepareHadoopDownloadTask(Task):
     hdfs_path = Parameter()
 
+    def requires(self):
+        return PreflightTask()
+
     def run(self):
-        tmp_dir = mkdtemp(
-            prefix='tmp_eggo_',
-            dir=eggo_config.get('worker_env', 'work_path'))
+        with self.input().open('r') as ip:
+            sidecar = json.load(ip)
+        sizes = source_sizes(sidecar)
+        etags = source_etags(sidecar)
+        bgzf = bgzf_sources(sidecar)
+        # start the largest downloads first, so that they don't straggle at
+        # the end of the job
+        sources = sorted(ToastConfig().config['sources'],
+                         key=lambda s: sizes.get(s['url']) or 0,
+                         reverse=True)
+        (tmp_dir, reservation) = allocate()
         try:
             # build the remote command for each source
             tmp_command_file = '{0}/command_file'.format(tmp_dir)
             with open(tmp_command_file, 'w') as command_file:
-                for source in ToastConfig().config['sources']:
+                for source in sources:
+                    source = dict(source, size=sizes.get(source['url']),
+                                  etag=etags.get(source['url']),
+                                  bgzf=source['url'] in bgzf)
                     command_file.write('{0}\n'.format(json.dumps(source)))
 
             # 3. Copy command file to Hadoop filesystem
-            hdfs_client = HdfsClient()
-            hdfs_client.mkdir(os.path.dirname(self.hdfs_path), True)
-            hdfs_client.put(tmp_command_file, self.hdfs_path)
+            make_dir(os.path.dirname(self.hdfs_path), hadoop_cli())
+            put_file(tmp_command_file, self.hdfs_path, hadoop_cli())
         finally:
-            rmtree(tmp_dir)
+            release(tmp_dir, reservation)
 
     def output(self):
-        return HdfsTarget(path=self.hdfs_path)
+        return EggoHdfsTarget(path=self.hdfs_path)
 
 
 class DownloadDatasetHadoopTask(JobTask):
@@ -270,12 +546,18 @@ class DownloadDatasetHadoopTask(JobTask):
 
     def job_runner(self):
         addl_conf = {'mapred.map.tasks.speculative.execution': 'false',
-                     'mapred.task.timeout': 12000000}
+                     # downloads report their progress as task status, and
+                     # stalled downloads are abandoned by eggo.transfer
+                     'mapred.task.timeout': 3600000}
         # TODO: can we delete the AWS vars with Director? does it set AWS cred in core-site.xml?
         streaming_args=['-cmdenv', 'EGGO_HOME=' + eggo_config.get('worker_env', 'eggo_home'),
                         '-cmdenv', 'EGGO_CONFIG=' + eggo_config.get('worker_env', 'eggo_config_path'),
                         '-cmdenv', 'AWS_ACCESS_KEY_ID=' + eggo_config.get('aws', 'aws_access_key_id'),
                         '-cmdenv', 'AWS_SECRET_ACCESS_KEY=' + eggo_config.get('aws', 'aws_secret_access_key')]
+        if profile_run() is not None:
+            # profile the mappers as part of the same run
+            streaming_args.extend(
+                ['-cmdenv', '{0}={1}'.format(PROFILE_ENV, profile_run())])
         return HadoopJobRunner(streaming_jar=eggo_config.get('worker_env', 'streaming_jar'),
                                streaming_args=streaming_args,
                                jobconfs=addl_conf,
@@ -285,17 +567,8 @@ class DownloadDatasetHadoopTask(JobTask):
 
     def mapper(self, line):
         source = json.loads('\t'.join(line.split('\t')[1:]))
-        dest_name = build_dest_filename(source['url'],
-                                        decompress=source['compression'])
-        dest_url = os.path.join(self.destination, dest_name)
-        if dest_url.startswith("s3:") or dest_url.startswith("s3n:"):
-            client = S3Client(eggo_config.get('aws', 'aws_access_key_id'),
-                              eggo_config.get('aws', 'aws_secret_access_key'))
-        else:
-            client = HdfsClient()
-        if not client.exists(dest_url):
-            _dnload_to_local_upload_to_dfs(
-                source['url'], dest_url, source['compression'])
+        with profiled('DownloadDatasetHadoopTask.mapper'):
+            _download_source_to(source, self.destination)
 
         yield (source['url'], 1)  # dummy output
 
@@ -303,14 +576,120 @@ class DownloadDatasetHadoopTask(JobTask):
         return flag_target(self.destination)
 
 
+def _download_source_to(source, destination):
+    # download a source (as in the command file) into destination, unless it
+    # is there already
+    dest_url = os.path.join(destination, raw_dest_filename(source))
+    if not exists(dest_url, hadoop_cli()):
+        _dnload_to_local_upload_to_dfs(
+            source['url'], dest_url, source['compression'],
+            source['format'], source.get('regions'), keep_bgzf(source),
+            source.get('size'), source.get('etag'))
+
+
+def _download_job(job):
+    # module level, so that it can be pickled to the pool processes
+    (source, destination) = job
+    _download_source_to(source, destination)
+
+
+class DownloadDatasetLocalTask(Task):
+    """Download the sources in a process pool sized to the CPU count, in
+    place of DownloadDatasetHadoopTask when the local engine is used."""
+
+    destination = Parameter()  # full file:// path to put data
+
+    def requires(self):
+        return PreflightTask()
+
+    def run(self):
+        with self.input().open('r') as ip:
+            sidecar = json.load(ip)
+        sizes = source_sizes(sidecar)
+        etags = source_etags(sidecar)
+        bgzf = bgzf_sources(sidecar)
+        # largest first, as in PrepareHadoopDownloadTask
+        sources = sorted(ToastConfig().config['sources'],
+                         key=lambda s: sizes.get(s['url']) or 0,
+                         reverse=True)
+        jobs = [(dict(source, size=sizes.get(source['url']),
+                      etag=etags.get(source['url']),
+                      bgzf=source['url'] in bgzf), self.destination)
+                for source in sources]
+        pool = Pool(min(cpu_count(), len(jobs)) or 1)
+        try:
+            pool.map(_download_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        create_SUCCESS_file(self.destination)
+
+    def output(self):
+        return flag_target(self.destination)
+
+
+def download_task(destination):
+    """The task that downloads the sources of the toast into destination."""
+    if local_engine():
+        return DownloadDatasetLocalTask(destination=destination)
+    return DownloadDatasetHadoopTask(destination=destination)
+
+
 class DeleteDatasetTask(Task):
 
     def run(self):
-        delete_raw_cmd = '{hadoop_home}/bin/hadoop fs -rm -r {raw} {target}'.format(
-            hadoop_home=eggo_config.get('worker_env', 'hadoop_home'),
-            raw=ToastConfig().raw_data_url(),
-            target=ToastConfig().dataset_url())
-        check_call(delete_raw_cmd, shell=True)
+        delete_prefix(ToastConfig().raw_data_url(), hadoop_bin=hadoop_cli())
+        delete_prefix(ToastConfig().dataset_url(), hadoop_bin=hadoop_cli())
+
+
+def adam_parquet_args(edition):
+    """ADAM arguments that set the Parquet options of an edition."""
+    options = edition_parquet_options(ToastConfig().config, edition)
+    return ['-parquet_compression_codec', options['codec'].upper(),
+            '-parquet_block_size', str(options['row_group_mb'] * 1024 * 1024),
+            '-parquet_page_size', str(options['page_kb'] * 1024)]
+
+
+def run_adam(command, args):
+    """Run an ADAM command (e.g. vcf2adam) with args, as its own adam-submit
+    application or in the warm ADAM session (execution.adam_executor).
+
+    Returns the seconds spent waiting for the session, which are not part of
+    the conversion's own time (0 with adam-submit).
+    """
+    if eggo_config.get('execution', 'adam_executor') == 'session':
+        timing = run_in_adam_session(command, args)
+        print >> sys.stderr, ('eggo adam session: {0} ran in {1:.1f}s after '
+                              'waiting {2:.1f}s'.format(
+                                  command, timing['run'], timing['queued']))
+        return timing['queued']
+    adam_cmd = ('{adam_home}/bin/adam-submit --master {spark_master} '
+                '{command} {args}').format(
+                    adam_home=eggo_config.get('worker_env', 'adam_home'),
+                    spark_master=spark_master(),
+                    command=command, args=' '.join(quote(a) for a in args))
+    check_call(adam_cmd, shell=True)
+    return 0
+
+
+# the flag of an edition that is indexed and recorded in the catalog; ADAM's
+# _SUCCESS only means that its data is written
+COMMITTED_FLAG = '_COMMITTED'
+
+
+def edition_converted(url):
+    """Whether the conversion that writes the edition at url finished."""
+    return exists(os.path.join(url, '_SUCCESS'), hadoop_cli())
+
+
+def commit_edition(edition):
+    """Index an edition whose data is written and record it in the catalog,
+    and only then flag it committed, so that a failure in between leaves its
+    task incomplete and a rerun repairs it."""
+    url = ToastConfig().edition_url(edition=edition)
+    write_index(url, hadoop_bin=hadoop_cli())
+    record_edition(ToastConfig().config, 'bdg', edition, url)
+    write_file(os.path.join(url, COMMITTED_FLAG), '', hadoop_bin=hadoop_cli())
 
 
 class ADAMBasicTask(Task):
@@ -320,34 +699,50 @@ class ADAMBasicTask(Task):
     edition = 'basic'
 
     def requires(self):
-        return DownloadDatasetHadoopTask(
-            destination=ToastConfig().raw_data_url())
+        return download_task(ToastConfig().raw_data_url())
 
     def run(self):
+        url = ToastConfig().edition_url(edition=self.edition)
+        self.adam_wait_seconds = 0
+        # the files of an interrupted compaction are not a partial conversion
+        finish_compaction(url, hadoop_cli())
+        if not edition_converted(url):
+            # a partial edition of a failed attempt would fail ADAM
+            delete_prefix(url, hadoop_bin=hadoop_cli())
+            self.convert()
+        # 3. Index the edition and record it in the dataset catalog
+        commit_edition(self.edition)
+
+    def convert(self):
         format = ToastConfig().config['sources'][0]['format'].lower()
         if format not in self.allowed_file_formats:
             raise ValueError("Format '{0}' not in allowed formats {1}.".format(
                 format, self.allowed_file_formats))
 
-        # 1. Copy the data from source (e.g. S3) to Hadoop's default filesystem
-        tmp_hadoop_path = '/tmp/{rand_id}.{format}'.format(rand_id=random_id(),
-                                                           format=format)
-        distcp_cmd = '{hadoop_home}/bin/hadoop distcp {source} {target}'.format(
-            hadoop_home=eggo_config.get('worker_env', 'hadoop_home'),
-            source=ToastConfig().raw_data_url(), target=tmp_hadoop_path)
-        check_call(distcp_cmd, shell=True)
-
-        # 2. Run the adam-submit job
-        adam_cmd = ('{adam_home}/bin/adam-submit --master {spark_master} {adam_command} '
-                    '{source} {target}').format(
-                        adam_home=eggo_config.get('worker_env', 'adam_home'),
-                        spark_master=eggo_config.get('worker_env', 'spark_master'),
-                        adam_command=self.adam_command, source=tmp_hadoop_path,
-                        target=ToastConfig().edition_url(edition=self.edition))
-        check_call(adam_cmd, shell=True)
+        # 1. Copy the data from source (e.g. S3) to Hadoop's default
+        # filesystem; the local engine reads the raw data where it is
+        tmp_hadoop_path = ToastConfig().raw_data_url()
+        if not local_engine():
+            tmp_hadoop_path = '/tmp/{rand_id}.{format}'.format(
+                rand_id=random_id(), format=format)
+            distcp_cmd = '{hadoop_home}/bin/hadoop distcp {source} {target}'.format(
+                hadoop_home=eggo_config.get('worker_env', 'hadoop_home'),
+                source=ToastConfig().raw_data_url(), target=tmp_hadoop_path)
+            check_call(distcp_cmd, shell=True)
+
+        # 2. Run the ADAM job
+        source = tmp_hadoop_path
+        if format == 'vcf':
+            # skip the .bgzfi block indexes of BGZF files kept compressed
+            source = '{0}/*.{{vcf,gz}}'.format(tmp_hadoop_path)
+        self.adam_wait_seconds = run_adam(
+            self.adam_command,
+            [source, ToastConfig().edition_url(edition=self.edition)] +
+            adam_parquet_args(self.edition))
 
     def output(self):
-        return flag_target(ToastConfig().edition_url(edition=self.edition))
+        return flag_target(ToastConfig().edition_url(edition=self.edition),
+                           flag=COMMITTED_FLAG)
 
 
 class ADAMFlattenTask(Task):
@@ -362,17 +757,20 @@ class ADAMFlattenTask(Task):
                              allowed_file_formats=self.allowed_file_formats)
 
     def run(self):
-        adam_cmd = ('{adam_home}/bin/adam-submit --master {spark_master} flatten '
-                    '{source} {target}').format(
-                        adam_home=eggo_config.get('worker_env', 'adam_home'),
-                        spark_master=eggo_config.get('worker_env', 'spark_master'),
-                        source=ToastConfig().edition_url(
-                            edition=self.source_edition),
-                        target=ToastConfig().edition_url(edition=self.edition))
-        check_call(adam_cmd, shell=True)
+        url = ToastConfig().edition_url(edition=self.edition)
+        self.adam_wait_seconds = 0
+        finish_compaction(url, hadoop_cli())
+        if not edition_converted(url):
+            delete_prefix(url, hadoop_bin=hadoop_cli())
+            self.adam_wait_seconds = run_adam(
+                'flatten',
+                [ToastConfig().edition_url(edition=self.source_edition),
+                 url] + adam_parquet_args(self.edition))
+        commit_edition(self.edition)
 
     def output(self):
-        return flag_target(ToastConfig().edition_url(edition=self.edition))
+        return flag_target(ToastConfig().edition_url(edition=self.edition),
+                           flag=COMMITTED_FLAG)
 
 
 class ToastTask(Task):
@@ -381,22 +779,258 @@ class ToastTask(Task):
         return flag_target(ToastConfig().edition_url(edition=self.edition))
 
 
-class VCF2ADAMTask(Task):
+def compaction_target_bytes():
+    target_mb = eggo_config.get('execution', 'compaction_target_mb')
+    return int(target_mb) * 1024 * 1024 if target_mb != '' else None
+
+
+def _compaction_groups(parts, target_bytes):
+    # pack consecutive part files (in name order, so that row order is
+    # preserved) into groups of at most target_bytes
+    groups = []
+    group_size = 0
+    for (name, size) in parts:
+        if groups and group_size + size <= target_bytes:
+            groups[-1].append(name)
+            group_size += size
+        else:
+            groups.append([name])
+            group_size = size
+    return groups
+
+
+def _count_part_rows(url, names):
+    return sum(num_rows(read_footer(os.path.join(url, name)))
+               for name in names)
+
+
+def _data_files(url, hadoop_bin):
+    # everything in an edition directory but its flags
+    return [name for (name, _) in list_files(url, hadoop_bin=hadoop_bin)
+            if name not in EDITION_FLAGS]
+
+
+# the flags of an edition directory, which stay while its data is swapped
+EDITION_FLAGS = ['_SUCCESS', COMMITTED_FLAG, '_COMPACTED', '_VALIDATED']
+
+
+def _swap_in(url, staged_url, hadoop_bin):
+    # replace the edition at url with the complete one at staged_url
+    if renames_atomically(url):
+        # two renames; in between, the edition is only at staged_url, where
+        # finish_compaction() finds it after a failure
+        superseded_url = url + SUPERSEDED_SUFFIX
+        if exists(url, hadoop_bin):
+            delete_prefix(superseded_url, hadoop_bin=hadoop_bin)
+            rename(url, superseded_url, hadoop_bin)
+        rename(staged_url, url, hadoop_bin)
+        delete_prefix(superseded_url, hadoop_bin=hadoop_bin)
+        return
+    # no directory renames (S3): the files are replaced in place with the
+    # edition uncommitted, which readers of the flag wait out, and the
+    # committed staged copy is kept until the edition is committed again
+    delete_files(url, [COMMITTED_FLAG], hadoop_bin)
+    delete_files(url, _data_files(url, hadoop_bin), hadoop_bin)
+    for name in _data_files(staged_url, hadoop_bin):
+        copy(os.path.join(staged_url, name), os.path.join(url, name),
+             hadoop_bin)
+    write_file(os.path.join(url, COMMITTED_FLAG), '', hadoop_bin=hadoop_bin)
+    delete_prefix(staged_url, hadoop_bin=hadoop_bin)
+
+
+def finish_compaction(url, hadoop_bin):
+    """Finish swapping a compacted edition in at url, if a failed attempt
+    staged it completely; returns whether there was one."""
+    staged_url = url + STAGING_SUFFIX
+    if not exists(os.path.join(staged_url, COMMITTED_FLAG), hadoop_bin):
+        return False
+    _swap_in(url, staged_url, hadoop_bin)
+    return True
+
+
+class CompactEditionTask(Task):
+    """Rewrite the Parquet part files of an edition into larger files.
+
+    The compacted edition is staged in a directory next to the original,
+    where its row count is checked against the original and it is indexed
+    and flagged committed.  It is then swapped in at the edition's url: by
+    renaming the directories where renames are atomic (HDFS and local
+    filesystems), or else by replacing the files in place while the edition
+    is uncommitted.  Either way, a rerun after a failure finishes the swap.
+    """
+
+    adam_command = Parameter()
+    allowed_file_formats = Parameter()
+    edition = Parameter()
 
     def requires(self):
-        basic = ADAMBasicTask(adam_command='vcf2adam',
-                              allowed_file_formats=['vcf'])
-        flat = ADAMFlattenTask(adam_command='vcf2adam',
-                               allowed_file_formats=['vcf'])
-        dependencies = [basic]
-        conf = ToastConfig().config
-        editions = conf['editions'] if 'editions' in conf else []
-        for edition in editions:
-            if edition == 'basic':
-                pass # included by default
-            elif edition == 'flat':
-                dependencies.append(flat)
+        # wait for every edition to be converted, as e.g. the flat edition is
+        # read from the basic one
+        return edition_tasks(self.adam_command, self.allowed_file_formats)
+
+    def run(self):
+        url = ToastConfig().edition_url(edition=self.edition)
+        hadoop_bin = hadoop_cli()
+        # after a failure past the swap, the files are compacted already, so
+        # that compacting them again leaves them as they are
+        if not finish_compaction(url, hadoop_bin):
+            staged_url = url + STAGING_SUFFIX
+            if self.compact(url, staged_url, hadoop_bin):
+                _swap_in(url, staged_url, hadoop_bin)
+        # the catalog is updated before the flag, so that a rerun after a
+        # failure here repairs it
+        record_edition(ToastConfig().config, 'bdg', self.edition, url)
+        write_file(os.path.join(url, '_COMPACTED'), '', hadoop_bin=hadoop_bin)
+
+    def compact(self, url, target_url, hadoop_bin):
+        """Stage the compacted files of the edition at url in target_url;
+        returns whether there was anything to compact."""
+        parts = sorted((name, size) for (name, size) in
+                       list_files(url, hadoop_bin=hadoop_bin)
+                       if '/' not in name and not name.startswith(('_', '.')))
+        groups = _compaction_groups(parts, compaction_target_bytes())
+        if len(groups) == len(parts):
+            return False
+        # a partial rewrite of a failed attempt
+        delete_prefix(target_url, hadoop_bin=hadoop_bin)
+        rewrite([[os.path.join(url, name) for name in group]
+                 for group in groups], target_url,
+                edition_parquet_options(ToastConfig().config, self.edition),
+                hadoop_bin)
+
+        expected = _count_part_rows(url, [name for (name, _) in parts])
+        actual = _count_part_rows(target_url, [
+            name for (name, _) in list_files(target_url, hadoop_bin=hadoop_bin)
+            if '/' not in name and not name.startswith(('_', '.'))])
+        if actual != expected:
+            raise ValueError(
+                'Compacted edition {0} has {1} rows, expected {2}'.format(
+                    url, actual, expected))
+
+        # the flag marks the staged edition complete, for finish_compaction()
+        write_index(target_url, hadoop_bin=hadoop_bin)
+        write_file(os.path.join(target_url, COMMITTED_FLAG), '',
+                   hadoop_bin=hadoop_bin)
+        return True
+
+    def output(self):
+        return flag_target(ToastConfig().edition_url(edition=self.edition),
+                           flag='_COMPACTED')
+
+
+def edition_tasks(adam_command, allowed_file_formats):
+    """The conversion tasks for the editions requested by the toast config."""
+    basic = ADAMBasicTask(adam_command=adam_command,
+                          allowed_file_formats=allowed_file_formats)
+    flat = ADAMFlattenTask(adam_command=adam_command,
+                           allowed_file_formats=allowed_file_formats)
+    dependencies = [basic]
+    for edition in edition_names(ToastConfig().config):
+        if edition == 'basic':
+            pass # included by default
+        elif edition == 'flat':
+            dependencies.append(flat)
+    return dependencies
+
+
+def finished_edition_tasks(adam_command, allowed_file_formats):
+    """The tasks that finish the editions: the conversions, compacted if
+    enabled."""
+    dependencies = edition_tasks(adam_command, allowed_file_formats)
+    if compaction_target_bytes() is None:
         return dependencies
+    return [CompactEditionTask(adam_command=adam_command,
+                               allowed_file_formats=allowed_file_formats,
+                               edition=task.edition)
+            for task in dependencies]
+
+
+def validation_sidecar_path():
+    return os.path.join(eggo_config.get('worker_env', 'work_path'),
+                        'validation', '{0}.{1}.counts.json'.format(
+                            ToastConfig().config['name'],
+                            eggo_config.get('execution', 'random_id')))
+
+
+class CountRawRecordsTask(Task):
+    """Count the records of each raw file of the toast, once for all the
+    editions that are validated against them."""
+
+    def requires(self):
+        return download_task(ToastConfig().raw_data_url())
+
+    def run(self):
+        sidecar = load_preflight(preflight_sidecar_path(),
+                                 ToastConfig().config['sources'])
+        bgzf = bgzf_sources(sidecar) if sidecar is not None else set()
+        raw_urls = {}
+        for source in ToastConfig().config['sources']:
+            source = dict(source, bgzf=source['url'] in bgzf)
+            raw_urls[source['url']] = (
+                os.path.join(ToastConfig().raw_data_url(),
+                             raw_dest_filename(source)),
+                source['format'].lower())
+        counts = count_raw_files(dict(raw_urls.itervalues()),
+                                 hadoop_bin=hadoop_cli())
+        sources = [dict(counts[raw_url], url=url, raw_url=raw_url)
+                   for (url, (raw_url, _)) in sorted(raw_urls.iteritems())]
+        with self.output().open('w') as op:
+            json.dump({'sources': sources}, op)
+
+    def output(self):
+        return LocalTarget(validation_sidecar_path())
+
+
+class ValidateEditionTask(Task):
+    """Check that an edition has as many rows as its raw records make."""
+
+    adam_command = Parameter()
+    allowed_file_formats = Parameter()
+    edition = Parameter()
+
+    def requires(self):
+        finished = [task for task in finished_edition_tasks(
+            self.adam_command, self.allowed_file_formats)
+            if task.edition == self.edition]
+        return {'edition': finished[0], 'counts': CountRawRecordsTask()}
+
+    def run(self):
+        with self.input()['counts'].open('r') as ip:
+            sources = json.load(ip)['sources']
+        url = ToastConfig().edition_url(edition=self.edition)
+        expected = sum(source['rows'] for source in sources)
+        actual = edition_rows(url, hadoop_bin=hadoop_cli())
+        report = '\n'.join('  {url}: {records} records, {rows} rows'.format(
+            **source) for source in sources)
+        if actual != expected:
+            raise ValidationError(
+                'Edition {0} has {1} rows, but its raw records make {2}:\n'
+                '{3}'.format(url, actual, expected, report))
+        print >> sys.stderr, 'eggo validate: {0} has the {1} rows of its raw ' \
+            'records:\n{2}'.format(url, actual, report)
+        write_file(os.path.join(url, '_VALIDATED'), '', hadoop_bin=hadoop_cli())
+
+    def output(self):
+        return flag_target(ToastConfig().edition_url(edition=self.edition),
+                           flag='_VALIDATED')
+
+
+def toast_tasks(adam_command, allowed_file_formats):
+    """The final tasks of a toast: the finished editions, validated if
+    enabled."""
+    dependencies = finished_edition_tasks(adam_command, allowed_file_formats)
+    if not eggo_config.getboolean('execution', 'validate_editions'):
+        return dependencies
+    return [ValidateEditionTask(adam_command=adam_command,
+                                allowed_file_formats=allowed_file_formats,
+                                edition=task.edition)
+            for task in dependencies]
+
+
+class VCF2ADAMTask(Task):
+
+    def requires(self):
+        return toast_tasks('vcf2adam', ['vcf'])
 
     def run(self):
         pass
@@ -408,17 +1042,4 @@ class VCF2ADAMTask(Task):
 class BAM2ADAMTask(Task):
 
     def requires(self):
-        basic = ADAMBasicTask(adam_command='transform',
-                              allowed_file_formats=['sam', 'bam'])
-        flat = ADAMFlattenTask(adam_command='transform',
-                               allowed_file_formats=['sam', 'bam'])
-        dependencies = [basic]
-        conf = ToastConfig().config
-        editions = conf['editions'] if 'editions' in conf else []
-        for edition in editions:
-            if edition == 'basic':
-                pass # included by default
-            elif edition == 'flat':
-                dependencies.append(flat)
-        return dependencies
-
+        return toast_tasks('transform', ['sam', 'bam'])
@@ -0,0 +1,605 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bulk operations on the target distributed filesystem (dfs)."""
+
+import os
+import time
+import errno
+import hashlib
+import threading
+from shutil import rmtree
+from urlparse import urlparse
+from itertools import islice
+from tempfile import NamedTemporaryFile
+from subprocess import (
+    Popen, PIPE, call, check_call, check_output, CalledProcessError)
+from multiprocessing.pool import ThreadPool
+
+from boto.s3.connection import S3Connection
+
+from eggo import webhdfs
+from eggo.fastcopy import copy_file as copy_local_file
+
+
+S3_SCHEMES = ['s3', 's3n', 's3a']
+
+# the maximum number of keys in one S3 multi-object delete request
+S3_DELETE_BATCH_SIZE = 1000
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class DeleteStats(object):
+
+    def __init__(self, url, dry_run):
+        self.url = url
+        self.dry_run = dry_run
+        self.keys = 0
+        self.bytes = 0
+        self.errors = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, keys, size, errors=0):
+        with self._lock:
+            self.keys += keys
+            self.bytes += size
+            self.errors += errors
+
+    def keys_per_sec(self):
+        elapsed = time.time() - self.start
+        return self.keys / elapsed if elapsed > 0 else float(self.keys)
+
+    def report(self):
+        verb = 'Would delete' if self.dry_run else 'Deleted'
+        print ('{verb} {keys} keys ({bytes} bytes) under {url} in {t:.1f}s '
+               '({rate:.0f} keys/s, {errors} errors)').format(
+                   verb=verb, keys=self.keys, bytes=self.bytes, url=self.url,
+                   t=time.time() - self.start, rate=self.keys_per_sec(),
+                   errors=self.errors)
+
+
+def _delete_s3(url, stats, threads):
+    # boto connections are not thread-safe, so each thread gets its own
+    local_conn = threading.local()
+
+    def get_bucket():
+        if not hasattr(local_conn, 'bucket'):
+            local_conn.bucket = S3Connection().get_bucket(url.netloc)
+        return local_conn.bucket
+
+    def delete_batch(batch):
+        result = get_bucket().delete_keys([name for (name, _) in batch],
+                                          quiet=True)
+        failed = set(e.key for e in result.errors)
+        stats.add(len(batch) - len(failed),
+                  sum(size for (name, size) in batch if name not in failed),
+                  len(failed))
+
+    # bucket.list() pages through the listing lazily (1000 keys per request),
+    # so deletes start as soon as the first page arrives.  The trailing slash
+    # keeps e.g. raw/foo from also matching raw/foo-bar
+    prefix = url.path.strip('/') + '/'
+    keys = ((k.name, k.size) for k in get_bucket().list(prefix))
+    batches = _batches(keys, S3_DELETE_BATCH_SIZE)
+    if stats.dry_run:
+        for batch in batches:
+            stats.add(len(batch), sum(size for (_, size) in batch))
+        return
+    pool = ThreadPool(threads)
+    try:
+        for _ in pool.imap_unordered(delete_batch, batches):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _delete_hdfs(url, stats, hadoop_bin):
+    client = _webhdfs(url)
+    if client is not None:
+        files = client.walk(url.path)
+        if client.status(url.path) is not None and not stats.dry_run:
+            client.delete(url.path, recursive=True)
+        stats.add(len(files), sum(size for (_, size) in files))
+        return
+    # output of -count is: DIR_COUNT FILE_COUNT CONTENT_SIZE PATHNAME
+    with open(os.devnull, 'w') as devnull:
+        try:
+            counts = check_output([hadoop_bin, 'fs', '-count', url.geturl()],
+                                  stderr=devnull).split()
+        except CalledProcessError:
+            return  # nothing to delete
+    if not stats.dry_run:
+        call([hadoop_bin, 'fs', '-rm', '-r', '-skipTrash', url.geturl()])
+    stats.add(int(counts[1]), int(counts[2]))
+
+
+def _delete_local(url, stats):
+    keys = 0
+    size = 0
+    for (dirpath, _, filenames) in os.walk(url.path):
+        for filename in filenames:
+            keys += 1
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    if not stats.dry_run:
+        rmtree(url.path, ignore_errors=True)
+    stats.add(keys, size)
+
+
+def delete_prefix(url, dry_run=False, threads=16, hadoop_bin='hadoop'):
+    """Recursively delete everything under url and report the throughput.
+
+    S3 listings are paged and deleted in batches of S3_DELETE_BATCH_SIZE keys
+    across a pool of threads; HDFS paths are removed with a single recursive
+    call.  With dry_run, nothing is deleted and only the number of keys and
+    bytes that would be deleted is reported.
+    """
+    parsed = urlparse(url)
+    stats = DeleteStats(url, dry_run)
+    if parsed.scheme in S3_SCHEMES:
+        _delete_s3(parsed, stats, threads)
+    elif parsed.scheme == 'hdfs':
+        _delete_hdfs(parsed, stats, hadoop_bin)
+    elif parsed.scheme == 'file':
+        _delete_local(parsed, stats)
+    else:
+        raise NotImplementedError(
+            "{0} dfs scheme not supported".format(parsed.scheme))
+    stats.report()
+    return stats
+
+
+def delete_files(url, names, hadoop_bin='hadoop'):
+    """Delete the files with the given names (relative paths) under the
+    directory at url; files that are already gone are ignored."""
+    parsed = urlparse(url)
+    paths = [os.path.join(parsed.path, name) for name in names]
+    if parsed.scheme in S3_SCHEMES:
+        bucket = _s3_bucket(parsed)
+        for batch in _batches(paths, S3_DELETE_BATCH_SIZE):
+            result = bucket.delete_keys([p.lstrip('/') for p in batch],
+                                        quiet=True)
+            if result.errors:
+                raise IOError('Could not delete {0} files under {1}'.format(
+                    len(result.errors), url))
+    elif parsed.scheme == 'file':
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    elif _webhdfs(parsed) is not None:
+        for path in paths:
+            _webhdfs(parsed).delete(path)
+    else:
+        # a hadoop process per batch of files, rather than per file
+        for batch in _batches(names, 100):
+            check_call([hadoop_bin, 'fs', '-rm', '-f', '-skipTrash'] +
+                       [os.path.join(url, name) for name in batch])
+
+
+def _s3_bucket(url):
+    return S3Connection().get_bucket(url.netloc)
+
+
+def _webhdfs(parsed):
+    # the WebHDFS client for an hdfs:// url, if that backend is configured
+    if parsed.scheme == 'hdfs' and webhdfs.enabled():
+        return webhdfs.client(parsed)
+    return None
+
+
+def _hadoop_succeeds(args, hadoop_bin):
+    with open(os.devnull, 'w') as devnull:
+        return call([hadoop_bin, 'fs'] + args, stdout=devnull,
+                    stderr=devnull) == 0
+
+
+def list_files(url, hadoop_bin='hadoop'):
+    """Recursively list the files under url as (relative name, size) pairs."""
+    parsed = urlparse(url)
+    base = parsed.path.rstrip('/') + '/'
+    if parsed.scheme in S3_SCHEMES:
+        prefix = base.lstrip('/')
+        return [(k.name[len(prefix):], k.size)
+                for k in _s3_bucket(parsed).list(prefix)
+                if not k.name.endswith('/')]
+    elif _webhdfs(parsed) is not None:
+        return _webhdfs(parsed).walk(parsed.path)
+    elif parsed.scheme == 'hdfs':
+        if not _hadoop_succeeds(['-test', '-e', url], hadoop_bin):
+            return []
+        files = []
+        # -ls -R lines: PERMISSIONS REPLICAS OWNER GROUP SIZE DATE TIME PATH
+        for line in check_output([hadoop_bin, 'fs', '-ls', '-R',
+                                  url]).splitlines():
+            fields = line.split(None, 7)
+            if len(fields) == 8 and not fields[0].startswith('d'):
+                path = urlparse(fields[7]).path
+                files.append((path[len(base):], int(fields[4])))
+        return files
+    elif parsed.scheme == 'file':
+        files = []
+        for (dirpath, _, filenames) in os.walk(parsed.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files.append((path[len(base):], os.path.getsize(path)))
+        return files
+    raise NotImplementedError(
+        "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+def read_file(url, hadoop_bin='hadoop'):
+    """Return the contents of the file at url, or None if it does not exist."""
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        key = _s3_bucket(parsed).get_key(parsed.path.lstrip('/'))
+        return key.get_contents_as_string() if key is not None else None
+    elif _webhdfs(parsed) is not None:
+        if not _webhdfs(parsed).exists(parsed.path):
+            return None
+        return _webhdfs(parsed).read(parsed.path)
+    elif parsed.scheme == 'hdfs':
+        if not _hadoop_succeeds(['-test', '-e', url], hadoop_bin):
+            return None
+        return check_output([hadoop_bin, 'fs', '-cat', url])
+    elif parsed.scheme == 'file':
+        if not os.path.exists(parsed.path):
+            return None
+        with open(parsed.path, 'rb') as ip:
+            return ip.read()
+    raise NotImplementedError(
+        "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+def read_tail(url, nbytes, hadoop_bin='hadoop'):
+    """Return (at most) the last nbytes of the file at url."""
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        key = _s3_bucket(parsed).get_key(parsed.path.lstrip('/'))
+        return key.get_contents_as_string(
+            headers={'Range': 'bytes=-{0}'.format(nbytes)})
+    elif _webhdfs(parsed) is not None:
+        length = _webhdfs(parsed).status(parsed.path)['length']
+        return _webhdfs(parsed).read(parsed.path, max(0, length - nbytes))
+    elif parsed.scheme == 'hdfs':
+        # the hadoop CLI has no ranged reads, so stream the file and keep its
+        # tail
+        p = Popen([hadoop_bin, 'fs', '-cat', url], stdout=PIPE)
+        tail = ''
+        for chunk in iter(lambda: p.stdout.read(1024 * 1024), ''):
+            tail = (tail + chunk)[-nbytes:]
+        if p.wait() != 0:
+            raise CalledProcessError(p.returncode, 'hadoop fs -cat ' + url)
+        return tail
+    elif parsed.scheme == 'file':
+        with open(parsed.path, 'rb') as ip:
+            ip.seek(0, os.SEEK_END)
+            ip.seek(max(0, ip.tell() - nbytes))
+            return ip.read()
+    raise NotImplementedError(
+        "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+def write_file(url, data, hadoop_bin='hadoop'):
+    """Replace the file at url with data (creating its directory), so that
+    readers never see a partial file."""
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        # a single S3 PUT is atomic
+        key = _s3_bucket(parsed).new_key(parsed.path.lstrip('/'))
+        key.set_contents_from_string(data)
+    elif _webhdfs(parsed) is not None:
+        client = _webhdfs(parsed)
+        tmp_path = parsed.path + '._COPYING_'
+        client.create(tmp_path, data, overwrite=True)
+        # rename does not overwrite, as with the hadoop CLI below
+        client.delete(parsed.path)
+        client.rename(tmp_path, parsed.path)
+    elif parsed.scheme == 'hdfs':
+        tmp_url = url + '._COPYING_'
+        make_dir(os.path.dirname(url), hadoop_bin)
+        with NamedTemporaryFile() as tmp:
+            tmp.write(data)
+            tmp.flush()
+            check_call([hadoop_bin, 'fs', '-put', '-f', tmp.name, tmp_url])
+        # hdfs mv does not overwrite, so there is a short window without a file
+        # (which eggo.catalog readers retry)
+        _hadoop_succeeds(['-rm', '-skipTrash', url], hadoop_bin)
+        check_call([hadoop_bin, 'fs', '-mv', tmp_url, url])
+    elif parsed.scheme == 'file':
+        tmp_path = parsed.path + '._COPYING_'
+        make_dir(os.path.dirname(url))
+        with open(tmp_path, 'wb') as op:
+            op.write(data)
+        os.rename(tmp_path, parsed.path)
+    else:
+        raise NotImplementedError(
+            "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+def file_md5(url):
+    """The MD5 (hex) of the file at url if it is cheap to get, else None."""
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        key = _s3_bucket(parsed).get_key(parsed.path.lstrip('/'))
+        etag = key.etag.strip('"') if key is not None else ''
+        # the ETag of a multipart upload is not the MD5 of the data
+        return etag if etag and '-' not in etag else None
+    elif parsed.scheme == 'file':
+        if not os.path.exists(parsed.path):
+            return None
+        md5 = hashlib.md5()
+        with open(parsed.path, 'rb') as ip:
+            for chunk in iter(lambda: ip.read(1024 * 1024), ''):
+                md5.update(chunk)
+        return md5.hexdigest()
+    return None
+
+
+class CopyStats(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.errors = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, files, size, skipped=0, skipped_bytes=0, errors=0):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+            self.skipped += skipped
+            self.skipped_bytes += skipped_bytes
+            self.errors += errors
+
+    def bytes_per_sec(self):
+        elapsed = time.time() - self.start
+        return self.bytes / elapsed if elapsed > 0 else float(self.bytes)
+
+    def report(self):
+        print ('Copied {files} files ({bytes} bytes) to {url} in {t:.1f}s '
+               '({rate:.1f} MB/s); skipped {skipped} files ({skipped_bytes} '
+               'bytes) already present; {errors} errors').format(
+                   files=self.files, bytes=self.bytes, url=self.url,
+                   t=time.time() - self.start,
+                   rate=self.bytes_per_sec() / 1e6, skipped=self.skipped,
+                   skipped_bytes=self.skipped_bytes, errors=self.errors)
+
+
+class _PopenReader(object):
+    # the stdout of a process as a file that fails if the process does
+
+    def __init__(self, args):
+        self.args = args
+        self.p = Popen(args, stdout=PIPE)
+
+    def read(self, n):
+        return self.p.stdout.read(n)
+
+    def close(self):
+        self.p.stdout.close()
+        if self.p.wait() != 0:
+            raise CalledProcessError(self.p.returncode, ' '.join(self.args))
+
+
+def open_read(url, offset=0, hadoop_bin='hadoop'):
+    """Open the file at url for streaming reads, starting at offset.
+
+    The result has read(n) and close() methods.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        key = _s3_bucket(parsed).get_key(parsed.path.lstrip('/'))
+        key.open_read(headers={'Range': 'bytes={0}-'.format(offset)}
+                      if offset else None)
+        return key
+    elif _webhdfs(parsed) is not None:
+        return _webhdfs(parsed).open(parsed.path, offset)
+    elif parsed.scheme == 'hdfs':
+        reader = _PopenReader([hadoop_bin, 'fs', '-cat', url])
+        while offset > 0:
+            # the hadoop CLI has no ranged reads
+            offset -= len(reader.read(min(offset, 1024 * 1024)))
+        return reader
+    elif parsed.scheme == 'file':
+        ip = open(parsed.path, 'rb')
+        ip.seek(offset)
+        return ip
+    raise NotImplementedError(
+        "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+def _stream(reader, op, chunk_size=1024 * 1024):
+    try:
+        for chunk in iter(lambda: reader.read(chunk_size), ''):
+            op.write(chunk)
+    finally:
+        reader.close()
+
+
+def _size(url, hadoop_bin):
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        return _s3_bucket(parsed).get_key(parsed.path.lstrip('/')).size
+    elif _webhdfs(parsed) is not None:
+        return _webhdfs(parsed).status(parsed.path)['length']
+    elif parsed.scheme == 'hdfs':
+        return int(check_output([hadoop_bin, 'fs', '-stat', '%b', url]))
+    elif parsed.scheme == 'file':
+        return os.path.getsize(parsed.path)
+    raise NotImplementedError(
+        "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+def copy_file(src, dst, hadoop_bin='hadoop'):
+    """Stream the file at src to dst (an hdfs or file url) without a local
+    copy.
+
+    The data goes to dst._COPYING_ first and is renamed into place, so dst
+    never holds a partial file.  A file:// copy that is interrupted resumes
+    from its ._COPYING_ file.
+    """
+    parsed = urlparse(dst)
+    if _webhdfs(parsed) is not None:
+        client = _webhdfs(parsed)
+        tmp_path = parsed.path + '._COPYING_'
+        reader = open_read(src, hadoop_bin=hadoop_bin)
+        try:
+            client.create(tmp_path, reader, size=_size(src, hadoop_bin),
+                          overwrite=True)
+        finally:
+            reader.close()
+        client.delete(parsed.path)
+        client.rename(tmp_path, parsed.path)
+    elif parsed.scheme == 'hdfs':
+        tmp_url = dst + '._COPYING_'
+        check_call([hadoop_bin, 'fs', '-mkdir', '-p', os.path.dirname(dst)])
+        put = Popen([hadoop_bin, 'fs', '-put', '-f', '-', tmp_url],
+                    stdin=PIPE)
+        try:
+            _stream(open_read(src, hadoop_bin=hadoop_bin), put.stdin)
+        finally:
+            put.stdin.close()
+            if put.wait() != 0:
+                raise CalledProcessError(put.returncode,
+                                         'hadoop fs -put - ' + tmp_url)
+        _hadoop_succeeds(['-rm', '-skipTrash', dst], hadoop_bin)
+        check_call([hadoop_bin, 'fs', '-mv', tmp_url, dst])
+    elif parsed.scheme == 'file':
+        tmp_path = parsed.path + '._COPYING_'
+        if not os.path.isdir(os.path.dirname(parsed.path)):
+            os.makedirs(os.path.dirname(parsed.path))
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        with open(tmp_path, 'ab' if offset else 'wb') as op:
+            _stream(open_read(src, offset, hadoop_bin), op)
+        os.rename(tmp_path, parsed.path)
+    else:
+        raise NotImplementedError(
+            "{0} dfs scheme not supported".format(parsed.scheme))
+
+
+# The operations of the toast DAG on its staging and output paths.  file://
+# urls are handled in-process, so that the local context never starts a JVM,
+# as are hdfs:// urls with the webhdfs backend; other urls (including S3, as
+# before) go through the hadoop CLI.
+
+def exists(url, hadoop_bin='hadoop'):
+    """Whether there is a file or directory at url."""
+    parsed = urlparse(url)
+    if parsed.scheme in S3_SCHEMES:
+        return _s3_bucket(parsed).get_key(parsed.path.lstrip('/')) is not None
+    elif parsed.scheme == 'file':
+        return os.path.exists(parsed.path)
+    elif _webhdfs(parsed) is not None:
+        return _webhdfs(parsed).exists(parsed.path)
+    return _hadoop_succeeds(['-test', '-e', url], hadoop_bin)
+
+
+def make_dir(url, hadoop_bin='hadoop'):
+    """Create the directory at url and its parents, if missing."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        if not os.path.isdir(parsed.path):
+            try:
+                os.makedirs(parsed.path)
+            except OSError:
+                # created concurrently by another task
+                if not os.path.isdir(parsed.path):
+                    raise
+    elif _webhdfs(parsed) is not None:
+        _webhdfs(parsed).mkdirs(parsed.path)
+    else:
+        # fails if the directory already exists, which is fine
+        _hadoop_succeeds(['-mkdir', '-p', url], hadoop_bin)
+
+
+def rename(src, dst, hadoop_bin='hadoop'):
+    """Move the file or directory at src to dst (atomically, for file://
+    and hdfs urls)."""
+    (parsed_src, parsed_dst) = (urlparse(src), urlparse(dst))
+    if parsed_src.scheme == 'file' and parsed_dst.scheme == 'file':
+        make_dir('file://' + os.path.dirname(parsed_dst.path))
+        os.rename(parsed_src.path, parsed_dst.path)
+    elif _webhdfs(parsed_src) is not None and \
+            parsed_src.netloc == parsed_dst.netloc:
+        _webhdfs(parsed_src).rename(parsed_src.path, parsed_dst.path)
+    else:
+        check_call([hadoop_bin, 'fs', '-mv', src, dst])
+
+
+def renames_atomically(url):
+    """Whether rename() moves a directory at url in a single step (unlike on
+    S3, where it is a copy and a delete of each object)."""
+    return urlparse(url).scheme not in S3_SCHEMES
+
+
+def copy(src, dst, hadoop_bin='hadoop'):
+    """Copy the file at src to dst, where both are on the same filesystem."""
+    (parsed_src, parsed_dst) = (urlparse(src), urlparse(dst))
+    if parsed_src.scheme == 'file' and parsed_dst.scheme == 'file':
+        copy_local_file(parsed_src.path, parsed_dst.path)
+    elif _webhdfs(parsed_dst) is not None:
+        copy_file(src, dst, hadoop_bin)
+    else:
+        check_call([hadoop_bin, 'fs', '-cp', src, dst])
+
+
+def put_file(local_path, url, hadoop_bin='hadoop', progress=None,
+             chunk_size=1024 * 1024, link=False):
+    """Upload the local file at local_path to url, calling progress.add()
+    (e.g. of an eggo.progress.Progress) with the bytes sent.
+
+    A file:// url is written with the cheapest copy the filesystems allow
+    (see eggo.fastcopy), or, with link, may be a hard link to local_path.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        copy_local_file(local_path, parsed.path, progress, link)
+        return
+    if _webhdfs(parsed) is not None:
+        with open(local_path, 'rb') as ip:
+            _webhdfs(parsed).create(parsed.path, ip,
+                                    size=os.path.getsize(local_path),
+                                    progress=progress)
+        return
+    with open(local_path, 'rb') as ip:
+        # fed through a pipe, so that the bytes sent can be counted
+        put = Popen([hadoop_bin, 'fs', '-put', '-', url], stdin=PIPE)
+        op = put.stdin
+        try:
+            for chunk in iter(lambda: ip.read(chunk_size), ''):
+                op.write(chunk)
+                if progress is not None:
+                    progress.add(len(chunk))
+        finally:
+            op.close()
+    if put.wait() != 0:
+        raise CalledProcessError(put.returncode, 'hadoop fs -put - ' + url)
@@ -0,0 +1,180 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Show what a toast would do, without running any of it.
+
+The toast DAG is resolved the way Luigi would resolve it: the dependencies of
+a task are only followed if the task is not complete.  Every remaining task
+gets an estimate of the bytes it reads and writes and of its duration, from
+the sizes of the sources (from the preflight) and the per-node throughputs of
+earlier toasts (see eggo.planner).  Meant to be run on the master (see `eggo
+dry_run`), with the same arguments as toaster.py.
+"""
+
+import sys
+
+from luigi.interface import ArgParseInterface
+
+from eggo.dag import ToastConfig, keep_bgzf, preflight_sidecar_path
+from eggo.preflight import load_preflight, source_sizes, bgzf_sources
+from eggo.scratch import GZIP_EXPANSION
+
+
+# ADAM Parquet is about the size of the gzipped source
+PARQUET_RATIO = 1.0
+
+# seconds to probe one source in the preflight
+PREFLIGHT_SECONDS = 1.0
+
+
+def resolve_dag(root):
+    """Return [(task, complete, dependencies)] for the tasks Luigi would
+    check, dependencies before the tasks that need them."""
+    resolved = []
+    seen = set()
+
+    def visit(task):
+        if task.task_id in seen:
+            return
+        seen.add(task.task_id)
+        complete = task.complete()
+        deps = [] if complete else task.deps()
+        for dep in deps:
+            visit(dep)
+        resolved.append((task, complete, deps))
+
+    visit(root)
+    return resolved
+
+
+class _Sources(object):
+    # sizes of the toast's sources, as the download tasks will stage them
+
+    def __init__(self):
+        sources = ToastConfig().config['sources']
+        sidecar = load_preflight(preflight_sidecar_path(), sources)
+        sizes = source_sizes(sidecar) if sidecar is not None else {}
+        bgzf = bgzf_sources(sidecar) if sidecar is not None else set()
+        self.count = len(sources)
+        self.sizes = {}
+        self.staged = {}
+        self.unknown = 0
+        for source in sources:
+            size = sizes.get(source['url']) or source.get('size')
+            if size is None:
+                self.unknown += 1
+                size = 0
+            source = dict(source, bgzf=source['url'] in bgzf)
+            self.sizes[source['url']] = size
+            self.staged[source['url']] = size * (
+                GZIP_EXPANSION
+                if source['compression'] and not keep_bgzf(source) else 1)
+        self.total = sum(self.sizes.values())
+        self.total_staged = sum(self.staged.values())
+        self.parquet = self.total * PARQUET_RATIO
+
+
+def estimate(task, sources, download_rate, convert_rate, nodes):
+    """(bytes read, bytes written, seconds) of a task, from the per-node
+    download and convert throughputs (in source bytes per second)."""
+    family = task.task_family
+    if family == 'PreflightTask':
+        return (0, 0, sources.count * PREFLIGHT_SECONDS)
+    if family == 'DownloadFileToDFSTask':
+        # one source, downloaded by the scheduler
+        size = task.size or sources.sizes.get(task.source, 0)
+        return (size, sources.staged.get(task.source, size),
+                size / download_rate)
+    if family in ('DownloadDatasetHadoopTask', 'DownloadDatasetLocalTask'):
+        # one source per mapper, or per process of the local pool, which
+        # shares the bandwidth of its one machine
+        hosts = nodes if family == 'DownloadDatasetHadoopTask' else 1
+        return (sources.total, sources.total_staged,
+                sources.total / (download_rate * min(hosts, sources.count)))
+    if family == 'ADAMBasicTask':
+        return (sources.total_staged, sources.parquet,
+                sources.total / (convert_rate * nodes))
+    if family == 'ADAMFlattenTask':
+        # a second conversion, from the basic edition
+        return (sources.parquet, sources.parquet,
+                sources.total / (convert_rate * nodes))
+    if family == 'CompactEditionTask':
+        # the edition rewritten by a Spark job, like a conversion
+        return (sources.parquet, sources.parquet,
+                sources.parquet / (convert_rate * nodes))
+    if family == 'CountRawRecordsTask':
+        # the raw data streamed through the master once
+        return (sources.total_staged, 0, sources.total_staged / download_rate)
+    return (0, 0, 0)
+
+
+def plan_toast(cmdline_args, download_rate, convert_rate, nodes):
+    """Resolve the DAG of a toast (given toaster.py arguments) and return a
+    list of dicts, one per task, with task_id, complete, bytes_in,
+    bytes_out, seconds and finish (the critical-path time at which the task
+    would finish) keys, and the _Sources of the toast."""
+    root = ArgParseInterface().parse(cmdline_args)[0]
+    resolved = resolve_dag(root)
+    sources = _Sources()
+    finish = {}
+    plan = []
+    for (task, complete, deps) in resolved:
+        if complete:
+            (bytes_in, bytes_out, seconds) = (0, 0, 0)
+        else:
+            (bytes_in, bytes_out, seconds) = estimate(
+                task, sources, download_rate, convert_rate, nodes)
+        finish[task.task_id] = seconds + max(
+            [finish[d.task_id] for d in deps] or [0])
+        plan.append({'task_id': task.task_id, 'complete': complete,
+                     'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                     'seconds': seconds, 'finish': finish[task.task_id]})
+    return (plan, sources)
+
+
+def _minutes(seconds):
+    return '{0:.1f} min'.format(seconds / 60.0)
+
+
+def print_plan(plan, sources):
+    row = '{status:<8}  {gb_in:>9}  {gb_out:>9}  {time:>10}  {task}'
+    print row.format(status='status', gb_in='GB in', gb_out='GB out',
+                     time='estimate', task='task')
+    for p in plan:
+        print row.format(
+            status='done' if p['complete'] else 'pending',
+            gb_in='{0:.2f}'.format(p['bytes_in'] / 1e9),
+            gb_out='{0:.2f}'.format(p['bytes_out'] / 1e9),
+            time=_minutes(p['seconds']) if not p['complete'] else '-',
+            task=p['task_id'])
+    pending = [p for p in plan if not p['complete']]
+    print '{0} of {1} tasks to run, moving {2:.2f} GB in and {3:.2f} GB ' \
+        'out'.format(len(pending), len(plan),
+                     sum(p['bytes_in'] for p in pending) / 1e9,
+                     sum(p['bytes_out'] for p in pending) / 1e9)
+    print 'Estimated time: {0} run serially, {1} on the critical ' \
+        'path'.format(_minutes(sum(p['seconds'] for p in pending)),
+                      _minutes(max([p['finish'] for p in plan] or [0])))
+    if sources.unknown:
+        print 'The sizes of {0} sources are unknown and were counted as ' \
+            'zero'.format(sources.unknown)
+
+
+if __name__ == '__main__':
+    # dryrun.py DOWNLOAD_RATE CONVERT_RATE NODES <toaster.py arguments>
+    (download_rate, convert_rate) = map(float, sys.argv[1:3])
+    nodes = int(sys.argv[3])
+    print_plan(*plan_toast(sys.argv[4:], download_rate, convert_rate, nodes))
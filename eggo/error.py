@@ -21,3 +21,41 @@ class EggoError(Exception):
 
 class ConfigError(EggoError):
 	pass
+
+
+class PreflightError(EggoError):
+	pass
+
+
+class ScratchSpaceError(EggoError):
+	pass
+
+
+class HostTimeoutError(EggoError):
+	pass
+
+
+class TransferError(EggoError):
+	def __init__(self, message, transient=False):
+		super(TransferError, self).__init__(message)
+		# whether a later attempt might succeed
+		self.transient = transient
+
+
+class WebHdfsError(EggoError):
+	def __init__(self, message, status=None):
+		super(WebHdfsError, self).__init__(message)
+		# the HTTP status of the failed request, if any
+		self.status = status
+
+
+class AdamSessionError(EggoError):
+	pass
+
+
+class ValidationError(EggoError):
+	pass
+
+
+class CatalogError(EggoError):
+	pass
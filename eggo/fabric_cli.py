@@ -16,22 +16,37 @@
 
 import os
 import json
-from shutil import rmtree
+import time
+from glob import glob
 from getpass import getuser
+from shutil import rmtree
+from tempfile import mkdtemp
+from multiprocessing import cpu_count
 from urlparse import urlparse
 from cStringIO import StringIO
 
 from fabric.api import (
-    task, env, execute, local, open_shell, put, cd, run, prefix, shell_env,
-    require, hosts, path, sudo, lcd)
-from fabric.contrib.files import append, exists
+    task, env, execute, local, open_shell, cd, prefix, shell_env, require,
+    hosts, path, lcd, abort, settings)
+from fabric.contrib.files import append
 from boto.ec2 import connect_to_region
-from boto.s3.connection import S3Connection
 
+import eggo.ssh
+import eggo.catalog
 import eggo.director
+import eggo.planner
+import eggo.register
+import eggo.replicate
+import eggo.scratch
+import eggo.preflight
+import eggo.profiling
 import eggo.spark_ec2
-from eggo.util import build_dest_filename
-from eggo.config import eggo_config, generate_luigi_cfg
+from eggo.dfs import delete_prefix
+from eggo.fleet import fleet_execute
+from eggo.ssh import run, sudo, put, exists
+from eggo.util import build_dest_filename, ensure_dir
+from eggo.config import (
+    eggo_config, generate_luigi_cfg, validate_toast_config, supported_codecs)
 
 
 exec_ctx = eggo_config.get('execution', 'context')
@@ -63,6 +78,13 @@ else:
     wcd = cd
 
 
+# fabric local only returns the command output when capturing it
+def wrun_output(cmd):
+    if exec_ctx == 'local':
+        return local(cmd, capture=True)
+    return wrun(cmd)
+
+
 # set some global Fabric env settings
 if exec_ctx in ['spark_ec2', 'director']:
     # user that fabric connects as
@@ -70,13 +92,51 @@ if exec_ctx in ['spark_ec2', 'director']:
     # ensure fabric uses EC2 private key when connecting
     if not env.key_filename:
         env.key_filename = eggo_config.get('aws', 'ec2_private_key_file')
+    # reuse SSH sessions within and across eggo commands
+    eggo.ssh.configure_fabric()
+
+
+def _hosts_cache_path():
+    return os.path.join(eggo.ssh.state_path(), 'hosts.json')
+
+
+def _cached_hosts(role, lookup):
+    # host lookups hit the EC2 API (and, for spark_ec2 slaves, an SSH hop to
+    # the master), so they are cached for hosts_cache_seconds, or until the
+    # cluster is provisioned or torn down again
+    key = '{0}/{1}/{2}'.format(exec_ctx,
+                               eggo_config.get(exec_ctx, 'stack_name'), role)
+    cache = {}
+    if os.path.exists(_hosts_cache_path()):
+        with open(_hosts_cache_path(), 'r') as ip:
+            cache = json.load(ip)
+    entry = cache.get(key)
+    max_age = eggo_config.getint('client_env', 'hosts_cache_seconds')
+    # (entries of older eggo versions are bare host lists)
+    if not isinstance(entry, dict) or time.time() - entry['time'] > max_age:
+        entry = None
+    # a cached host that cannot be reached may have been replaced
+    if entry is not None and 'failed' in eggo.ssh.open_sessions(
+            entry['hosts']).values():
+        entry = None
+    if entry is None:
+        entry = cache[key] = {'hosts': lookup(), 'time': time.time()}
+        ensure_dir(eggo.ssh.state_path())
+        with open(_hosts_cache_path(), 'w') as op:
+            json.dump(cache, op, indent=2)
+    return entry['hosts']
+
+
+def _clear_hosts_cache():
+    if os.path.exists(_hosts_cache_path()):
+        os.remove(_hosts_cache_path())
 
 
 def get_master_host():
     if exec_ctx == 'spark_ec2':
-        return eggo.spark_ec2.get_master_host()
+        return _cached_hosts('master', eggo.spark_ec2.get_master_host)
     elif exec_ctx == 'director':
-        return eggo.director.get_gateway_host()
+        return _cached_hosts('master', eggo.director.get_gateway_host)
     elif exec_ctx == 'local':
         return 'localhost'
     else:
@@ -86,9 +146,11 @@ def get_master_host():
 
 def get_slave_hosts():
     if exec_ctx == 'spark_ec2':
-        return eggo.spark_ec2.get_slave_hosts()
+        master = get_master_host()
+        return _cached_hosts(
+            'slaves', lambda: eggo.spark_ec2.get_slave_hosts(master=master))
     elif exec_ctx == 'director':
-        return eggo.director.get_worker_hosts()
+        return _cached_hosts('slaves', eggo.director.get_worker_hosts)
     elif exec_ctx == 'local':
         return []
     else:
@@ -100,8 +162,87 @@ def get_worker_hosts():
     return [get_master_host()] + get_slave_hosts()
 
 
+def execute_on_master(func):
+    master = get_master_host()
+    eggo.ssh.open_sessions([master])
+    return execute(func, hosts=master)
+
+
+def _load_registry_files(configs):
+    # configs: ';'-separated paths or glob patterns of registry files
+    filenames = sorted(set(filename for pattern in configs.split(';')
+                           for filename in glob(pattern)))
+    if not filenames:
+        abort('No registry files match {0}'.format(configs))
+    config_datas = []
+    for filename in filenames:
+        with open(filename, 'r') as ip:
+            config_data = json.load(ip)
+        validate_toast_config(config_data)
+        config_datas.append(config_data)
+    return config_datas
+
+
+def _plan_cluster(configs, target_hours, max_nodes, spot):
+    # size from the cached preflights, probing sources that have none; a
+    # "size" field in a registry source is used if a probe cannot tell
+    sizes = []
+    for config_data in _load_registry_files(configs):
+        sidecar = eggo.preflight.preflight(config_data['sources'],
+                                           _local_preflight_path(config_data))
+        probed = eggo.preflight.source_sizes(sidecar)
+        sizes.extend(probed.get(s['url']) or s.get('size') or 0
+                     for s in config_data['sources'])
+    spot_region = (eggo_config.get(exec_ctx, 'region')
+                   if _is_true(spot) and exec_ctx == 'spark_ec2' else None)
+    plans = eggo.planner.plan_cluster(
+        sum(sizes), max(sizes),
+        eggo.planner.load_history(eggo.ssh.state_path()),
+        float(target_hours), int(max_nodes), spot_region=spot_region)
+    eggo.planner.print_plans(plans, sum(sizes))
+    if not plans:
+        abort('No instance type has enough disk for the largest source')
+    return plans[0]
+
+
+@task
+def plan(config, target_hours=4, max_nodes=50, spot='yes'):
+    """Recommend a cluster size for one or more registry files."""
+    best = _plan_cluster(config, target_hours, max_nodes, spot)
+    print 'Recommended: {0} x {1}{2}'.format(
+        best['nodes'], best['instance_type'],
+        ' at a spot bid of {0}'.format(best['spot_price'])
+        if best['spot_price'] is not None else '')
+
+
+def _apply_plan(best):
+    if exec_ctx == 'spark_ec2':
+        eggo_config.set('spark_ec2', 'num_slaves', str(best['nodes']))
+        eggo_config.set('spark_ec2', 'instance_type', best['instance_type'])
+        eggo_config.set('spark_ec2', 'spot_price',
+                        str(best['spot_price'] or ''))
+    elif exec_ctx == 'director':
+        # the worker instance type is set in the Director conf template
+        eggo_config.set('director', 'num_workers', str(best['nodes']))
+        eggo.director.NUM_WORKERS = str(best['nodes'])
+
+
+def _cluster_size():
+    # (instance type, number of worker nodes) of the current cluster
+    if exec_ctx == 'spark_ec2':
+        return (eggo_config.get('spark_ec2', 'instance_type'),
+                len(get_slave_hosts()))
+    elif exec_ctx == 'director':
+        return ('director', len(get_slave_hosts()))
+    return (exec_ctx, 1)
+
+
 @task
-def provision():
+def provision(plan=None, target_hours=4, max_nodes=50, spot='yes'):
+    """Provision a cluster, optionally sized for the given registry files."""
+    if plan is not None:
+        _apply_plan(_plan_cluster(plan, target_hours, max_nodes, spot))
+    _clear_hosts_cache()
     if exec_ctx == 'spark_ec2':
         eggo.spark_ec2.provision()
     elif exec_ctx == 'director':
@@ -131,8 +272,10 @@ def provision():
 @task
 def deploy_config():
     def do():
-        # 0. ensure that the work path exists on the worker nodes
+        # 0. ensure that the work and scratch paths exist on the worker nodes
         wrun('mkdir -p -m 777 {work_path}'.format(work_path=work_path))
+        for scratch_path in eggo.scratch.scratch_paths():
+            wrun('mkdir -p -m 777 {0}'.format(scratch_path))
 
         # 1. copy local eggo config file to remote cluster
         put(local_path=os.environ['EGGO_CONFIG'],
@@ -143,7 +286,7 @@ def deploy_config():
         put(local_path=buf,
             remote_path=luigi_config_path)
 
-    execute(do, hosts=get_worker_hosts())
+    fleet_execute(do, get_worker_hosts())
 
 
 def install_pypa():
@@ -234,7 +377,7 @@ def setup_master():
             wrun('/root/ephemeral-hdfs/bin/stop-all.sh')
             wrun('/root/ephemeral-hdfs/bin/start-all.sh')
 
-    execute(do, hosts=get_master_host())
+    execute_on_master(do)
 
 
 @task
@@ -244,13 +387,12 @@ def print_worker_env():
         wrun('javac -version')
         wrun('mvn -version')
 
-    execute(do, hosts=get_master_host())
+    execute_on_master(do)
 
 
 @task
 def setup_slaves():
     def do():
-        env.parallel = True
         if exec_ctx == 'director':
             install_git()
         install_pypa()
@@ -258,11 +400,59 @@ def setup_slaves():
         install_eggo(work_path, eggo_home, eggo_fork, eggo_branch)
 
     if exec_ctx in ['director', 'spark_ec2']:
-        execute(do, hosts=get_slave_hosts())
+        fleet_execute(do, get_slave_hosts())
+
+
+@task
+def list_datasets():
+    """List the toasted datasets and their editions."""
+    eggo.catalog.print_catalog(eggo.catalog.load_catalog())
+
+
+@task(name='info')
+def dataset_info(dataset):
+    """Print the catalog entry of a toasted dataset."""
+    catalog = eggo.catalog.load_catalog()
+    if dataset not in catalog['datasets']:
+        abort('Dataset {0} not found in {1}'.format(
+            dataset, eggo.catalog.catalog_url()))
+    eggo.catalog.print_dataset(catalog, dataset)
+
+
+@task
+def get(dataset, destination, editions=None, verify='size', max_workers=32):
+    """Copy a toasted dataset to a local cluster (an hdfs:// or file:// url).
+
+    editions is a ;-separated list of edition names (default: all).
+    """
+    stats = eggo.replicate.replicate(
+        dataset, destination,
+        editions=editions.split(';') if editions else None, verify=verify,
+        max_workers=int(max_workers))
+    if stats.errors:
+        abort('{0} files failed to copy; run eggo get again to '
+              'resume'.format(stats.errors))
 
 
 @task
-def list():
+def register(config, output=None, dialect='hive', database=None):
+    """Generate the DDL that registers the editions of a toasted dataset."""
+    if dialect not in eggo.register.dialects:
+        abort('Unknown dialect {0}; use one of {1}'.format(
+            dialect, ', '.join(eggo.register.dialects)))
+    with open(config, 'r') as ip:
+        config_data = json.load(ip)
+    ddl = eggo.register.format_ddl(eggo.register.dataset_ddl(
+        config_data, dialect=dialect, database=database))
+    if output is None:
+        print ddl
+    else:
+        with open(output, 'w') as op:
+            op.write(ddl)
+
+
+@task(name='list')
+def list_instances():
     if exec_ctx == 'director':
         eggo.director.list()
     else:
@@ -272,134 +462,362 @@ def list():
 
 @task
 def login():
-    execute(open_shell, hosts=get_master_host())
+    execute_on_master(open_shell)
 
 
 @task
 def teardown():
+    eggo.ssh.close_sessions()
     if exec_ctx == 'spark_ec2':
         eggo.spark_ec2.teardown()
     elif exec_ctx == 'director':
         eggo.director.teardown()
+    _clear_hosts_cache()
 
 
 @task
-def toast(config):
-    def do():
-        with open(config, 'r') as ip:
-            config_data = json.load(ip)
-        dag_class = config_data['dag']
-        # push the toast config to the remote machine
-        toast_config_worker_path = os.path.join(
-            eggo_config.get('worker_env', 'work_path'),
-            build_dest_filename(config))
-        put(local_path=config,
-            remote_path=toast_config_worker_path)
-        # TODO: run on central scheduler instead
-        toast_cmd = ('toaster.py --local-scheduler {clazz} '
-                     '--ToastConfig-config {toast_config}'.format(
-                        clazz=dag_class,
-                        toast_config=toast_config_worker_path))
-        
-        hadoop_bin = os.path.join(eggo_config.get('worker_env', 'hadoop_home'), 'bin')
-        toast_env = {'EGGO_HOME': eggo_config.get('worker_env', 'eggo_home'),  # toaster.py imports eggo_config, which needs EGGO_HOME on worker
-                     'EGGO_CONFIG': eggo_config.get('worker_env', 'eggo_config_path'),  # bc toaster.py imports eggo_config which must be init on the worker
-                     'LUIGI_CONFIG_PATH': eggo_config.get('worker_env', 'luigi_config_path'),
-                     'AWS_ACCESS_KEY_ID': eggo_config.get('aws', 'aws_access_key_id'),  # bc dataset dnload pushes data to S3 TODO: should only be added if the dfs is S3
-                     'AWS_SECRET_ACCESS_KEY': eggo_config.get('aws', 'aws_secret_access_key'),  # TODO: should only be added if the dfs is S3
-                     'SPARK_HOME': eggo_config.get('worker_env', 'spark_home')}
-        if exec_ctx == 'local':
-                # this should copy vars that maintain venv info
-                env_copy = os.environ.copy()
-                env_copy.update(toast_env)
-                toast_env = env_copy
-        with path(hadoop_bin):
-            with shell_env(**toast_env):
-                wrun(toast_cmd)
-    
-    execute(do, hosts=get_master_host())
+def refresh_hosts():
+    """Look up the cluster's host names again instead of using the cached
+    ones."""
+    _clear_hosts_cache()
+    print 'master: {0}'.format(get_master_host())
+    print 'slaves: {0}'.format(', '.join(get_slave_hosts()))
+
+
+@task
+def ssh_sessions():
+    """Print SSH session reuse statistics for the cluster hosts."""
+    eggo.ssh.print_session_stats()
+
+
+@task
+def close_ssh_sessions():
+    eggo.ssh.close_sessions()
+
+
+def _local_preflight_path(config_data):
+    return eggo.preflight.sidecar_path(
+        os.path.join(eggo.ssh.state_path(), 'preflight'), config_data)
 
 
 @task
-def delete_raw(config):
+def preflight(config, threads=32):
+    """Validate a toast config and probe all of its sources."""
     with open(config, 'r') as ip:
         config_data = json.load(ip)
-    url = os.path.join(eggo_config.get('dfs', 'dfs_raw_data_url'),
-                       config_data['name'])
-    url = urlparse(url)
-    if url.scheme == 's3n':
-        conn = S3Connection()
-        bucket = conn.get_bucket(url.netloc)
-        keys = bucket.list(url.path.lstrip('/'))
-        bucket.delete_keys(keys)
-    elif url.scheme == 'file':
-        # TODO: this assumes that file:// is in local mode
-        rmtree(url.path, ignore_errors=True)
-    else:
-        raise NotImplementedError(
-            "{0} dfs scheme not supported".format(url.scheme))
+    validate_toast_config(config_data)
+    sidecar = eggo.preflight.preflight(config_data['sources'],
+                                       _local_preflight_path(config_data),
+                                       threads=int(threads))
+    eggo.preflight.print_preflight(sidecar)
+    if eggo.preflight.failed_sources(sidecar):
+        abort('Preflight failed for {0}'.format(config))
 
 
 @task
-def delete_tmp(config):
+def toast(config, progress='no', profile='no'):
+    # profile=yes (or a run name) profiles the DAG's tasks; see
+    # eggo.profiling and profile_report
+    profile_run = None
+    if _is_true(profile):
+        with open(config, 'r') as ip:
+            profile_run = '{0}-{1}'.format(json.load(ip)['name'],
+                                           time.strftime('%Y%m%d-%H%M%S'))
+    elif profile.lower() not in ['no', 'false', 'n', '0']:
+        profile_run = profile
+    if profile_run is not None:
+        print 'Profiling the toast as run {0}'.format(profile_run)
+
+    def do():
+        # TODO: run on central scheduler instead
+        toast_cmd = 'toaster.py --local-scheduler ' + _push_toast_config(config)
+        if profile_run is not None:
+            toast_cmd = '{0}={1} {2}'.format(eggo.profiling.PROFILE_ENV,
+                                             profile_run, toast_cmd)
+        if _is_true(progress):
+            # tail the transfers of the scheduler host while the toast runs
+            toast_cmd = ('{0} & pid=$!; python -m eggo.progress $pid; '
+                         'wait $pid'.format(toast_cmd))
+        run_with_worker_env(toast_cmd)
+
+    execute_on_master(do)
+
+    # remember how fast this cluster was, for eggo plan
+    if exec_ctx in ['spark_ec2', 'director']:
+        with open(config, 'r') as ip:
+            name = json.load(ip)['name']
+        dataset = eggo.catalog.load_catalog()['datasets'].get(name, {})
+        (instance_type, nodes) = _cluster_size()
+        eggo.planner.record_runs(eggo.ssh.state_path(), name,
+                                 dataset.get('stages', {}), instance_type,
+                                 nodes)
+
+
+def _push_toast_config(config):
+    # push the toast config, and a cached preflight sidecar (if any) so the
+    # DAG can skip probing, to the remote machine; returns the toaster.py
+    # arguments that run the toast
     with open(config, 'r') as ip:
         config_data = json.load(ip)
-    url = os.path.join(eggo_config.get('dfs', 'dfs_tmp_data_url'),
-                       config_data['name'])
-    url = urlparse(url)
-    if url.scheme == 's3n':
-        conn = S3Connection()
-        bucket = conn.get_bucket(url.netloc)
-        keys = bucket.list(url.path.lstrip('/'))
-        bucket.delete_keys(keys)
-    elif url.scheme == 'file':
-        rmtree(url.path, ignore_errors=True)
-    else:
-        raise NotImplementedError(
-            "{0} dfs scheme not supported".format(url.scheme))
+    toast_config_worker_path = os.path.join(
+        eggo_config.get('worker_env', 'work_path'),
+        build_dest_filename(config))
+    put(local_path=config,
+        remote_path=toast_config_worker_path)
+    local_sidecar = _local_preflight_path(config_data)
+    if os.path.exists(local_sidecar):
+        worker_preflight_dir = os.path.join(
+            eggo_config.get('worker_env', 'work_path'), 'preflight')
+        wrun('mkdir -p {0}'.format(worker_preflight_dir))
+        put(local_path=local_sidecar,
+            remote_path=eggo.preflight.sidecar_path(worker_preflight_dir,
+                                                    config_data))
+    return '{clazz} --ToastConfig-config {toast_config}'.format(
+        clazz=config_data['dag'], toast_config=toast_config_worker_path)
 
 
 @task
-def delete_toasted(config):
+def dry_run(config):
+    """Show which tasks of a toast would run, and estimate their cost."""
     with open(config, 'r') as ip:
         config_data = json.load(ip)
-    url = os.path.join(eggo_config.get('dfs', 'dfs_root_url'),
+    # probe the sources (or reuse a cached probe) for their sizes
+    eggo.preflight.preflight(config_data['sources'],
+                             _local_preflight_path(config_data))
+    (instance_type, nodes) = _cluster_size()
+    (download_rate, convert_rate) = eggo.planner.node_rates(
+        eggo.planner.load_history(eggo.ssh.state_path()), instance_type,
+        vcpus=cpu_count() if exec_ctx == 'local' else None)
+
+    def do():
+        run_with_worker_env('python -m eggo.dryrun {0} {1} {2} {3}'.format(
+            download_rate, convert_rate, nodes, _push_toast_config(config)))
+
+    execute_on_master(do)
+
+
+def run_with_worker_env(cmd, capture=False):
+    hadoop_bin = os.path.join(eggo_config.get('worker_env', 'hadoop_home'), 'bin')
+    worker_env = {'EGGO_HOME': eggo_config.get('worker_env', 'eggo_home'),  # toaster.py imports eggo_config, which needs EGGO_HOME on worker
+                  'EGGO_CONFIG': eggo_config.get('worker_env', 'eggo_config_path'),  # bc toaster.py imports eggo_config which must be init on the worker
+                  'LUIGI_CONFIG_PATH': eggo_config.get('worker_env', 'luigi_config_path'),
+                  'AWS_ACCESS_KEY_ID': eggo_config.get('aws', 'aws_access_key_id'),  # bc dataset dnload pushes data to S3 TODO: should only be added if the dfs is S3
+                  'AWS_SECRET_ACCESS_KEY': eggo_config.get('aws', 'aws_secret_access_key'),  # TODO: should only be added if the dfs is S3
+                  'SPARK_HOME': eggo_config.get('worker_env', 'spark_home')}
+    if exec_ctx == 'local':
+            # this should copy vars that maintain venv info
+            env_copy = os.environ.copy()
+            env_copy.update(worker_env)
+            worker_env = env_copy
+    with path(hadoop_bin):
+        with shell_env(**worker_env):
+            if capture:
+                return wrun_output(cmd)
+            wrun(cmd)
+
+
+@task
+def scratch_usage():
+    """Show the usage of the scratch disks of every worker."""
+    def do():
+        run_with_worker_env('python -m eggo.scratch')
+
+    fleet_execute(do, get_worker_hosts())
+
+
+@task
+def progress():
+    """Show the progress of the transfers on every worker."""
+    def do():
+        run_with_worker_env('python -m eggo.progress')
+
+    fleet_execute(do, get_worker_hosts())
+
+
+@task
+def profile_report(run='default'):
+    """Merge the profiles of a profiled toast from every worker into one
+    report of where its time went."""
+    def do():
+        return run_with_worker_env(
+            'python -m eggo.profiling --export {0}'.format(run), capture=True)
+
+    results = fleet_execute(do, get_worker_hosts())
+    eggo.profiling.print_report(eggo.profiling.merge_exports(
+        # the export is the last line of output (after any warnings)
+        [json.loads(r.value.splitlines()[-1])
+         for r in results.itervalues()]))
+
+
+@task
+def benchmark_codecs(codecs=','.join(supported_codecs)):
+    """Compare the size, write and scan time of Parquet codecs."""
+    def do():
+        run_with_worker_env('python -m eggo.benchmark {0}'.format(
+            ' '.join(codecs.split(','))))
+
+    execute_on_master(do)
+
+
+def _is_true(value):
+    # fabric passes task arguments as strings
+    return str(value).lower() in ['true', 'yes', 'y', '1']
+
+
+def _delete_dataset_data(config, url_option, dry_run):
+    with open(config, 'r') as ip:
+        config_data = json.load(ip)
+    url = os.path.join(eggo_config.get('dfs', url_option),
                        config_data['name'])
-    url = urlparse(url)
-    if url.scheme == 's3n':
-        conn = S3Connection()
-        bucket = conn.get_bucket(url.netloc)
-        keys = bucket.list(url.path.lstrip('/'))
-        bucket.delete_keys(keys)
-    elif url.scheme == 'file':
-        rmtree(url.path, ignore_errors=True)
-    else:
-        raise NotImplementedError(
-            "{0} dfs scheme not supported".format(url.scheme))
+    # TODO: file:// urls assume that file:// is in local mode
+    delete_prefix(url, dry_run=_is_true(dry_run))
+
+
+@task
+def delete_raw(config, dry_run=False):
+    _delete_dataset_data(config, 'dfs_raw_data_url', dry_run)
+
+
+@task
+def delete_tmp(config, dry_run=False):
+    _delete_dataset_data(config, 'dfs_tmp_data_url', dry_run)
 
 
 @task
-def delete_all(config):
-    delete_tmp(config)
-    delete_raw(config)
-    delete_toasted(config)
+def delete_toasted(config, dry_run=False):
+    _delete_dataset_data(config, 'dfs_root_url', dry_run)
+    if not _is_true(dry_run):
+        with open(config, 'r') as ip:
+            eggo.catalog.remove_dataset(json.load(ip)['name'])
+
+
+@task
+def delete_all(config, dry_run=False):
+    delete_tmp(config, dry_run)
+    delete_raw(config, dry_run)
+    delete_toasted(config, dry_run)
+
+
+# paths whose contents end up in the pip-installed eggo package (see setup.py
+# and MANIFEST.in); changes anywhere else do not require a reinstall
+eggo_package_paths = ['setup.py', 'MANIFEST.in', 'README.md', 'LICENSE.txt',
+                      'eggo', 'bin', 'registry', 'test/registry']
+
+
+# the ref, in the client's eggo checkout ($EGGO_HOME) and in the bundles, of
+# the commit the workers are updated to
+eggo_update_ref = 'refs/eggo/update'
+
+
+def fetch_eggo_commit(fork, branch):
+    """Fetch the branch into the client's eggo checkout and return its
+    commit; the workers then get it from the client instead of GitHub."""
+    with lcd(os.environ['EGGO_HOME']):
+        local('git fetch -q https://github.com/{0}/eggo.git '
+              '+refs/heads/{1}:{2}'.format(fork, branch, eggo_update_ref))
+        return local('git rev-parse {0}'.format(eggo_update_ref),
+                     capture=True).strip()
+
+
+def eggo_package_hash(rev):
+    return wrun_output('git ls-tree -r {rev} -- {paths} | md5sum'.format(
+        rev=rev, paths=' '.join(eggo_package_paths))).split()[0]
+
+
+def eggo_worker_commit(eggo_home):
+    """The commit checked out in eggo_home on the worker, or None."""
+    if not exists(os.path.join(eggo_home, '.git')):
+        return None
+    with wcd(eggo_home):
+        return wrun_output('git rev-parse HEAD').strip()
+
+
+def build_eggo_bundle(old_commit, bundle_dir):
+    """Write a git bundle of eggo_update_ref to bundle_dir, holding only the
+    objects that a checkout of old_commit does not have (or all of them, if
+    old_commit is None or unknown to the client); returns its path."""
+    path = os.path.join(bundle_dir, '{0}.bundle'.format(
+        old_commit or 'full'))
+    with lcd(os.environ['EGGO_HOME']):
+        known = False
+        if old_commit is not None:
+            with settings(warn_only=True):
+                known = local('git cat-file -e {0}^{{commit}}'.format(
+                    old_commit), capture=True).succeeded
+        local('git bundle create {0} {1}{2}'.format(
+            path, eggo_update_ref, ' ^' + old_commit if known else ''),
+            capture=True)
+    return path
+
+
+def update_eggo_from_bundle(eggo_home, bundle, old_commit, commit):
+    remote_bundle = os.path.join(os.path.dirname(eggo_home),
+                                 'eggo-update.bundle')
+    if old_commit is None:
+        wrun('mkdir -p {0}'.format(eggo_home))
+    # in the local exec ctx, eggo_home is the user's own checkout, which is
+    # never forced over
+    owned = exec_ctx != 'local'
+    if not owned and old_commit is not None:
+        with wcd(eggo_home):
+            if wrun_output('git status --porcelain').strip():
+                abort('{0} has uncommitted changes; commit or stash them '
+                      'before updating eggo'.format(eggo_home))
+    put(local_path=bundle, remote_path=remote_bundle)
+    with wcd(eggo_home):
+        if old_commit is None:
+            wrun('git init -q')
+        else:
+            old_hash = eggo_package_hash('HEAD')
+        wrun('git fetch -q {0} {1}'.format(remote_bundle, eggo_update_ref))
+        wrun('rm -f {0}'.format(remote_bundle))
+        if old_commit is not None:
+            diffstat = wrun_output('git diff --shortstat {0} {1}'.format(
+                old_commit, commit)).strip()
+        wrun('git checkout -q {0}{1}'.format('-f ' if owned else '', commit))
+        reinstall = (old_commit is None or
+                     eggo_package_hash('HEAD') != old_hash)
+        if reinstall:
+            wrun('pip install .')
+    if old_commit is None:
+        return 'installed {0}'.format(commit[:8])
+    return '{old}..{new}: {diffstat}; {action}'.format(
+        old=old_commit[:8], new=commit[:8], diffstat=diffstat or 'no changes',
+        action='reinstalled' if reinstall else 'package unchanged')
 
 
 @task
 def update_eggo():
-    work_path = eggo_config.get('worker_env', 'work_path')
-    venv_path = eggo_config.get('worker_env', 'venv_path')
     eggo_fork = eggo_config.get('versions', 'eggo_fork')
     eggo_branch = eggo_config.get('versions', 'eggo_branch')
     eggo_home = eggo_config.get('worker_env', 'eggo_home')
-
-    def do():
-        env.parallel = True
-        if exec_ctx in ['director', 'spark_ec2']:
-            wrun('rm -rf {0}'.format(eggo_home))
-        install_eggo(work_path, eggo_home, eggo_fork, eggo_branch)
-
-    execute(do, hosts=get_worker_hosts())
+    # resolve and fetch the branch once, on the client, so all workers end up
+    # on the same commit without fetching from GitHub themselves
+    commit = fetch_eggo_commit(eggo_fork, eggo_branch)
+
+    workers = get_worker_hosts()
+    old_commits = dict(
+        (host, r.value) for (host, r) in fleet_execute(
+            lambda: eggo_worker_commit(eggo_home), workers).iteritems())
+    stale = [host for host in workers if old_commits[host] != commit]
+
+    # a bundle per distinct old commit, built once on the client
+    bundle_dir = mkdtemp(prefix='tmp_eggo_')
+    try:
+        bundles = dict((old_commit, build_eggo_bundle(old_commit, bundle_dir))
+                       for old_commit in set(old_commits[h] for h in stale))
+
+        def do():
+            old_commit = old_commits[env.host_string]
+            return update_eggo_from_bundle(eggo_home, bundles[old_commit],
+                                           old_commit, commit)
+
+        results = fleet_execute(do, stale)
+    finally:
+        rmtree(bundle_dir, ignore_errors=True)
+    for host in sorted(workers):
+        print '{0}: {1}'.format(host, results[host].value if host in results
+                                else 'unchanged at {0}'.format(commit[:8]))
 
 
 # Director commands (experimental)
@@ -0,0 +1,136 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copying files between local (or mounted) paths with the least work.
+
+copy_file() tries, in order, the cheapest copy that the two filesystems
+support: a hard link (only if asked for); a reflink (FICLONE), which shares
+the source's blocks copy-on-write; copy_file_range(2), which the kernel (or
+an NFS 4.2 or SMB server) copies without passing the data through user
+space, and which some filesystems turn into a reflink; sendfile(2); and
+finally read and write.  Python 2 has none of these calls, so the system
+calls are made through ctypes.
+"""
+
+import os
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+
+
+# the ioctl request of FICLONE, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# bytes per kernel copy call, i.e. between progress updates
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# errors that mean a method does not apply to these two files, so that the
+# next one should be tried
+_UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                    errno.EOPNOTSUPP, errno.EBADF, errno.EPERM])
+
+# errors of os.link that a copy gets around
+_UNLINKABLE = set([errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK,
+                   errno.ENOTSUP])
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def _libc_function(name, argtypes):
+    function = getattr(_libc, name, None)
+    if function is not None:
+        function.argtypes = argtypes
+        function.restype = ctypes.c_ssize_t
+    return function
+
+
+# copy_file_range(fd_in, off_in, fd_out, off_out, len, flags) needs glibc
+# 2.27; with null offsets, both files' own offsets are used and advanced
+_copy_file_range = _libc_function(
+    'copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+
+# sendfile(out_fd, in_fd, offset, count)
+_sendfile = _libc_function(
+    'sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                 ctypes.c_size_t])
+
+
+def _kernel_copy(call, add):
+    # copy the rest of the input with call(count), which returns the bytes
+    # copied (0 at the end) or -1; False if the call does not apply
+    while True:
+        copied = call(CHUNK_SIZE)
+        if copied < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if error in _UNSUPPORTED:
+                # anything copied so far stays; the next method resumes from
+                # the files' offsets
+                return False
+            raise OSError(error, os.strerror(error))
+        if copied == 0:
+            return True
+        add(copied)
+
+
+def copy_file(src, dst, progress=None, link=False):
+    """Copy the file at src to dst (both local paths), calling
+    progress.add() (e.g. of an eggo.progress.Progress) with the bytes
+    copied; with link, dst may be a hard link to src.
+
+    Returns the method used: hardlink, reflink, copy_file_range, sendfile or
+    read/write.
+    """
+    add = progress.add if progress is not None else lambda n: None
+    if link:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in _UNLINKABLE:
+                raise
+        else:
+            add(os.path.getsize(src))
+            return 'hardlink'
+    with open(src, 'rb') as ip:
+        with open(dst, 'wb') as op:
+            (in_fd, out_fd) = (ip.fileno(), op.fileno())
+            try:
+                fcntl.ioctl(out_fd, FICLONE, in_fd)
+            except IOError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+            else:
+                add(os.fstat(in_fd).st_size)
+                return 'reflink'
+            if _copy_file_range is not None and _kernel_copy(
+                    lambda n: _copy_file_range(in_fd, None, out_fd, None, n,
+                                               0), add):
+                return 'copy_file_range'
+            if _sendfile is not None and _kernel_copy(
+                    lambda n: _sendfile(out_fd, in_fd, None, n), add):
+                return 'sendfile'
+            # on the descriptors, which the kernel copies may have advanced
+            for chunk in iter(lambda: os.read(in_fd, 1024 * 1024), ''):
+                while chunk:
+                    written = os.write(out_fd, chunk)
+                    add(written)
+                    chunk = chunk[written:]
+            return 'read/write'
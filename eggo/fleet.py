@@ -0,0 +1,111 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run Fabric functions across many hosts with bounded parallelism."""
+
+import time
+import signal
+from collections import namedtuple
+
+from fabric.api import env, execute, parallel, abort
+
+from eggo.config import eggo_config
+from eggo.error import HostTimeoutError
+from eggo.ssh import open_sessions
+
+
+# must be defined at module level so that it can be pickled back from the
+# Fabric worker processes
+HostResult = namedtuple('HostResult', ['host', 'status', 'duration', 'value',
+                                       'error'])
+
+
+def fleet_pool_size():
+    return eggo_config.getint('execution', 'fleet_pool_size')
+
+
+def fleet_host_timeout():
+    timeout = eggo_config.get('execution', 'fleet_host_timeout')
+    return int(timeout) if timeout != '' else None
+
+
+def _deadline_passed(timeout):
+    raise HostTimeoutError('Did not finish within {0} seconds'.format(
+        timeout))
+
+
+def _run_on_host(func, timeout, *args, **kwargs):
+    # each host runs in its own Fabric worker process, so SIGALRM bounds the
+    # whole of func on this host, however many commands it runs
+    start = time.time()
+    handler = signal.signal(signal.SIGALRM,
+                            lambda signum, frame: _deadline_passed(timeout))
+    try:
+        if timeout:
+            signal.alarm(timeout)
+        try:
+            value = func(*args, **kwargs)
+        finally:
+            signal.alarm(0)
+    except (Exception, SystemExit) as e:
+        # Fabric aborts by raising SystemExit; catch it too so that a single
+        # bad host is recorded instead of killing the whole fleet
+        return HostResult(env.host_string, 'failed', time.time() - start,
+                          None, '{0}: {1}'.format(type(e).__name__, e))
+    finally:
+        signal.signal(signal.SIGALRM, handler)
+    return HostResult(env.host_string, 'ok', time.time() - start, value, None)
+
+
+def print_fleet_results(results):
+    width = max([len('host')] + [len(h) for h in results])
+    row = '{host:<{width}}  {status:<6}  {duration:>9}  {error}'
+    print row.format(host='host', width=width, status='status',
+                     duration='duration', error='error')
+    for host in sorted(results):
+        r = results[host]
+        print row.format(host=host, width=width, status=r.status,
+                         duration='{0:.1f}s'.format(r.duration),
+                         error=r.error or '')
+
+
+def fleet_execute(func, hosts, *args, **kwargs):
+    """Run func on every host in hosts, at most fleet_pool_size at a time.
+
+    A failure on one host does not stop func from running on the others; a
+    host on which func runs for longer than timeout seconds (by default
+    fleet_host_timeout) fails.
+    Once every host has finished, a per-host table of status and duration is
+    printed, and the task is aborted if any host failed.  Returns a dict
+    mapping each host to its HostResult.
+    """
+    pool_size = kwargs.pop('pool_size', None) or fleet_pool_size()
+    timeout = kwargs.pop('timeout', None) or fleet_host_timeout()
+    if not hosts:
+        return {}
+    open_sessions(hosts)
+
+    @parallel(pool_size=pool_size)
+    def do(*args, **kwargs):
+        return _run_on_host(func, timeout, *args, **kwargs)
+
+    results = execute(do, hosts=hosts, *args, **kwargs)
+    print_fleet_results(results)
+    failed = [h for (h, r) in results.iteritems() if r.status != 'ok']
+    if failed:
+        abort('{0} of {1} hosts failed: {2}'.format(
+            len(failed), len(results), ', '.join(sorted(failed))))
+    return results
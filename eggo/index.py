@@ -0,0 +1,167 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A per-edition summary of the Parquet footers, for file-level pruning.
+
+After an edition is committed, the toast DAG writes INDEX_FILENAME into its
+directory: for each part file, its row count, size, and the min/max of the
+key columns (contig, start and end) from its row group statistics.  Readers
+load that one small file instead of every footer, and overlapping() returns
+only the part files that can hold records in a region.  The leading
+underscore keeps Hadoop input formats from reading the index as data.
+
+    from eggo.index import overlapping
+    urls = overlapping(edition_url, '22:16000000-17000000')
+"""
+
+import os
+import json
+
+from eggo.dfs import list_files, read_file, write_file
+from eggo.parquet import (
+    read_footers, num_rows, row_groups, decode_statistic, ROW_GROUP_COLUMNS,
+    COLUMN_META_DATA, COLUMN_TYPE, COLUMN_PATH_IN_SCHEMA, COLUMN_STATISTICS,
+    STATISTICS_MIN, STATISTICS_MAX, STATISTICS_MIN_VALUE,
+    STATISTICS_MAX_VALUE, BYTE_ARRAY)
+from eggo.regions import parse_region
+
+
+INDEX_FILENAME = '_eggo_index.json'
+
+INDEX_VERSION = 1
+
+# key -> column names that hold it; nested (basic) and flattened (flat)
+# editions are matched on the last part of the column path, e.g.
+# variant.contig.contigName or variant__contig__contigName
+KEY_COLUMNS = {'contig': ['contigName', 'referenceName'],
+               'start': ['start'],
+               'end': ['end']}
+
+
+def _column_name(path):
+    return path[-1].split('__')[-1]
+
+
+def _key_paths(footer):
+    # key -> the shortest column path (e.g. the variant's start rather than
+    # that of a nested annotation) that holds it
+    paths = {}
+    for rg in row_groups(footer)[:1]:
+        for chunk in rg.get(ROW_GROUP_COLUMNS, []):
+            path = tuple(chunk.get(COLUMN_META_DATA, {}).get(
+                COLUMN_PATH_IN_SCHEMA, []))
+            for (key, names) in KEY_COLUMNS.iteritems():
+                if path and _column_name(path) in names and (
+                        key not in paths or len(path) < len(paths[key])):
+                    paths[key] = path
+    return paths
+
+
+def _decode(type_, value):
+    return value if type_ == BYTE_ARRAY else decode_statistic(type_, value)
+
+
+def _key_ranges(footer, paths):
+    # key -> [min, max] over all row groups, or no entry if any row group
+    # lacks the statistic
+    lows = {}
+    highs = {}
+    missing = set()
+    by_path = dict((path, key) for (key, path) in paths.iteritems())
+    for rg in row_groups(footer):
+        for chunk in rg.get(ROW_GROUP_COLUMNS, []):
+            column = chunk.get(COLUMN_META_DATA, {})
+            key = by_path.get(tuple(column.get(COLUMN_PATH_IN_SCHEMA, [])))
+            if key is None:
+                continue
+            s = column.get(COLUMN_STATISTICS, {})
+            low = s.get(STATISTICS_MIN_VALUE, s.get(STATISTICS_MIN))
+            high = s.get(STATISTICS_MAX_VALUE, s.get(STATISTICS_MAX))
+            if low is None or high is None:
+                missing.add(key)
+                continue
+            low = _decode(column.get(COLUMN_TYPE), low)
+            high = _decode(column.get(COLUMN_TYPE), high)
+            lows[key] = min(lows.get(key, low), low)
+            highs[key] = max(highs.get(key, high), high)
+    return dict((key, [lows[key], highs[key]]) for key in lows
+                if key not in missing)
+
+
+def build_index(url, hadoop_bin='hadoop'):
+    """Summarize the footers of the part files under url (in parallel)."""
+    files = list_files(url, hadoop_bin=hadoop_bin)
+    sizes = dict(files)
+    footers = read_footers(url, files)
+    entries = []
+    for name in sorted(footers):
+        footer = footers[name]
+        entries.append({'name': name, 'rows': num_rows(footer),
+                        'bytes': sizes[name],
+                        'keys': _key_ranges(footer, _key_paths(footer))})
+    return {'version': INDEX_VERSION, 'files': entries}
+
+
+def write_index(url, hadoop_bin='hadoop'):
+    """Write the index of the edition at url into its directory."""
+    write_file(os.path.join(url, INDEX_FILENAME),
+               json.dumps(build_index(url, hadoop_bin)),
+               hadoop_bin=hadoop_bin)
+
+
+def load_index(url, hadoop_bin='hadoop'):
+    """The index of the edition at url, or None if it has none."""
+    data = read_file(os.path.join(url, INDEX_FILENAME), hadoop_bin=hadoop_bin)
+    if data is None:
+        return None
+    index = json.loads(data)
+    return index if index.get('version') == INDEX_VERSION else None
+
+
+def _may_overlap(keys, name, beg, end):
+    # whether a file with these key ranges can hold records on contig name
+    # in [beg, end); a missing range cannot rule anything out
+    if 'contig' not in keys:
+        # positions on different contigs could be mixed in the ranges
+        return True
+    (low, high) = keys['contig']
+    if not low <= name <= high:
+        return False
+    if low != high:
+        return True
+    if 'start' in keys and keys['start'][0] >= end:
+        return False
+    # ends are exclusive; without them, a record that starts before beg may
+    # still reach into the region
+    if 'end' in keys and keys['end'][1] <= beg:
+        return False
+    return True
+
+
+def overlapping(url, region, hadoop_bin='hadoop'):
+    """The urls of the part files of the edition at url that may hold
+    records in region (e.g. '22' or '22:16000000-17000000').
+
+    Without an index, every part file is returned.
+    """
+    index = load_index(url, hadoop_bin)
+    if index is None:
+        return [os.path.join(url, name) for (name, _) in
+                sorted(list_files(url, hadoop_bin=hadoop_bin))
+                if name.endswith('.parquet')]
+    (name, beg, end) = parse_region(region)
+    return [os.path.join(url, f['name']) for f in index['files']
+            if _may_overlap(f['keys'], name, beg, end)]
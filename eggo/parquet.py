@@ -0,0 +1,271 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal reader for Parquet file footers.
+
+A Parquet file ends with a Thrift-serialized (compact protocol) FileMetaData
+struct, a 4-byte little-endian footer length, and the magic bytes PAR1.  This
+module decodes that struct generically (into dicts keyed by Thrift field id),
+which avoids a dependency on a Parquet or Thrift library.  See parquet.thrift
+in the parquet-format project for the field ids.
+"""
+
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+
+from eggo.dfs import read_tail
+
+
+MAGIC = 'PAR1'
+
+# how many bytes to read from the end of a file to (usually) get its footer
+FOOTER_READ_SIZE = 64 * 1024
+
+# FileMetaData fields
+FILE_SCHEMA = 2
+FILE_NUM_ROWS = 3
+FILE_ROW_GROUPS = 4
+
+# RowGroup fields
+ROW_GROUP_COLUMNS = 1
+ROW_GROUP_TOTAL_BYTE_SIZE = 2
+ROW_GROUP_NUM_ROWS = 3
+
+# SchemaElement fields
+SCHEMA_TYPE = 1
+SCHEMA_REPETITION_TYPE = 3
+SCHEMA_NAME = 4
+SCHEMA_NUM_CHILDREN = 5
+SCHEMA_CONVERTED_TYPE = 6
+SCHEMA_SCALE = 7
+SCHEMA_PRECISION = 8
+
+# ColumnChunk/ColumnMetaData fields
+COLUMN_META_DATA = 3
+COLUMN_TYPE = 1
+COLUMN_PATH_IN_SCHEMA = 3
+COLUMN_CODEC = 4
+COLUMN_TOTAL_COMPRESSED_SIZE = 7
+COLUMN_STATISTICS = 12
+
+# Statistics fields
+STATISTICS_MAX = 1
+STATISTICS_MIN = 2
+STATISTICS_NULL_COUNT = 3
+STATISTICS_MAX_VALUE = 5
+STATISTICS_MIN_VALUE = 6
+
+# physical types
+BOOLEAN = 0
+INT32 = 1
+INT64 = 2
+INT96 = 3
+FLOAT = 4
+DOUBLE = 5
+BYTE_ARRAY = 6
+FIXED_LEN_BYTE_ARRAY = 7
+
+# repetition types
+REQUIRED = 0
+OPTIONAL = 1
+REPEATED = 2
+
+# converted types
+UTF8 = 0
+MAP = 1
+MAP_KEY_VALUE = 2
+LIST = 3
+ENUM = 4
+DECIMAL = 5
+DATE = 6
+INT_8 = 15
+INT_16 = 16
+JSON = 19
+
+# plain encodings of the numeric types, for statistics
+_PLAIN_FORMATS = {INT32: '<i', INT64: '<q', FLOAT: '<f', DOUBLE: '<d'}
+
+# Thrift compact protocol types
+_STOP = 0
+_TRUE = 1
+_FALSE = 2
+_BYTE = 3
+_I16 = 4
+_I32 = 5
+_I64 = 6
+_DOUBLE = 7
+_BINARY = 8
+_LIST = 9
+_SET = 10
+_MAP = 11
+_STRUCT = 12
+
+
+class _CompactReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        b = ord(self.data[self.pos])
+        self.pos += 1
+        return b
+
+    def varint(self):
+        shift = 0
+        result = 0
+        while True:
+            b = self.byte()
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                return result
+            shift += 7
+
+    def zigzag(self):
+        n = self.varint()
+        return (n >> 1) ^ -(n & 1)
+
+    def value(self, type_):
+        if type_ == _TRUE:
+            return True
+        elif type_ == _FALSE:
+            return False
+        elif type_ == _BYTE:
+            return self.byte()
+        elif type_ in (_I16, _I32, _I64):
+            return self.zigzag()
+        elif type_ == _DOUBLE:
+            (d,) = struct.unpack('<d', self.data[self.pos:self.pos + 8])
+            self.pos += 8
+            return d
+        elif type_ == _BINARY:
+            n = self.varint()
+            s = self.data[self.pos:self.pos + n]
+            self.pos += n
+            return s
+        elif type_ in (_LIST, _SET):
+            header = self.byte()
+            size = header >> 4
+            if size == 15:
+                size = self.varint()
+            elem_type = header & 0x0f
+            if elem_type in (_TRUE, _FALSE):
+                # booleans inside collections are encoded as a full byte
+                return [self.byte() == _TRUE for _ in xrange(size)]
+            return [self.value(elem_type) for _ in xrange(size)]
+        elif type_ == _MAP:
+            size = self.varint()
+            if size == 0:
+                return {}
+            types = self.byte()
+            return dict((self.value(types >> 4), self.value(types & 0x0f))
+                        for _ in xrange(size))
+        elif type_ == _STRUCT:
+            return self.struct()
+        raise ValueError('Unknown Thrift compact type {0}'.format(type_))
+
+    def struct(self):
+        fields = {}
+        field_id = 0
+        while True:
+            header = self.byte()
+            type_ = header & 0x0f
+            if type_ == _STOP:
+                return fields
+            delta = header >> 4
+            field_id = field_id + delta if delta else self.zigzag()
+            fields[field_id] = self.value(type_)
+
+
+def footer_length(tail):
+    """Return the footer length given (at least) the last 8 bytes of a file."""
+    if tail[-4:] != MAGIC:
+        raise ValueError('Not a Parquet file (bad magic bytes)')
+    (length,) = struct.unpack('<i', tail[-8:-4])
+    return length
+
+
+def parse_footer(tail):
+    """Decode the FileMetaData from the trailing bytes of a Parquet file.
+
+    tail must contain the complete footer; use footer_length() to find out how
+    many trailing bytes (footer_length(tail) + 8) are needed.
+    """
+    length = footer_length(tail)
+    if length + 8 > len(tail):
+        raise ValueError('Need {0} trailing bytes to parse the footer, got '
+                         '{1}'.format(length + 8, len(tail)))
+    return _CompactReader(tail[-8 - length:-8]).struct()
+
+
+def row_groups(meta):
+    return meta.get(FILE_ROW_GROUPS, [])
+
+
+def num_rows(meta):
+    return sum(rg.get(ROW_GROUP_NUM_ROWS, 0) for rg in row_groups(meta))
+
+
+def schema_tree(meta):
+    """The schema of a file as a (SchemaElement, [children]) tree, from the
+    depth-first list of elements in the footer."""
+    elements = meta[FILE_SCHEMA]
+
+    def parse(pos):
+        element = elements[pos]
+        children = []
+        pos += 1
+        for _ in xrange(element.get(SCHEMA_NUM_CHILDREN, 0)):
+            (child, pos) = parse(pos)
+            children.append(child)
+        return ((element, children), pos)
+
+    return parse(0)[0]
+
+
+def decode_statistic(type_, value):
+    """Decode a plain-encoded min or max of a numeric column (None for other
+    types)."""
+    if type_ not in _PLAIN_FORMATS:
+        return None
+    return struct.unpack(_PLAIN_FORMATS[type_], value)[0]
+
+
+def read_footer(url):
+    """Read and decode the footer of the Parquet file at a dfs url."""
+    tail = read_tail(url, FOOTER_READ_SIZE)
+    length = footer_length(tail)
+    if length + 8 > len(tail):
+        tail = read_tail(url, length + 8)
+    return parse_footer(tail)
+
+
+def read_footers(url, files, threads=16):
+    """Read the footers of the part files under url in parallel.
+
+    files are (relative name, size) pairs, as from eggo.dfs.list_files;
+    returns {name: footer} for the .parquet files among them.
+    """
+    names = [name for (name, _) in files if name.endswith('.parquet')]
+    pool = ThreadPool(max(1, min(threads, len(names))))
+    try:
+        return dict(zip(names, pool.map(
+            lambda name: read_footer(os.path.join(url, name)), names)))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,195 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Size a cluster for the sources of one or more toasts.
+
+The toast DAG records how long the download and conversion stages took (see
+eggo.catalog.record_stage); after each toast, the client adds those timings,
+with the number and type of nodes that produced them, to a history file in
+the client state directory.  The planner turns the history into per-node
+throughputs (falling back to rough defaults), and picks the cheapest instance
+type and node count that should finish within a target wall-clock time.
+"""
+
+import os
+import json
+import math
+from datetime import datetime, timedelta
+
+import boto.ec2
+from boto.exception import (
+    BotoClientError, BotoServerError, NoAuthHandlerFound)
+
+from eggo.scratch import GZIP_EXPANSION
+from eggo.util import ensure_dir
+
+
+# instance type -> (vCPUs, instance storage in GB, on-demand USD/hour in
+# us-east-1)
+instance_types = {
+    'm3.xlarge': (4, 80, 0.266),
+    'm3.2xlarge': (8, 160, 0.532),
+    'c3.4xlarge': (16, 320, 0.840),
+    'c3.8xlarge': (32, 640, 1.680),
+    'r3.xlarge': (4, 80, 0.333),
+    'r3.2xlarge': (8, 160, 0.665),
+    'r3.4xlarge': (16, 320, 1.330),
+    'r3.8xlarge': (32, 640, 2.660),
+    'i2.xlarge': (4, 800, 0.853),
+    'i2.2xlarge': (8, 1600, 1.705)}
+
+# throughputs assumed before any run has been recorded
+DEFAULT_DOWNLOAD_RATE = 40e6  # bytes/s per node
+DEFAULT_CONVERT_RATE = 2e6  # bytes/s per vCPU
+
+# vCPUs assumed for nodes of an unknown instance type
+DEFAULT_VCPUS = 4
+
+# provisioning and setup time that does not shrink with more nodes
+DEFAULT_OVERHEAD = 30 * 60  # seconds
+
+# bid this much over the current spot price, up to the on-demand price
+SPOT_BID_MARGIN = 1.25
+
+
+def history_path(state_path):
+    return os.path.join(state_path, 'throughput.json')
+
+
+def load_history(state_path):
+    path = history_path(state_path)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as ip:
+        return json.load(ip)
+
+
+def record_runs(state_path, dataset, stages, instance_type, nodes):
+    """Add the stage timings of a toast (from its catalog entry) to the
+    history, skipping timings that were already added."""
+    history = load_history(state_path)
+    seen = set((r['dataset'], r['stage'], r['updated']) for r in history)
+    for (stage, timing) in stages.iteritems():
+        if (dataset, stage, timing['updated']) in seen:
+            continue
+        history.append(dict(timing, dataset=dataset, stage=stage,
+                            instance_type=instance_type, nodes=nodes))
+    ensure_dir(state_path)
+    tmp_path = history_path(state_path) + '.tmp'
+    with open(tmp_path, 'w') as op:
+        json.dump(history, op, indent=2)
+    os.rename(tmp_path, history_path(state_path))
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return (values[mid] if len(values) % 2
+            else (values[mid - 1] + values[mid]) / 2.0)
+
+
+def _node_rates(history, stage):
+    # (record, source bytes/s per node) for each usable run of a stage
+    return [(r, r['source_bytes'] / float(r['seconds']) / r['nodes'])
+            for r in history
+            if r['stage'] == stage and r['seconds'] > 0 and r['nodes'] > 0]
+
+
+def node_rates(history, instance_type, vcpus=None):
+    """Estimate the (download, convert) throughput of one node, in source
+    bytes per second.  vcpus overrides the vCPUs of instance_type."""
+    # downloads are network-bound, so any instance type's runs will do
+    download = [rate for (_, rate) in _node_rates(history, 'download')]
+    download_rate = _median(download) if download else DEFAULT_DOWNLOAD_RATE
+    # conversion is CPU-bound, so other types' runs are scaled by their vCPUs
+    convert = _node_rates(history, 'convert')
+    same_type = [rate for (r, rate) in convert
+                 if r['instance_type'] == instance_type]
+    per_vcpu = [rate / instance_types[r['instance_type']][0]
+                for (r, rate) in convert
+                if r['instance_type'] in instance_types]
+    if vcpus is None:
+        vcpus = instance_types.get(instance_type, (DEFAULT_VCPUS,))[0]
+    if same_type:
+        convert_rate = _median(same_type)
+    else:
+        convert_rate = vcpus * (
+            _median(per_vcpu) if per_vcpu else DEFAULT_CONVERT_RATE)
+    return (download_rate, convert_rate)
+
+
+def spot_price(region, instance_type):
+    """The highest current spot price of instance_type across the zones of
+    region, or None if it is unavailable."""
+    try:
+        conn = boto.ec2.connect_to_region(region)
+        history = conn.get_spot_price_history(
+            start_time=(datetime.utcnow() - timedelta(hours=1)).isoformat(),
+            instance_type=instance_type,
+            product_description='Linux/UNIX')
+    except (BotoClientError, BotoServerError, NoAuthHandlerFound):
+        return None
+    prices = [h.price for h in history]
+    return max(prices) if prices else None
+
+
+def plan_cluster(source_bytes, largest_source, history, target_hours,
+                 max_nodes, overhead=DEFAULT_OVERHEAD, spot_region=None):
+    """Return a plan (a dict) for each instance type, cheapest first among
+    the plans that meet the target time, then fastest first."""
+    target = target_hours * 3600.0
+    plans = []
+    for (type_, (_, disk_gb, price)) in instance_types.iteritems():
+        if disk_gb * 1e9 < largest_source * GZIP_EXPANSION:
+            # the largest source would not fit on a node's disk, decompressed
+            continue
+        (download_rate, convert_rate) = node_rates(history, type_)
+        node_seconds = (source_bytes / download_rate +
+                        source_bytes / convert_rate)
+        nodes = int(math.ceil(node_seconds / max(target - overhead, 1)))
+        nodes = min(max(nodes, 1), max_nodes)
+        seconds = overhead + node_seconds / nodes
+        bid = None
+        if spot_region is not None:
+            current = spot_price(spot_region, type_)
+            if current is not None:
+                bid = round(min(price, current * SPOT_BID_MARGIN), 3)
+        hourly = bid if bid is not None else price
+        plans.append({'instance_type': type_, 'nodes': nodes,
+                      'hours': seconds / 3600,
+                      'meets_target': seconds <= target,
+                      'spot_price': bid,
+                      # EC2 bills whole instance-hours
+                      'cost': nodes * hourly * math.ceil(seconds / 3600)})
+    return sorted(plans, key=lambda p: (not p['meets_target'],
+                                        p['cost'] if p['meets_target']
+                                        else p['hours']))
+
+
+def print_plans(plans, source_bytes):
+    print 'Sizing for {0:.1f} GB of sources'.format(source_bytes / 1e9)
+    row = ('{type_:<12}  {nodes:>5}  {hours:>6}  {spot:>6}  {cost:>8}  '
+           '{meets}')
+    print row.format(type_='type', nodes='nodes', hours='hours', spot='bid',
+                     cost='cost', meets='meets target')
+    for p in plans:
+        print row.format(
+            type_=p['instance_type'], nodes=p['nodes'],
+            hours='{0:.1f}'.format(p['hours']),
+            spot='{0:.3f}'.format(p['spot_price'])
+            if p['spot_price'] is not None else '-',
+            cost='${0:.2f}'.format(p['cost']),
+            meets='yes' if p['meets_target'] else 'no')
@@ -0,0 +1,242 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Probe the sources of a toast config before anything is downloaded.
+
+Every source is probed concurrently with a single small request (an 18-byte
+ranged GET for HTTP, SIZE/MDTM plus a REST 0 retrieval for FTP, a stat and a
+read for a local or mounted file), which records
+its size, whether it supports ranged reads, its ETag (or modification time)
+and its leading bytes, so that a mislabelled "compression" field is caught and
+BGZF files are recognized.  A source that sends fewer leading bytes than the
+size it reports (e.g. a truncated mirror) fails too.
+The results are cached in a JSON sidecar keyed by a digest of the sources.
+
+This module deliberately does not depend on the eggo config, so that it can be
+exercised against local HTTP/FTP servers.
+"""
+
+import os
+import json
+import time
+import urllib2
+import httplib
+from ftplib import FTP, all_errors
+from hashlib import md5
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+
+from eggo.bgzf import is_bgzf
+from eggo.util import ensure_dir, local_path
+
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# enough leading bytes to recognize a BGZF block header
+HEAD_SIZE = 18
+
+# sidecars older than this are re-probed
+DEFAULT_MAX_AGE = 24 * 60 * 60  # seconds
+
+
+def sources_digest(sources):
+    return md5(json.dumps(sources, sort_keys=True)).hexdigest()
+
+
+def sidecar_path(directory, config_data):
+    return os.path.join(directory,
+                        '{0}.preflight.json'.format(config_data['name']))
+
+
+def _probe_http(url, timeout):
+    request = urllib2.Request(
+        url, headers={'Range': 'bytes=0-{0}'.format(HEAD_SIZE - 1)})
+    response = urllib2.urlopen(request, timeout=timeout)
+    try:
+        info = response.info()
+        accepts_ranges = response.getcode() == 206
+        if accepts_ranges:
+            # Content-Range: bytes 0-17/<size>
+            size = info.getheader('Content-Range', '').split('/')[-1]
+        else:
+            size = info.getheader('Content-Length')
+        return {'size': int(size) if size and size != '*' else None,
+                'accepts_ranges': accepts_ranges,
+                'etag': info.getheader('ETag'),
+                'head': response.read(HEAD_SIZE)}
+    finally:
+        response.close()
+
+
+def _probe_ftp(url, timeout):
+    parsed = urlparse(url)
+    ftp = FTP(timeout=timeout)
+    ftp.connect(parsed.hostname, parsed.port or 21)
+    try:
+        ftp.login(parsed.username or 'anonymous', parsed.password or '')
+        ftp.voidcmd('TYPE I')
+        size = ftp.size(parsed.path)
+        try:
+            mdtm = 'mdtm:' + ftp.sendcmd('MDTM ' + parsed.path).split()[-1]
+        except all_errors:
+            mdtm = None
+        try:
+            conn = ftp.transfercmd('RETR ' + parsed.path, rest=0)
+            accepts_ranges = True
+        except all_errors:
+            conn = ftp.transfercmd('RETR ' + parsed.path)
+            accepts_ranges = False
+        head = ''
+        while len(head) < HEAD_SIZE:
+            data = conn.recv(HEAD_SIZE - len(head))
+            if not data:
+                break
+            head += data
+        conn.close()
+        return {'size': size, 'accepts_ranges': accepts_ranges,
+                'etag': mdtm, 'head': head}
+    finally:
+        ftp.close()
+
+
+def _probe_local(path):
+    with open(path, 'rb') as ip:
+        return {'size': os.fstat(ip.fileno()).st_size, 'accepts_ranges': True,
+                'etag': 'mtime:{0}'.format(int(os.fstat(ip.fileno()).st_mtime)),
+                'head': ip.read(HEAD_SIZE)}
+
+
+def _check_size(size, head):
+    if size is not None and len(head) < min(size, HEAD_SIZE):
+        return 'sent {0} bytes, but reports a size of {1}'.format(len(head),
+                                                                  size)
+    return None
+
+
+def _check_head(source, head):
+    # BAM files are BGZF-compressed, which starts with the gzip magic bytes
+    expect_gzip = source['compression'] or source['format'] == 'bam'
+    gzipped = head[:2] == GZIP_MAGIC
+    if len(head) >= 2 and gzipped != expect_gzip:
+        return ('content is {0}gzip-compressed, but "compression" is '
+                '{1}'.format('' if gzipped else 'not ',
+                             str(source['compression']).lower()))
+    return None
+
+
+def probe_source(source, timeout=30):
+    """Probe a single source dict from a toast config."""
+    url = source['url']
+    result = {'url': url, 'ok': False, 'error': None, 'size': None,
+              'accepts_ranges': None, 'etag': None, 'bgzf': None}
+    start = time.time()
+    try:
+        if local_path(url) is not None:
+            probe = _probe_local(local_path(url))
+        elif url.startswith('ftp:'):
+            probe = _probe_ftp(url, timeout)
+        else:
+            probe = _probe_http(url, timeout)
+    except ((urllib2.URLError, httplib.HTTPException, EnvironmentError,
+             ValueError) + all_errors) as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    else:
+        head = probe.pop('head')
+        result['error'] = (_check_size(probe['size'], head) or
+                           _check_head(source, head))
+        result['bgzf'] = is_bgzf(head)
+        result.update(probe)
+        result['ok'] = result['error'] is None
+    result['duration'] = time.time() - start
+    return result
+
+
+def run_preflight(sources, threads=32, timeout=30):
+    """Probe all sources concurrently and return a sidecar dict."""
+    pool = ThreadPool(max(1, min(threads, len(sources))))
+    try:
+        results = pool.map(lambda s: probe_source(s, timeout), sources)
+    finally:
+        pool.close()
+        pool.join()
+    return {'digest': sources_digest(sources),
+            'created': time.time(),
+            'sources': results}
+
+
+def load_preflight(path, sources, max_age=DEFAULT_MAX_AGE):
+    """Return the cached sidecar at path if it is fresh and fully ok."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as ip:
+        sidecar = json.load(ip)
+    if (sidecar.get('digest') != sources_digest(sources) or
+            time.time() - sidecar.get('created', 0) > max_age or
+            not all(r['ok'] for r in sidecar['sources'])):
+        return None
+    return sidecar
+
+
+def write_preflight(path, sidecar):
+    ensure_dir(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as op:
+        json.dump(sidecar, op, indent=2)
+    os.rename(tmp_path, path)
+
+
+def preflight(sources, path, threads=32, timeout=30,
+              max_age=DEFAULT_MAX_AGE):
+    """Return the cached sidecar at path, or probe the sources and cache it."""
+    sidecar = load_preflight(path, sources, max_age)
+    if sidecar is None:
+        sidecar = run_preflight(sources, threads, timeout)
+        write_preflight(path, sidecar)
+    return sidecar
+
+
+def failed_sources(sidecar):
+    return [r for r in sidecar['sources'] if not r['ok']]
+
+
+def source_sizes(sidecar):
+    """Map each source url to its size in bytes (None if unknown)."""
+    return dict((r['url'], r['size']) for r in sidecar['sources'])
+
+
+def source_etags(sidecar):
+    """Map each source url to its ETag (or modification time), if known."""
+    return dict((r['url'], r['etag']) for r in sidecar['sources'])
+
+
+def bgzf_sources(sidecar):
+    """The urls of the sources that are BGZF-compressed."""
+    return set(r['url'] for r in sidecar['sources'] if r.get('bgzf'))
+
+
+def print_preflight(sidecar):
+    row = '{status:<6}  {size:>14}  {ranges:<6}  {url}{error}'
+    print row.format(status='status', size='size', ranges='ranges', url='url',
+                     error='')
+    for r in sidecar['sources']:
+        error = '  ({0})'.format(r['error']) if r['error'] else ''
+        print row.format(status='ok' if r['ok'] else 'FAILED',
+                         size=r['size'] if r['size'] is not None else '?',
+                         ranges='yes' if r['accepts_ranges'] else 'no',
+                         url=r['url'], error=error)
+    total = sum(r['size'] or 0 for r in sidecar['sources'])
+    print '{0} sources, {1} bytes, {2} failed'.format(
+        len(sidecar['sources']), total, len(failed_sources(sidecar)))
@@ -0,0 +1,284 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in profiling of the toast DAG's task bodies and streaming mappers.
+
+Profiling is on when the EGGO_PROFILE environment variable is set (to a run
+name, or to 1 for the 'default' run).  Each profiled body then runs under
+cProfile, with the wall time, the CPU time of Python and of its child
+processes, and the command line and duration of every subprocess it waited
+for.  These are written to the run's directory under worker_env.work_path:
+a <name>.<host>.<pid>.<n>.prof file (pstats format) and a .json file next
+to it.
+
+`python -m eggo.profiling RUN` prints the hot spots of a run on this host;
+`python -m eggo.profiling --export RUN` prints them as JSON, which
+merge_exports() combines across hosts (see `eggo profile_report`).
+"""
+
+import os
+import sys
+import json
+import time
+import pstats
+import socket
+import cProfile
+import resource
+import subprocess
+from glob import glob
+from contextlib import contextmanager
+
+from eggo.config import eggo_config
+from eggo.util import ensure_dir
+
+
+PROFILE_ENV = 'EGGO_PROFILE'
+
+# functions per host in an export, by internal time
+EXPORT_LIMIT = 1000
+
+# rows of each table in a report
+REPORT_ROWS = 25
+
+# the profiles being taken in this process, by name
+_active = {}
+
+_sequence = [0]
+
+
+def profile_run():
+    """The name of the run being profiled, or None if profiling is off."""
+    value = os.environ.get(PROFILE_ENV, '').strip()
+    if value.lower() in ['', '0', 'false', 'no']:
+        return None
+    if value.lower() in ['1', 'true', 'yes']:
+        return 'default'
+    return value
+
+
+def profile_dir(run):
+    return os.path.join(eggo_config.get('worker_env', 'work_path'),
+                        'profiles', run)
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _command(args):
+    if isinstance(args, basestring):
+        return args
+    return ' '.join(str(a) for a in args)
+
+
+class _SubprocessTimer(object):
+    # times the subprocesses that are waited for while installed, by patching
+    # subprocess.Popen itself, so that it also sees the Popen of modules that
+    # imported it by name (e.g. from subprocess import check_call)
+
+    def __init__(self):
+        self.calls = []
+        self._originals = None
+
+    def install(self):
+        timer = self
+        (init, wait) = (subprocess.Popen.__init__, subprocess.Popen.wait)
+        self._originals = (init, wait)
+
+        def timed_init(popen, *args, **kwargs):
+            popen._eggo_started = time.time()
+            popen._eggo_command = _command(
+                args[0] if args else kwargs.get('args', ''))
+            init(popen, *args, **kwargs)
+
+        def timed_wait(popen, *args, **kwargs):
+            returncode = wait(popen, *args, **kwargs)
+            started = getattr(popen, '_eggo_started', None)
+            if started is not None:
+                timer.calls.append({'command': popen._eggo_command,
+                                    'seconds': time.time() - started,
+                                    'returncode': returncode})
+                popen._eggo_started = None
+            return returncode
+
+        subprocess.Popen.__init__ = timed_init
+        subprocess.Popen.wait = timed_wait
+
+    def uninstall(self):
+        if self._originals is not None:
+            (subprocess.Popen.__init__,
+             subprocess.Popen.wait) = self._originals
+            self._originals = None
+
+
+def start_profile(name):
+    """Start profiling name (e.g. a task id), if profiling is on."""
+    if profile_run() is None or _active:
+        # profiles do not nest: an inner body is part of the outer one
+        return
+    timer = _SubprocessTimer()
+    timer.install()
+    profiler = cProfile.Profile()
+    _active[name] = (profiler, timer, time.time(),
+                     _cpu_seconds(resource.RUSAGE_SELF),
+                     _cpu_seconds(resource.RUSAGE_CHILDREN))
+    profiler.enable()
+
+
+def stop_profile(name, failed=False):
+    """Stop profiling name, and write its profile to the run's directory."""
+    if name not in _active:
+        return
+    (profiler, timer, started, cpu, children_cpu) = _active.pop(name)
+    profiler.disable()
+    timer.uninstall()
+    run_dir = profile_dir(profile_run())
+    ensure_dir(run_dir)
+    _sequence[0] += 1
+    base = os.path.join(run_dir, '{0}.{1}.{2}.{3}'.format(
+        ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)[:100],
+        socket.gethostname(), os.getpid(), _sequence[0]))
+    profiler.dump_stats(base + '.prof')
+    summary = {'name': name, 'host': socket.gethostname(),
+               'failed': failed, 'started': started,
+               'wall': time.time() - started,
+               'cpu': _cpu_seconds(resource.RUSAGE_SELF) - cpu,
+               'children_cpu': (_cpu_seconds(resource.RUSAGE_CHILDREN) -
+                                children_cpu),
+               'subprocesses': timer.calls}
+    with open(base + '.json', 'w') as op:
+        json.dump(summary, op)
+
+
+@contextmanager
+def profiled(name):
+    """Profile the body of the with statement, if profiling is on."""
+    start_profile(name)
+    try:
+        yield
+    except:
+        stop_profile(name, failed=True)
+        raise
+    stop_profile(name)
+
+
+def export_run(run):
+    """The merged function statistics (the top EXPORT_LIMIT by internal
+    time) and the summaries of the profiles of run on this host."""
+    run_dir = profile_dir(run)
+    profiles = sorted(glob(os.path.join(run_dir, '*.prof')))
+    stats = []
+    if profiles:
+        merged = pstats.Stats(*profiles)
+        for ((path, line, func), (cc, nc, tt, ct, _)) in \
+                merged.stats.iteritems():
+            stats.append([path, line, func, cc, nc, tt, ct])
+        stats = sorted(stats, key=lambda s: -s[5])[:EXPORT_LIMIT]
+    summaries = []
+    for path in sorted(glob(os.path.join(run_dir, '*.json'))):
+        with open(path, 'r') as ip:
+            summaries.append(json.load(ip))
+    return {'run': run, 'stats': stats, 'profiles': summaries}
+
+
+def merge_exports(exports):
+    """Combine the exports of several hosts into one."""
+    stats = {}
+    summaries = []
+    for export in exports:
+        for (path, line, func, cc, nc, tt, ct) in export['stats']:
+            total = stats.setdefault((path, line, func), [0, 0, 0.0, 0.0])
+            for (i, value) in enumerate([cc, nc, tt, ct]):
+                total[i] += value
+        summaries.extend(export['profiles'])
+    return {'stats': [list(k) + v for (k, v) in stats.iteritems()],
+            'profiles': summaries}
+
+
+def _program(command):
+    # the program a command runs, e.g. 'hadoop fs' or 'adam-submit'
+    words = command.split()
+    if not words:
+        return '?'
+    program = os.path.basename(words[0])
+    if len(words) > 1 and not words[1].startswith('-') and \
+            '/' not in words[1]:
+        program += ' ' + words[1]
+    return program
+
+
+def _task_name(name):
+    # the task family of a luigi task id, e.g. ADAMBasicTask(...)
+    return name.split('(')[0]
+
+
+def print_report(export, rows=REPORT_ROWS):
+    """Print where the time of the profiled bodies went."""
+    tasks = {}
+    programs = {}
+    for p in export['profiles']:
+        t = tasks.setdefault(_task_name(p['name']), [0, 0.0, 0.0, 0.0, 0.0])
+        subprocess_seconds = sum(c['seconds'] for c in p['subprocesses'])
+        for (i, value) in enumerate([1, p['wall'], p['cpu'],
+                                     p['children_cpu'], subprocess_seconds]):
+            t[i] += value
+        for c in p['subprocesses']:
+            s = programs.setdefault(_program(c['command']), [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += c['seconds']
+            s[2] = max(s[2], c['seconds'])
+
+    print 'Profiled bodies (seconds; "other" is wall time outside Python ' \
+        'CPU and subprocesses, e.g. network waits):'
+    row = '{0:<40} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}'
+    print row.format('body', 'count', 'wall', 'python', 'subprocess',
+                     'child cpu', 'other')
+    for (name, (count, wall, cpu, children_cpu, sub)) in sorted(
+            tasks.iteritems(), key=lambda t: -t[1][1]):
+        print row.format(name[:40], count, '{0:.1f}'.format(wall),
+                         '{0:.1f}'.format(cpu), '{0:.1f}'.format(sub),
+                         '{0:.1f}'.format(children_cpu),
+                         '{0:.1f}'.format(max(0.0, wall - cpu - sub)))
+
+    print
+    print 'Subprocesses:'
+    row = '{0:<40} {1:>6} {2:>10} {3:>10}'
+    print row.format('program', 'count', 'total', 'max')
+    for (program, (count, total, longest)) in sorted(
+            programs.iteritems(), key=lambda p: -p[1][1])[:rows]:
+        print row.format(program[:40], count, '{0:.1f}'.format(total),
+                         '{0:.1f}'.format(longest))
+
+    print
+    print 'Python hot spots, by internal time:'
+    row = '{0:>10} {1:>10} {2:>10}  {3}'
+    print row.format('calls', 'tottime', 'cumtime', 'function')
+    for (path, line, func, cc, nc, tt, ct) in sorted(
+            export['stats'], key=lambda s: -s[5])[:rows]:
+        print row.format(nc, '{0:.2f}'.format(tt), '{0:.2f}'.format(ct),
+                         '{0}:{1}({2})'.format(path, line, func))
+
+
+if __name__ == '__main__':
+    # profiling.py [--export] RUN: print the report (or export) of a run
+    args = sys.argv[1:]
+    export = export_run(args[-1] if args and args[-1] != '--export'
+                        else 'default')
+    if '--export' in args:
+        print json.dumps(export)
+    else:
+        print_report(export)
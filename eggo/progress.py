@@ -0,0 +1,186 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Live progress of the transfers (downloads and uploads) of a toast.
+
+Every few seconds, a transfer publishes its bytes done, rate and ETA as a
+small JSON status file in the progress directory under worker_env.work_path,
+one file per transfer, so that any process on the host can show them (see
+`python -m eggo.progress`).  Under Hadoop streaming, it also updates the
+task's status and an "eggo" byte counter per phase, which the job tracker
+shows for each mapper.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+
+from eggo.config import eggo_config
+
+
+# how often (in seconds) a transfer publishes its progress
+PUBLISH_INTERVAL = 5
+
+# status files not updated for this long (in seconds) are removed
+STALE_AGE = 24 * 3600
+
+
+def progress_dir():
+    return os.path.join(eggo_config.get('worker_env', 'work_path'),
+                        'progress')
+
+
+def _in_hadoop_streaming():
+    return 'mapred_task_id' in os.environ or 'mapreduce_task_id' in os.environ
+
+
+def _size(n):
+    return '{0:.1f} MB'.format(n / 1e6) if n is not None else '?'
+
+
+def _duration(seconds):
+    if seconds is None:
+        return '?'
+    return '{0}:{1:02d}:{2:02d}'.format(int(seconds) // 3600,
+                                        int(seconds) % 3600 // 60,
+                                        int(seconds) % 60)
+
+
+def format_status(status):
+    return '{phase} {name}: {done} of {total} ({rate:.1f} MB/s, ETA ' \
+        '{eta})'.format(phase=status['phase'],
+                        name=os.path.basename(status['source']),
+                        done=_size(status['bytes']),
+                        total=_size(status['total']),
+                        rate=status['rate'] / 1e6,
+                        eta=_duration(status['eta']))
+
+
+class Progress(object):
+    """The progress of one transfer of source (e.g. a URL) in a phase (e.g.
+    'download'), of total bytes if known."""
+
+    def __init__(self, source, phase, total=None):
+        self.source = source
+        self.phase = phase
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.rate = 0.0
+        self._published = (self.start, 0)
+        self._counted = 0
+        self._path = os.path.join(progress_dir(), '{0}.{1}.json'.format(
+            hashlib.md5(source).hexdigest(), phase))
+
+    def add(self, nbytes):
+        self.set(self.done + nbytes)
+
+    def set(self, done):
+        """Set the bytes done (e.g. after a resumed download starts)."""
+        self.done = done
+        if time.time() - self._published[0] >= PUBLISH_INTERVAL:
+            self._publish()
+
+    def finish(self):
+        self._publish(finished=True)
+
+    def status(self, finished=False):
+        eta = None
+        if finished:
+            eta = 0
+        elif self.total is not None and self.rate > 0:
+            eta = max(0, self.total - self.done) / self.rate
+        return {'source': self.source, 'phase': self.phase,
+                'bytes': self.done, 'total': self.total, 'rate': self.rate,
+                'eta': eta, 'pid': os.getpid(), 'started': self.start,
+                'updated': time.time(), 'finished': finished}
+
+    def _publish(self, finished=False):
+        now = time.time()
+        (then, done_then) = self._published
+        if finished and now > self.start:
+            self.rate = self.done / (now - self.start)
+        elif now > then:
+            # the rate over the last interval, so that a stall shows at once
+            self.rate = max(0, self.done - done_then) / (now - then)
+        self._published = (now, self.done)
+        status = self.status(finished)
+        if not os.path.isdir(progress_dir()):
+            os.makedirs(progress_dir())
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as op:
+            json.dump(status, op)
+        os.rename(tmp_path, self._path)
+        if _in_hadoop_streaming():
+            print >> sys.stderr, 'reporter:status:' + format_status(status)
+            if self.done > self._counted:
+                print >> sys.stderr, \
+                    'reporter:counter:eggo,{0} bytes,{1}'.format(
+                        self.phase, self.done - self._counted)
+                self._counted = self.done
+
+
+def load_statuses():
+    """The statuses of the transfers on this host, oldest first."""
+    if not os.path.isdir(progress_dir()):
+        return []
+    statuses = []
+    for name in os.listdir(progress_dir()):
+        path = os.path.join(progress_dir(), name)
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(path, 'r') as ip:
+                status = json.load(ip)
+        except (IOError, ValueError):
+            continue
+        if time.time() - status['updated'] > STALE_AGE:
+            os.remove(path)
+            continue
+        statuses.append(status)
+    return sorted(statuses, key=lambda s: s['started'])
+
+
+def print_statuses(statuses, since=None):
+    """Print the transfers updated since a time (default: all)."""
+    for status in statuses:
+        if since is not None and status['updated'] < since:
+            continue
+        print '{0} {1}'.format('done   ' if status['finished'] else 'running',
+                               format_status(status))
+
+
+def follow(pid, interval=30):
+    """Print the transfers that are active while process pid runs."""
+    while True:
+        time.sleep(interval)
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return
+        print '--- {0}'.format(time.strftime('%H:%M:%S'))
+        print_statuses(load_statuses(), since=time.time() - interval)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    # progress.py: show all transfers; progress.py PID: follow while PID runs
+    if len(sys.argv) > 1:
+        follow(int(sys.argv[1]))
+    else:
+        print_statuses(load_statuses())
@@ -0,0 +1,411 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Download only some genomic regions of a remote, indexed BAM or VCF.
+
+BAM files and bgzipped VCF files are BGZF: a series of independently
+gzip-compressed blocks of at most 64 KB.  Their .bai/.tbi indexes map each
+region to "chunks" of virtual file offsets (the compressed offset of a block
+in the upper 48 bits, and an offset into the decompressed block in the lower
+16), so the blocks that cover a set of regions can be fetched with ranged
+reads.  The header and the records that overlap the regions are then written
+to a new, valid file: plain text for VCF, BGZF for BAM.  See the SAM/BAM and
+tabix specifications for the formats.
+
+The chunks are fetched in pieces of at most FETCH_PIECE_SIZE compressed
+bytes, several at a time but only a few ahead of the one being written, and
+are decompressed, filtered and written out a block at a time, so that the
+memory used does not grow with the size of the regions.
+"""
+
+import struct
+import urllib2
+from collections import deque
+from itertools import islice
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+
+from eggo.bgzf import (
+    BGZF_MAX_BLOCK_SIZE, BgzfWriter, block_spans, inflate_block,
+    bgzf_decompress)
+from eggo.transfer import retry, ftp_connect, ftp_finish
+from eggo.util import local_path
+
+
+# the largest region coordinate supported by the binning index
+MAX_POSITION = 1 << 29
+
+# the most compressed bytes fetched in one ranged read
+FETCH_PIECE_SIZE = 4 * 1024 * 1024
+
+# pieces fetched ahead of the one being written, per fetching thread
+FETCH_AHEAD = 2
+
+# BAM CIGAR operations that consume the reference: M, D, N, =, X
+_REF_CIGAR_OPS = set([0, 2, 3, 7, 8])
+
+
+def parse_region(region):
+    """Parse chr, chr:start or chr:start-end (1-based, inclusive) into a
+    (name, beg, end) tuple of 0-based, half-open coordinates."""
+    if ':' not in region:
+        return (region, 0, MAX_POSITION)
+    (name, span) = region.rsplit(':', 1)
+    span = span.replace(',', '')
+    if '-' in span:
+        (start, end) = span.split('-', 1)
+        return (name, int(start) - 1, int(end))
+    return (name, int(span) - 1, MAX_POSITION)
+
+
+def default_index_url(url, format):
+    return url + ('.bai' if format == 'bam' else '.tbi')
+
+
+# ranged reads
+
+def fetch_range(url, start, end=None, timeout=60):
+    """Return bytes [start, end) of the file at an http(s), ftp or local url
+    (up to the end of the file if end is None or past it), retrying transient
+    errors."""
+    return retry(lambda: _fetch_range(url, start, end, timeout),
+                 '{0} bytes {1}-{2}'.format(url, start, end or ''))
+
+
+def _fetch_range(url, start, end, timeout):
+    if local_path(url) is not None:
+        with open(local_path(url), 'rb') as ip:
+            ip.seek(start)
+            return ip.read(end - start) if end is not None else ip.read()
+    if url.startswith('ftp:'):
+        ftp = ftp_connect(url, timeout)
+        try:
+            conn = ftp.transfercmd('RETR ' + urlparse(url).path, rest=start)
+            chunks = []
+            remaining = end - start if end is not None else None
+            while remaining is None or remaining > 0:
+                data = conn.recv(min(remaining or 1 << 20, 1 << 20))
+                if not data:
+                    # the end of the file: the server must confirm it
+                    ftp_finish(ftp, conn, url)
+                    break
+                chunks.append(data)
+                if remaining is not None:
+                    remaining -= len(data)
+            else:
+                # stopped short of the end, which the server reports as an
+                # aborted transfer
+                conn.close()
+            return ''.join(chunks)[:end - start if end is not None else None]
+        finally:
+            ftp.close()
+    byte_range = 'bytes={0}-{1}'.format(
+        start, end - 1 if end is not None else '')
+    response = urllib2.urlopen(
+        urllib2.Request(url, headers={'Range': byte_range}), timeout=timeout)
+    try:
+        data = response.read()
+    finally:
+        response.close()
+    if response.getcode() != 206:
+        # the server ignored the range and sent the whole file
+        data = data[start:end]
+    return data
+
+
+def _pieces(vbeg, vend):
+    # the compressed byte ranges, of at most FETCH_PIECE_SIZE bytes, that
+    # hold the blocks between two virtual offsets; the last one reaches past
+    # the start of the block of vend by a whole block
+    (cbeg, cend) = (vbeg >> 16, vend >> 16)
+    starts = range(cbeg, cend, FETCH_PIECE_SIZE) or [cbeg]
+    return zip(starts, starts[1:] + [cend + BGZF_MAX_BLOCK_SIZE])
+
+
+def _virtual_range(pieces, vbeg, vend):
+    # yield the decompressed bytes between two virtual offsets, a block at a
+    # time, given the data of their _pieces() in order
+    (cbeg, ubeg) = (vbeg >> 16, vbeg & 0xffff)
+    (cend, uend) = (vend >> 16, vend & 0xffff)
+    (offset, pending) = (cbeg, '')
+    for piece in pieces:
+        data = pending + piece
+        consumed = 0
+        for (start, end) in block_spans(data):
+            block = offset + start
+            if block > cend:
+                return
+            payload = inflate_block(data[start:end])
+            payload = payload[:uend] if block == cend else payload
+            yield payload[ubeg:] if block == cbeg else payload
+            if block == cend:
+                return
+            consumed = end
+        (offset, pending) = (offset + consumed, data[consumed:])
+    # vend is at (or past) the end of the file
+
+
+def fetch_virtual_range(url, vbeg, vend, timeout=60):
+    """Return the decompressed bytes between two virtual offsets."""
+    return ''.join(_virtual_range(
+        (fetch_range(url, start, end, timeout)
+         for (start, end) in _pieces(vbeg, vend)), vbeg, vend))
+
+
+# indexes
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from('<' + fmt, self.data, self.pos)
+        self.pos += struct.calcsize('<' + fmt)
+        return values if len(values) > 1 else values[0]
+
+    def array(self, fmt, n):
+        values = struct.unpack_from('<{0}{1}'.format(n, fmt), self.data,
+                                    self.pos)
+        self.pos += struct.calcsize('<{0}{1}'.format(n, fmt))
+        return list(values)
+
+    def bytes(self, n):
+        s = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return s
+
+
+def _read_ref_indexes(reader, n_ref):
+    # per reference: the binning index (bin -> chunks) and the linear index
+    refs = []
+    for _ in xrange(n_ref):
+        bins = {}
+        for _ in xrange(reader.read('i')):
+            (bin_, n_chunk) = reader.read('Ii')
+            bins[bin_] = [reader.read('QQ') for _ in xrange(n_chunk)]
+        linear = reader.array('Q', reader.read('i'))
+        refs.append((bins, linear))
+    return refs
+
+
+def parse_bai(data):
+    """Parse a .bai index into a list of per-reference indexes."""
+    reader = _Reader(data)
+    if reader.bytes(4) != 'BAI\x01':
+        raise ValueError('Not a BAI index')
+    return _read_ref_indexes(reader, reader.read('i'))
+
+
+def parse_tbi(data):
+    """Parse a (BGZF-compressed) .tbi index into (names, per-reference
+    indexes, meta character)."""
+    reader = _Reader(bgzf_decompress(data))
+    if reader.bytes(4) != 'TBI\x01':
+        raise ValueError('Not a tabix index')
+    (n_ref, _, _, _, _, meta, _, l_nm) = reader.read('8i')
+    names = reader.bytes(l_nm).rstrip('\x00').split('\x00')
+    return (names, _read_ref_indexes(reader, n_ref), chr(meta))
+
+
+def _reg2bins(beg, end):
+    end -= 1
+    bins = [0]
+    for (shift, offset) in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(xrange(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def region_chunks(ref_index, beg, end):
+    """The chunks of virtual offsets that may hold records in [beg, end)."""
+    (bins, linear) = ref_index
+    window = beg >> 14
+    min_offset = linear[window] if window < len(linear) else 0
+    chunks = []
+    for bin_ in _reg2bins(beg, min(end, MAX_POSITION)):
+        chunks.extend(c for c in bins.get(bin_, []) if c[1] > min_offset)
+    return chunks
+
+
+def merge_chunks(chunks):
+    """Merge overlapping (or touching) chunks, sorted by offset."""
+    merged = []
+    for (beg, end) in sorted(chunks):
+        if merged and beg <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((beg, end))
+    return merged
+
+
+def first_record_offset(ref_indexes):
+    """The smallest virtual offset of any indexed record, i.e. the end of the
+    header."""
+    offsets = [c[0] for (bins, _) in ref_indexes
+               for (bin_, chunks) in bins.iteritems()
+               for c in chunks if bin_ < 37450]  # skip pseudo-bins
+    return min(offsets) if offsets else None
+
+
+# subsetting
+
+def _overlaps(regions, name, beg, end):
+    return any(n == name and b < end and beg < e for (n, b, e) in regions)
+
+
+def _fetch_ahead(function, items, threads):
+    # yield function(item) for each item, in order, computed on a pool of
+    # threads with at most FETCH_AHEAD results per thread held at once
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= FETCH_AHEAD * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fetch_chunks(url, chunks, threads, timeout):
+    # yield the decompressed data of chunks, in order, a block at a time
+    pieces = [_pieces(vbeg, vend) for (vbeg, vend) in chunks]
+    fetched = _fetch_ahead(
+        lambda piece: fetch_range(url, piece[0], piece[1], timeout),
+        (piece for chunk_pieces in pieces for piece in chunk_pieces),
+        max(1, threads))
+    for ((vbeg, vend), chunk_pieces) in zip(chunks, pieces):
+        data = islice(fetched, len(chunk_pieces))
+        for payload in _virtual_range(data, vbeg, vend):
+            yield payload
+        # the rest of the chunk's last piece
+        for _ in data:
+            pass
+
+
+def _lines(pieces):
+    # yield the lines of a stream of data pieces
+    partial = ''
+    for data in pieces:
+        lines = (partial + data).splitlines(True)
+        partial = lines.pop() if lines and not lines[-1].endswith('\n') \
+            else ''
+        for line in lines:
+            yield line
+    if partial:
+        yield partial
+
+
+def subset_vcf(url, index_url, regions, output, threads=8, timeout=60):
+    """Write the header and the records of a bgzipped, tabix-indexed VCF that
+    overlap regions to the (plain text) file output."""
+    (names, ref_indexes, meta) = parse_tbi(fetch_range(index_url, 0))
+    regions = [parse_region(r) for r in regions]
+    chunks = merge_chunks(
+        c for (name, beg, end) in regions if name in names
+        for c in region_chunks(ref_indexes[names.index(name)], beg, end))
+    header_end = first_record_offset(ref_indexes)
+    with open(output, 'w') as op:
+        if header_end is not None:
+            header = fetch_virtual_range(url, 0, header_end, timeout)
+            op.write(''.join(line for line in header.splitlines(True)
+                             if line.startswith(meta)))
+        for line in _lines(_fetch_chunks(url, chunks, threads, timeout)):
+            if line.startswith(meta) or not line.strip():
+                continue
+            fields = line.split('\t', 5)
+            pos = int(fields[1]) - 1
+            if _overlaps(regions, fields[0], pos, pos + len(fields[3])):
+                op.write(line)
+
+
+def _parse_bam_header(data):
+    reader = _Reader(data)
+    if reader.bytes(4) != 'BAM\x01':
+        raise ValueError('Not a BAM file')
+    reader.bytes(reader.read('i'))  # header text
+    names = []
+    for _ in xrange(reader.read('i')):
+        names.append(reader.bytes(reader.read('i')).rstrip('\x00'))
+        reader.read('i')  # reference length
+    return (names, reader.pos)
+
+
+def _bam_records(pieces):
+    # yield (reference id, start, end, raw record) for each alignment of a
+    # stream of data pieces
+    partial = ''
+    for data in pieces:
+        data = partial + data
+        pos = 0
+        while pos + 4 <= len(data):
+            (block_size,) = struct.unpack_from('<i', data, pos)
+            if pos + 4 + block_size > len(data):
+                break
+            record = data[pos:pos + 4 + block_size]
+            pos += 4 + block_size
+            (ref_id, start, l_read_name, _, _, n_cigar_op) = \
+                struct.unpack_from('<iiBBHH', record, 4)
+            cigar = struct.unpack_from('<{0}I'.format(n_cigar_op), record,
+                                       36 + l_read_name)
+            length = sum(op >> 4 for op in cigar
+                         if op & 0xf in _REF_CIGAR_OPS)
+            yield (ref_id, start, start + max(length, 1), record)
+        partial = data[pos:]
+    if partial:
+        raise ValueError('Truncated BAM record')
+
+
+def subset_bam(url, index_url, regions, output, threads=8, timeout=60):
+    """Write the header and the alignments of an indexed BAM that overlap
+    regions to the BAM file output."""
+    ref_indexes = parse_bai(fetch_range(index_url, 0))
+    header_end = first_record_offset(ref_indexes)
+    if header_end is None:
+        raise ValueError('BAM index of {0} has no records'.format(url))
+    header = fetch_virtual_range(url, 0, header_end, timeout)
+    (names, header_length) = _parse_bam_header(header)
+    regions = [parse_region(r) for r in regions]
+    chunks = merge_chunks(
+        c for (name, beg, end) in regions if name in names
+        for c in region_chunks(ref_indexes[names.index(name)], beg, end))
+    with open(output, 'wb') as op:
+        writer = BgzfWriter(op)
+        writer.write(header[:header_length])
+        for (ref_id, beg, end, record) in _bam_records(
+                _fetch_chunks(url, chunks, threads, timeout)):
+            if _overlaps(regions, names[ref_id] if ref_id >= 0 else None,
+                         beg, end):
+                writer.write(record)
+        writer.close()
+
+
+def subset(url, format, regions, output, index_url=None, threads=8,
+           timeout=60):
+    """Download the parts of a BAM or bgzipped VCF at url that overlap
+    regions (e.g., ['chr22', '20:100000-200000']) into output."""
+    index_url = index_url or default_index_url(url, format)
+    if format == 'bam':
+        subset_bam(url, index_url, regions, output, threads, timeout)
+    elif format == 'vcf':
+        subset_vcf(url, index_url, regions, output, threads, timeout)
+    else:
+        raise ValueError(
+            'Regions are only supported for BAM and VCF, not {0}'.format(format))
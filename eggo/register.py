@@ -0,0 +1,326 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate the DDL that registers the editions of a dataset as tables.
+
+Each edition becomes an external Parquet table whose columns come from the
+schema in a Parquet footer.  Part files under Hive-style key=value
+directories (e.g. a locus-partitioned layout such as contig=22/pos_bin=3/)
+make a partitioned table, with one partition per directory.  The footers of
+all the part files are read in parallel, and their row group metadata gives
+the row counts and the per-column null counts and numeric min/max values, so
+the statistics statements need no scan of the data.  Nothing is sent to a
+metastore: the statements are returned (or written) for Hive or Impala to
+run.
+"""
+
+import os
+import re
+from urllib import unquote
+
+from eggo.config import eggo_config, edition_names
+from eggo.dfs import list_files
+from eggo.parquet import (
+    read_footers, num_rows, row_groups, schema_tree, decode_statistic,
+    ROW_GROUP_COLUMNS, COLUMN_META_DATA, COLUMN_TYPE,
+    COLUMN_PATH_IN_SCHEMA, COLUMN_STATISTICS, STATISTICS_MAX,
+    STATISTICS_MIN, STATISTICS_NULL_COUNT, STATISTICS_MAX_VALUE,
+    STATISTICS_MIN_VALUE, SCHEMA_TYPE, SCHEMA_NAME, SCHEMA_REPETITION_TYPE,
+    SCHEMA_CONVERTED_TYPE, SCHEMA_PRECISION, SCHEMA_SCALE, BOOLEAN, INT32,
+    INT64, INT96, FLOAT, DOUBLE, BYTE_ARRAY, FIXED_LEN_BYTE_ARRAY, REPEATED,
+    UTF8, MAP, MAP_KEY_VALUE, LIST, ENUM, DECIMAL, DATE, INT_8, INT_16,
+    JSON)
+
+
+# the SQL dialects the statistics statements can be written in
+dialects = ['hive', 'impala']
+
+_HIVE_TYPES = {BOOLEAN: 'BOOLEAN', INT32: 'INT', INT64: 'BIGINT',
+               INT96: 'TIMESTAMP', FLOAT: 'FLOAT', DOUBLE: 'DOUBLE',
+               BYTE_ARRAY: 'BINARY', FIXED_LEN_BYTE_ARRAY: 'BINARY'}
+
+_HIVE_CONVERTED_TYPES = {UTF8: 'STRING', ENUM: 'STRING', JSON: 'STRING',
+                         DATE: 'DATE', INT_8: 'TINYINT', INT_16: 'SMALLINT'}
+
+
+# schema
+
+def _primitive_type(element):
+    converted = element.get(SCHEMA_CONVERTED_TYPE)
+    if converted == DECIMAL:
+        return 'DECIMAL({0},{1})'.format(element[SCHEMA_PRECISION],
+                                         element.get(SCHEMA_SCALE, 0))
+    if converted in _HIVE_CONVERTED_TYPES:
+        return _HIVE_CONVERTED_TYPES[converted]
+    return _HIVE_TYPES[element[SCHEMA_TYPE]]
+
+
+def _struct_type(children):
+    return 'STRUCT<{0}>'.format(','.join(
+        '{0}:{1}'.format(child[0][SCHEMA_NAME], field_type(child))
+        for child in children))
+
+
+def _list_element_type(list_node):
+    # the element type of a LIST-annotated group, following the backward
+    # compatibility rules of the Parquet format's LogicalTypes.md
+    (element, children) = list_node
+    repeated = children[0]
+    (repeated_element, repeated_children) = repeated
+    if SCHEMA_TYPE in repeated_element:
+        return _primitive_type(repeated_element)
+    if (len(repeated_children) > 1 or repeated_element[SCHEMA_NAME] in
+            ('array', element[SCHEMA_NAME] + '_tuple')):
+        return _struct_type(repeated_children)
+    return field_type(repeated_children[0])
+
+
+def _element_type(node):
+    # the Hive type of a schema node, ignoring its repetition
+    (element, children) = node
+    if SCHEMA_TYPE in element:
+        return _primitive_type(element)
+    converted = element.get(SCHEMA_CONVERTED_TYPE)
+    if converted == LIST and len(children) == 1:
+        return 'ARRAY<{0}>'.format(_list_element_type(node))
+    if (converted in (MAP, MAP_KEY_VALUE) and len(children) == 1 and
+            len(children[0][1]) == 2):
+        (key, value) = children[0][1]
+        return 'MAP<{0},{1}>'.format(_element_type(key), field_type(value))
+    return _struct_type(children)
+
+
+def field_type(node):
+    """The Hive type of a (SchemaElement, [children]) schema node."""
+    if node[0].get(SCHEMA_REPETITION_TYPE) == REPEATED:
+        return 'ARRAY<{0}>'.format(_element_type(node))
+    return _element_type(node)
+
+
+def table_columns(meta):
+    """[(name, Hive type)] for the top-level fields of a footer's schema."""
+    return [(child[0][SCHEMA_NAME], field_type(child))
+            for child in schema_tree(meta)[1]]
+
+
+# statistics
+
+def column_statistics(footers):
+    """Aggregate the row group statistics of top-level primitive columns.
+
+    Returns {column: {'nulls': n or None, 'min': v or None, 'max': v or
+    None}}; a statistic is None if any row group lacks it.
+    """
+    stats = {}
+    for meta in footers:
+        for rg in row_groups(meta):
+            for chunk in rg.get(ROW_GROUP_COLUMNS, []):
+                column = chunk.get(COLUMN_META_DATA, {})
+                path = column.get(COLUMN_PATH_IN_SCHEMA, [])
+                if len(path) != 1:
+                    continue  # nested columns have no column statistics
+                s = column.get(COLUMN_STATISTICS, {})
+                low = s.get(STATISTICS_MIN_VALUE, s.get(STATISTICS_MIN))
+                high = s.get(STATISTICS_MAX_VALUE, s.get(STATISTICS_MAX))
+                if low is not None:
+                    low = decode_statistic(column.get(COLUMN_TYPE), low)
+                if high is not None:
+                    high = decode_statistic(column.get(COLUMN_TYPE), high)
+                nulls = s.get(STATISTICS_NULL_COUNT)
+                if path[0] not in stats:
+                    stats[path[0]] = {'nulls': nulls, 'min': low,
+                                      'max': high}
+                    continue
+                c = stats[path[0]]
+                c['nulls'] = (c['nulls'] + nulls
+                              if None not in (c['nulls'], nulls) else None)
+                c['min'] = (min(c['min'], low)
+                            if None not in (c['min'], low) else None)
+                c['max'] = (max(c['max'], high)
+                            if None not in (c['max'], high) else None)
+    return stats
+
+
+# layout
+
+def partition_layout(files):
+    """Group the part files of an edition by partition.
+
+    files are (relative name, size) pairs, as from eggo.dfs.list_files.
+    Returns (partition keys, {partition values: [(name, size)]}); with no
+    key=value directories, the keys are empty and there is one partition,
+    ().
+    """
+    parts = [(name, size) for (name, size) in files
+             if name.endswith('.parquet')]
+    layouts = set()
+    partitions = {}
+    for (name, size) in parts:
+        dirs = [d.split('=', 1) for d in name.split('/')[:-1] if '=' in d]
+        layouts.add(tuple(key for (key, _) in dirs))
+        partitions.setdefault(tuple(unquote(value) for (_, value) in dirs),
+                              []).append((name, size))
+    if len(layouts) > 1:
+        raise ValueError('Inconsistent partition directories: {0}'.format(
+            ', '.join('/'.join(keys) or '(none)' for keys in layouts)))
+    return (layouts.pop() if layouts else (), partitions)
+
+
+def _partition_types(keys, partitions):
+    # INT for keys whose values are all integers, STRING otherwise
+    return [(key, 'INT' if all(re.match(r'^-?\d+$', values[i])
+                               for values in partitions) else 'STRING')
+            for (i, key) in enumerate(keys)]
+
+
+# DDL
+
+def table_name(dataset, edition, database=None):
+    name = '`{0}_{1}`'.format(re.sub(r'\W', '_', dataset), edition)
+    return '`{0}`.{1}'.format(database, name) if database else name
+
+
+def _literal(value):
+    if isinstance(value, basestring):
+        return "'{0}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+    return repr(value)
+
+
+def _partition_spec(keys, values):
+    return 'PARTITION ({0})'.format(', '.join(
+        '`{0}`={1}'.format(key, _literal(value))
+        for (key, value) in zip(keys, values)))
+
+
+def _table_stats(target, rows, files, size, dialect):
+    props = [('numRows', rows), ('numFiles', files), ('totalSize', size)]
+    if dialect == 'impala':
+        # otherwise Impala ignores the row count
+        props.append(('STATS_GENERATED_VIA_STATS_TASK', 'true'))
+    return 'ALTER TABLE {0} SET TBLPROPERTIES ({1})'.format(
+        target, _properties(props))
+
+
+def _properties(props):
+    return ', '.join("'{0}'='{1}'".format(k, v) for (k, v) in props)
+
+
+def _column_stats(target, column, stats, dialect):
+    props = []
+    if stats['nulls'] is not None:
+        props.append(('numNulls', stats['nulls']))
+    if dialect == 'hive':
+        # Impala keeps no min/max column statistics
+        if stats['min'] is not None and stats['max'] is not None:
+            props.extend([('lowValue', stats['min']),
+                          ('highValue', stats['max'])])
+        template = ('ALTER TABLE {0} UPDATE STATISTICS FOR COLUMN `{1}` '
+                    'SET ({2})')
+    else:
+        template = 'ALTER TABLE {0} SET COLUMN STATS `{1}` ({2})'
+    if not props:
+        return None
+    return template.format(target, column, _properties(props))
+
+
+def _columns_stats(target, columns, footers, dialect):
+    stats = column_statistics(footers)
+    statements = [_column_stats(target, name, stats[name], dialect)
+                  for (name, _) in columns if name in stats]
+    return [s for s in statements if s is not None]
+
+
+def edition_ddl(table, url, files, footers, dialect='hive'):
+    """The statements that create and describe the table of one edition.
+
+    files are the (relative name, size) pairs under url, and footers maps
+    each part file name to its decoded footer.  Partitions get their own row
+    counts in the impala dialect, and their own column statistics in the hive
+    dialect (where column statistics are per partition).
+    """
+    if dialect not in dialects:
+        raise ValueError('Unknown dialect {0}; use one of {1}'.format(
+            dialect, ', '.join(dialects)))
+    (keys, partitions) = partition_layout(files)
+    if not partitions:
+        raise ValueError('No Parquet files under {0}'.format(url))
+    all_parts = sorted(p for parts in partitions.itervalues() for p in parts)
+    columns = [(name, type_) for (name, type_)
+               in table_columns(footers[all_parts[0][0]])
+               if name not in keys]
+    key_types = _partition_types(keys, partitions)
+    statements = ['DROP TABLE IF EXISTS {0}'.format(table)]
+    create = 'CREATE EXTERNAL TABLE {0} (\n{1}\n)'.format(
+        table, ',\n'.join('  `{0}` {1}'.format(name, type_)
+                          for (name, type_) in columns))
+    if keys:
+        create += '\nPARTITIONED BY ({0})'.format(', '.join(
+            '`{0}` {1}'.format(key, type_) for (key, type_) in key_types))
+    statements.append(create + "\nSTORED AS PARQUET\nLOCATION '{0}'".format(
+        url))
+
+    for values in sorted(partitions):
+        if not keys:
+            break
+        parts = partitions[values]
+        target = '{0} {1}'.format(table, _partition_spec(keys, [
+            int(v) if t == 'INT' else v
+            for (v, (_, t)) in zip(values, key_types)]))
+        statements.append(
+            "ALTER TABLE {0} ADD IF NOT EXISTS {1} LOCATION '{2}'".format(
+                table, target[len(table) + 1:],
+                os.path.join(url, os.path.dirname(parts[0][0]))))
+        if dialect == 'impala':
+            statements.append(_table_stats(
+                target, sum(num_rows(footers[name]) for (name, _) in parts),
+                len(parts), sum(size for (_, size) in parts), dialect))
+        else:
+            statements.extend(_columns_stats(
+                target, columns, [footers[name] for (name, _) in parts],
+                dialect))
+    statements.append(_table_stats(
+        table, sum(num_rows(footers[name]) for (name, _) in all_parts),
+        len(all_parts), sum(size for (_, size) in all_parts), dialect))
+    if not keys or dialect == 'impala':
+        statements.extend(_columns_stats(
+            table, columns, [footers[name] for (name, _) in all_parts],
+            dialect))
+    return statements
+
+
+def edition_url(config_data, edition, format='bdg'):
+    # the same layout as eggo.dag.ToastConfig.edition_url
+    return os.path.join(eggo_config.get('dfs', 'dfs_root_url'),
+                        config_data['name'], format, edition)
+
+
+def dataset_ddl(config_data, dialect='hive', database=None, threads=16):
+    """The DDL for every edition of the dataset of a toast config."""
+    statements = []
+    if database:
+        statements.append('CREATE DATABASE IF NOT EXISTS `{0}`'.format(
+            database))
+    for edition in edition_names(config_data):
+        url = edition_url(config_data, edition)
+        files = list_files(url)
+        statements.extend(edition_ddl(
+            table_name(config_data['name'], edition, database), url, files,
+            read_footers(url, files, threads), dialect))
+    return statements
+
+
+def format_ddl(statements):
+    return ''.join('{0};\n\n'.format(s) for s in statements)
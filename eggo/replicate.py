@@ -0,0 +1,142 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copy the editions of a toasted dataset to another filesystem.
+
+The editions come from the catalog (or, for datasets missing from it, a
+listing of the dataset directory), and keep their
+<dataset>/<format>/<edition> layout under the destination.  Files that are
+already at the destination with the same size (and, with verify='checksum',
+the same MD5 where both sides have one) are skipped, so an interrupted copy
+resumes where it stopped when it is run again.  Each edition's _SUCCESS and
+_COMMITTED flags are copied last, once the rest of the edition is in place.
+"""
+
+import os
+import sys
+import math
+import time
+from multiprocessing.pool import ThreadPool
+
+from eggo.config import eggo_config
+from eggo.catalog import load_catalog
+from eggo.dfs import CopyStats, list_files, copy_file, file_md5
+from eggo.compaction import STAGING_SUFFIXES
+
+
+# each copy worker is given about this many bytes
+BYTES_PER_WORKER = 256 * 1024 * 1024
+
+# how often (in seconds) progress is printed
+PROGRESS_INTERVAL = 30
+
+FLAG_FILES = ['_SUCCESS', '_COMMITTED']
+
+
+def dataset_editions(dataset):
+    """{'<format>/<edition>': url} for the editions of a toasted dataset."""
+    editions = load_catalog()['datasets'].get(dataset, {}).get('editions')
+    if editions:
+        return dict((name, e['url']) for (name, e) in editions.iteritems())
+    # not in the catalog: any <format>/<edition> directory with part files
+    root = os.path.join(eggo_config.get('dfs', 'dfs_root_url'), dataset)
+    names = set('/'.join(name.split('/')[:2]) for (name, _) in
+                list_files(root) if name.count('/') >= 2)
+    # the directories of a compaction in progress are not editions
+    names = [name for name in names if not name.endswith(STAGING_SUFFIXES)]
+    return dict((name, os.path.join(root, name)) for name in names)
+
+
+def copy_workers(total_bytes, files, max_workers):
+    """The number of parallel copies for a copy of total_bytes."""
+    workers = int(math.ceil(total_bytes / float(BYTES_PER_WORKER)))
+    return max(1, min(workers, files, max_workers))
+
+
+def _same(src, dst, verify):
+    if verify != 'checksum':
+        return True
+    dst_md5 = file_md5(dst)
+    return dst_md5 is None or dst_md5 == file_md5(src)
+
+
+def plan_copy(dataset, destination, editions=None, verify='size'):
+    """Return [(source url, destination url, size)] for the files to copy,
+    flags last, and (files, bytes) already at the destination."""
+    copies = []
+    flags = []
+    (skipped, skipped_bytes) = (0, 0)
+    for (name, url) in sorted(dataset_editions(dataset).iteritems()):
+        if editions and name not in editions and \
+                name.split('/')[-1] not in editions:
+            continue
+        dst_url = os.path.join(destination, dataset, name)
+        present = dict(list_files(dst_url))
+        for (file_name, size) in sorted(list_files(url)):
+            src = os.path.join(url, file_name)
+            dst = os.path.join(dst_url, file_name)
+            if present.get(file_name) == size and _same(src, dst, verify):
+                skipped += 1
+                skipped_bytes += size
+            elif file_name in FLAG_FILES:
+                flags.append((src, dst, size))
+            else:
+                copies.append((src, dst, size))
+    return (copies + flags, (skipped, skipped_bytes))
+
+
+def replicate(dataset, destination, editions=None, verify='size',
+              max_workers=32, hadoop_bin='hadoop'):
+    """Copy the editions (all, or the given '<format>/<edition>' or
+    '<edition>' names) of dataset to destination, an hdfs or file url, and
+    report the throughput.  Returns the CopyStats."""
+    (copies, (skipped, skipped_bytes)) = plan_copy(dataset, destination,
+                                                    editions, verify)
+    stats = CopyStats(destination)
+    stats.add(0, 0, skipped, skipped_bytes)
+    data = [c for c in copies if os.path.basename(c[1]) not in FLAG_FILES]
+    flags = [c for c in copies if os.path.basename(c[1]) in FLAG_FILES]
+    workers = copy_workers(sum(size for (_, _, size) in data), len(data),
+                           max_workers)
+    print 'Copying {0} files ({1} bytes) with {2} workers'.format(
+        len(copies), sum(size for (_, _, size) in copies), workers)
+    last_progress = time.time()
+
+    def copy(c):
+        (src, dst, size) = c
+        try:
+            copy_file(src, dst, hadoop_bin)
+            stats.add(1, size)
+        except Exception as e:
+            print >> sys.stderr, 'Failed to copy {0}: {1}'.format(src, e)
+            stats.add(0, 0, errors=1)
+
+    pool = ThreadPool(workers)
+    try:
+        for _ in pool.imap_unordered(copy, data):
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                print '{0} of {1} files, {2:.1f} MB/s'.format(
+                    stats.files, len(data), stats.bytes_per_sec() / 1e6)
+                last_progress = time.time()
+    finally:
+        pool.close()
+        pool.join()
+    if stats.errors == 0:
+        # only flag the editions as complete once all their files are in
+        for c in flags:
+            copy(c)
+    stats.report()
+    return stats
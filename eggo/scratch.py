@@ -0,0 +1,239 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Temporary directories striped across the local disks of a worker.
+
+worker_env.scratch_paths lists one directory per disk (by default, just
+worker_env.work_path).  Temporary directories go to the disks in turn,
+skipping those without room; when the size of the data is known up front,
+that much space is reserved, so that a large download fails before it starts
+rather than with ENOSPC at the end.  Once the data is on disk, statvfs counts
+it, so the reservation is shrunk to what may still be written.  Reservations
+are files under each scratch directory, so that they are shared by all the
+processes (e.g. Hadoop streaming mappers) on a worker, and a lock file
+serializes allocations.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+from shutil import rmtree
+from tempfile import mkdtemp
+from contextlib import contextmanager
+
+from eggo.config import eggo_config
+from eggo.error import ScratchSpaceError
+from eggo.util import ensure_dir
+
+
+# gunzipped genomics data can be this many times larger than the gzipped file
+GZIP_EXPANSION = 10
+
+# space that is never allocated on a disk
+MIN_FREE_BYTES = 1024 * 1024 * 1024
+
+RESERVATIONS_DIR = '.eggo_reservations'
+
+LOCK_FILE = '.eggo_scratch.lock'
+
+# the index of the scratch path the next allocation tries first
+NEXT_FILE = '.eggo_scratch.next'
+
+
+def scratch_paths():
+    """The scratch directories: worker_env.scratch_paths, or work_path."""
+    paths = []
+    if eggo_config.has_option('worker_env', 'scratch_paths'):
+        paths = [p.strip() for p in
+                 eggo_config.get('worker_env', 'scratch_paths').split(',')
+                 if p.strip()]
+    return paths or [eggo_config.get('worker_env', 'work_path')]
+
+
+def _free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _reservations(path):
+    # live reservations as (file name, reserved bytes); the reservations of
+    # processes that died without releasing them are removed
+    reservations_dir = os.path.join(path, RESERVATIONS_DIR)
+    if not os.path.isdir(reservations_dir):
+        return []
+    live = []
+    for name in os.listdir(reservations_dir):
+        reservation_path = os.path.join(reservations_dir, name)
+        try:
+            with open(reservation_path, 'r') as ip:
+                reservation = json.load(ip)
+        except (IOError, ValueError):
+            continue
+        if _pid_alive(reservation['pid']):
+            live.append((name, reservation['bytes']))
+        else:
+            os.remove(reservation_path)
+    return live
+
+
+def _available(path):
+    return (_free_bytes(path) - MIN_FREE_BYTES -
+            sum(size for (_, size) in _reservations(path)))
+
+
+@contextmanager
+def _allocation_lock():
+    lock_path = os.path.join(scratch_paths()[0], LOCK_FILE)
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _take_turn(paths):
+    # the scratch paths in the order this allocation tries them, starting
+    # after the one the previous allocation went to; under the lock
+    next_path = os.path.join(paths[0], NEXT_FILE)
+    try:
+        with open(next_path, 'r') as ip:
+            first = int(ip.read()) % len(paths)
+    except (IOError, ValueError):
+        first = 0
+    return paths[first:] + paths[:first]
+
+
+def _end_turn(paths, path):
+    with open(os.path.join(paths[0], NEXT_FILE), 'w') as op:
+        op.write(str((paths.index(path) + 1) % len(paths)))
+
+
+def allocate(size=None, prefix='tmp_eggo_'):
+    """Create a temporary directory on the next scratch disk in turn.
+
+    If size (in bytes) is given, it is reserved on that disk until shrink()
+    or release() is called, disks that cannot hold it are skipped, and
+    ScratchSpaceError is raised if none can.  Returns (directory, reservation
+    path).
+    """
+    paths = scratch_paths()
+    for path in paths:
+        ensure_dir(os.path.join(path, RESERVATIONS_DIR))
+    with _allocation_lock():
+        available = dict((path, _available(path)) for path in paths)
+        turn = _take_turn(paths)
+        fits = [p for p in turn if available[p] >= (size or 0)]
+        if not fits and size is not None:
+            raise ScratchSpaceError(
+                'No scratch disk has {0} bytes free: {1}'.format(
+                    size, ', '.join('{0} ({1} bytes)'.format(p, available[p])
+                                    for p in paths)))
+        path = (fits or turn)[0]
+        _end_turn(paths, path)
+        directory = mkdtemp(prefix=prefix, dir=path)
+        reservation_path = os.path.join(path, RESERVATIONS_DIR,
+                                        os.path.basename(directory))
+        with open(reservation_path, 'w') as op:
+            json.dump({'pid': os.getpid(), 'bytes': size or 0,
+                       'created': time.time()}, op)
+    print >> sys.stderr, (
+        'eggo scratch: allocated {0} ({1} bytes reserved, {2} bytes '
+        'available)'.format(directory, size or 0, available[path]))
+    return (directory, reservation_path)
+
+
+def _disk_usage(directory):
+    usage = 0
+    for (dirpath, _, filenames) in os.walk(directory):
+        for filename in filenames:
+            usage += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+    return usage
+
+
+def shrink(directory, reservation_path, remaining=None):
+    """Shrink the reservation of directory to the bytes that may still be
+    written to it: remaining, or by default the reservation less the space
+    that the files under directory now take (which the disk's free space
+    already counts)."""
+    with _allocation_lock():
+        try:
+            with open(reservation_path, 'r') as ip:
+                reservation = json.load(ip)
+        except (IOError, ValueError):
+            return
+        if remaining is None:
+            remaining = reservation['bytes'] - _disk_usage(directory)
+        reservation['bytes'] = max(0, min(reservation['bytes'], remaining))
+        with open(reservation_path, 'w') as op:
+            json.dump(reservation, op)
+
+
+def release(directory, reservation_path):
+    rmtree(directory, ignore_errors=True)
+    try:
+        os.remove(reservation_path)
+    except OSError:
+        pass
+
+
+@contextmanager
+def scratch_dir(size=None, prefix='tmp_eggo_'):
+    """A temporary directory from allocate() that is removed on exit."""
+    (directory, reservation_path) = allocate(size, prefix)
+    try:
+        yield directory
+    finally:
+        release(directory, reservation_path)
+
+
+def scratch_usage():
+    """Per-disk usage: a dict for each scratch path with its total, free and
+    reserved bytes and number of live allocations."""
+    usage = []
+    for path in scratch_paths():
+        st = os.statvfs(path)
+        reservations = _reservations(path)
+        usage.append({'path': path,
+                      'total': st.f_blocks * st.f_frsize,
+                      'free': st.f_bavail * st.f_frsize,
+                      'reserved': sum(size for (_, size) in reservations),
+                      'allocations': len(reservations)})
+    return usage
+
+
+def print_scratch_usage(usage):
+    row = '{path:<30}  {total:>15}  {free:>15}  {reserved:>15}  {allocs:>6}'
+    print row.format(path='path', total='total', free='free',
+                     reserved='reserved', allocs='allocs')
+    for u in usage:
+        print row.format(path=u['path'], total=u['total'], free=u['free'],
+                         reserved=u['reserved'], allocs=u['allocations'])
+
+
+if __name__ == '__main__':
+    print_scratch_usage(scratch_usage())
@@ -53,12 +53,13 @@ def get_master_host():
     return result.split('\n')[2].strip()
 
 
-def get_slave_hosts():
+def get_slave_hosts(master=None):
     def do():
         with prefix('source /root/spark-ec2/ec2-variables.sh'):
             result = run('echo $SLAVES').split()
         return result
-    master = get_master_host()
+    if master is None:
+        master = get_master_host()
     return execute(do, hosts=master)[master]
 
 
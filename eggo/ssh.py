@@ -0,0 +1,383 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent, multiplexed SSH sessions to the worker machines.
+
+Each host gets an OpenSSH ControlMaster, which outlives the eggo command that
+opened it (for ssh_control_persist seconds of idleness).  run(), sudo(), put()
+and exists() stand in for Fabric's: they send the command Fabric would run
+(with the cd, prefix, shell_env and path contexts applied) through the
+master's control socket with ssh -S, so each command costs a new channel on
+the existing connection rather than a TCP connection and an SSH handshake.
+Fabric itself speaks SSH through paramiko, which cannot share control
+sockets, so whatever still goes through Fabric (e.g. open_shell) is pointed
+at a generated ssh_config whose ProxyCommand tunnels through the master with
+ssh -W; that saves the TCP connection and the outer handshake, but paramiko
+still makes its own handshake inside the tunnel.
+"""
+
+import os
+import json
+from threading import Thread, Timer
+from subprocess import Popen, PIPE, STDOUT, call
+from multiprocessing.pool import ThreadPool
+
+import fabric.api
+import fabric.contrib.files
+from fabric.api import env
+from fabric.state import output
+from fabric.utils import error
+from fabric.exceptions import CommandTimeout
+
+from eggo.config import eggo_config
+from eggo.util import ensure_dir
+
+
+exec_ctx = eggo_config.get('execution', 'context')
+
+
+def state_path():
+    return os.path.expanduser(eggo_config.get('client_env', 'state_path'))
+
+
+def control_dir():
+    return os.path.join(state_path(), 'ssh')
+
+
+def enabled():
+    return exec_ctx in ['spark_ec2', 'director']
+
+
+def ssh_user():
+    return eggo_config.get(exec_ctx, 'user')
+
+
+def _master_options():
+    return ['-i', eggo_config.get('aws', 'ec2_private_key_file'),
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=ERROR',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPersist={0}'.format(
+                eggo_config.get('client_env', 'ssh_control_persist'))]
+
+
+def ssh_options():
+    # %r, %h and %p are expanded by ssh (or by paramiko, in the ProxyCommand)
+    return _master_options() + [
+        '-o', 'ControlPath={0}/%r@%h:%p'.format(control_dir())]
+
+
+def control_socket(host, user=None, port=22):
+    """The path of the control socket of the master session to host."""
+    return os.path.join(control_dir(), '{0}@{1}:{2}'.format(
+        user or ssh_user(), host, port))
+
+
+def ssh_command(host, user=None):
+    """Return an ssh command line (as a string) that reuses the session."""
+    return 'ssh {opts} {user}@{host}'.format(
+        opts=' '.join(ssh_options()), user=user or ssh_user(), host=host)
+
+
+def configure_fabric():
+    """Route all of Fabric's connections through the multiplexed sessions."""
+    if not enabled():
+        return
+    ensure_dir(control_dir())
+    ssh_config_path = os.path.join(control_dir(), 'ssh_config')
+    proxy_command = 'ssh {opts} -W 127.0.0.1:%p -l %r %h'.format(
+        opts=' '.join(ssh_options()))
+    with open(ssh_config_path, 'w') as op:
+        op.write('Host *\n    ProxyCommand {0}\n'.format(proxy_command))
+    env.use_ssh_config = True
+    env.ssh_config_path = ssh_config_path
+
+
+# commands over the control sockets
+
+# the chunks put() streams a file in
+PUT_CHUNK_SIZE = 1024 * 1024
+
+
+class CommandResult(str):
+    """The output of a command, with the attributes of Fabric's results
+    (return_code, failed, succeeded, ...)."""
+
+    @property
+    def stdout(self):
+        return str(self)
+
+
+def _shell_escape(command):
+    # for the inside of a double-quoted shell string
+    for char in ('"', '$', '`'):
+        command = command.replace(char, '\\' + char)
+    return command
+
+
+def _sudo_prefix(user):
+    prefix = env.sudo_prefix % env
+    if user is None:
+        return prefix
+    if str(user).isdigit():
+        user = '#{0}'.format(user)
+    return '{0} -u "{1}" '.format(prefix, user)
+
+
+def remote_command(command, sudo=False, user=None, shell=True):
+    """The command line Fabric's run() or sudo() would send for command: it
+    applies the cd, prefix, path and shell_env contexts and env.shell."""
+    prefixes = list(env.command_prefixes)
+    if env.cwd:
+        prefixes.insert(0, 'cd {0} >/dev/null'.format(env.cwd))
+    command = ''.join(p + ' && ' for p in prefixes) + command
+    env_vars = dict(env.shell_env)
+    if env.path:
+        env_vars['PATH'] = {
+            'append': '$PATH:"{0}"', 'prepend': '"{0}":$PATH',
+            'replace': '"{0}"'}[env.path_behavior].format(env.path)
+    if env_vars:
+        command = 'export {0} && {1}'.format(' '.join(
+            '{0}="{1}"'.format(k, v if k == 'PATH' else _shell_escape(v))
+            for (k, v) in env_vars.iteritems()), command)
+    return _shell_wrap(command, sudo, user, shell)
+
+
+def _shell_wrap(command, sudo=False, user=None, shell=True):
+    if shell and env.use_shell:
+        command = '{0} "{1}"'.format(
+            env.shell, _shell_escape(command) if env.get('shell_escape', True)
+            else command)
+    return (_sudo_prefix(user) + ' ' if sudo else '') + command
+
+
+def _ssh(command, pty):
+    # the ssh command line that runs command on the current Fabric host; if
+    # its master has gone away, ssh opens a new one at the same socket
+    return (['ssh'] + _master_options() +
+            ['-S', control_socket(env.host, env.user, env.port or 22)] +
+            (['-t', '-t'] if pty else ['-T']) +
+            ['{0}@{1}'.format(env.user, env.host), command])
+
+
+def _feed(stdin, source):
+    # stream source (a file-like object) to stdin in chunks
+    try:
+        for chunk in iter(lambda: source.read(PUT_CHUNK_SIZE), ''):
+            stdin.write(chunk)
+    except IOError:
+        # the command exited without reading all of it; its status says why
+        pass
+    finally:
+        try:
+            stdin.close()
+        except IOError:
+            pass
+
+
+def _communicate(args, source=None, echo=True, timeout=None):
+    # run args with source (a file-like object, or None for no input) as its
+    # input, echoing its output as Fabric does; returns (output, status)
+    p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+    timer = Timer(timeout, p.kill) if timeout else None
+    if timer is not None:
+        timer.start()
+    # fed from a thread, so that a command that writes while it reads cannot
+    # block on a full pipe
+    feeder = None
+    if source is None:
+        p.stdin.close()
+    else:
+        feeder = Thread(target=_feed, args=(p.stdin, source))
+        feeder.daemon = True
+        feeder.start()
+    try:
+        lines = []
+        for line in iter(p.stdout.readline, ''):
+            # a pty ends its lines with \r\n
+            line = line.rstrip('\r\n')
+            if echo and output.stdout:
+                print '[{0}] out: {1}'.format(env.host_string, line)
+            lines.append(line)
+        status = p.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        # e.g. after the fleet's per-host deadline interrupted the command
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        if feeder is not None:
+            feeder.join()
+    if timer is not None and status == -9:
+        raise CommandTimeout(timeout)
+    return ('\n'.join(lines), status)
+
+
+def _run_command(command, sudo=False, user=None, shell=True, pty=True,
+                 warn_only=False, quiet=False):
+    wrapped = remote_command(command, sudo=sudo, user=user, shell=shell)
+    which = 'sudo' if sudo else 'run'
+    if output.running and not quiet:
+        print '[{0}] {1}: {2}'.format(env.host_string, which, command)
+    (stdout, status) = _communicate(_ssh(wrapped, pty), echo=not quiet,
+                                    timeout=env.command_timeout)
+    out = CommandResult(stdout)
+    out.command = command
+    out.real_command = wrapped
+    out.return_code = status
+    out.failed = status not in env.ok_ret_codes
+    out.succeeded = not out.failed
+    out.stderr = ''
+    if out.failed and not (warn_only or quiet or env.warn_only):
+        error('{0}() received nonzero return code {1} while executing!\n\n'
+              'Requested: {2}\nExecuted: {3}'.format(which, status, command,
+                                                     wrapped), stdout=out)
+    return out
+
+
+def run(command, shell=True, pty=True, warn_only=False, quiet=False):
+    """Like fabric.api.run, through the host's control socket."""
+    if not enabled():
+        return fabric.api.run(command, shell=shell, pty=pty,
+                              warn_only=warn_only, quiet=quiet)
+    return _run_command(command, shell=shell, pty=pty, warn_only=warn_only,
+                        quiet=quiet)
+
+
+def sudo(command, shell=True, pty=True, user=None, warn_only=False,
+         quiet=False):
+    """Like fabric.api.sudo, through the host's control socket."""
+    if not enabled():
+        return fabric.api.sudo(command, shell=shell, pty=pty, user=user,
+                               warn_only=warn_only, quiet=quiet)
+    return _run_command(command, sudo=True, user=user, shell=shell, pty=pty,
+                        warn_only=warn_only, quiet=quiet)
+
+
+def put(local_path, remote_path, use_sudo=False):
+    """Like fabric.api.put of a single file (a local path or a file-like
+    object) to a remote file path, streamed through the host's control
+    socket."""
+    if not enabled():
+        return fabric.api.put(local_path=local_path, remote_path=remote_path,
+                              use_sudo=use_sudo)
+    # without the cd and prefix contexts, as with Fabric's put
+    command = _shell_wrap('cat > {0}'.format(remote_path), sudo=use_sudo)
+    if output.running:
+        print '[{0}] put: {1}'.format(env.host_string, remote_path)
+    if hasattr(local_path, 'read'):
+        (stdout, status) = _communicate(_ssh(command, False), local_path,
+                                        timeout=env.command_timeout)
+    else:
+        with open(os.path.expanduser(local_path), 'rb') as ip:
+            (stdout, status) = _communicate(_ssh(command, False), ip,
+                                            timeout=env.command_timeout)
+    if status != 0:
+        error('put() to {0} received nonzero return code {1}'.format(
+            remote_path, status), stdout=stdout)
+    return [remote_path]
+
+
+def exists(path, use_sudo=False):
+    """Like fabric.contrib.files.exists, through the host's control socket."""
+    if not enabled():
+        return fabric.contrib.files.exists(path, use_sudo=use_sudo)
+    func = sudo if use_sudo else run
+    return func('test -e "$(echo {0})"'.format(path), quiet=True).succeeded
+
+
+def _is_alive(host):
+    cmd = ['ssh'] + ssh_options() + ['-O', 'check',
+                                     '{0}@{1}'.format(ssh_user(), host)]
+    with open(os.devnull, 'w') as devnull:
+        return call(cmd, stdout=devnull, stderr=devnull) == 0
+
+
+def _open(host):
+    if _is_alive(host):
+        return (host, 'reused')
+    # -f backgrounds ssh once it has authenticated; -N runs no command, so the
+    # process only serves as the control master
+    cmd = (['ssh'] + ssh_options() +
+           ['-o', 'ControlMaster=yes', '-f', '-N',
+            '{0}@{1}'.format(ssh_user(), host)])
+    with open(os.devnull, 'w') as devnull:
+        if call(cmd, stdout=devnull, stderr=devnull) != 0:
+            return (host, 'failed')
+    return (host, 'opened')
+
+
+def _stats_path():
+    return os.path.join(control_dir(), 'stats.json')
+
+
+def load_stats():
+    if not os.path.exists(_stats_path()):
+        return {}
+    with open(_stats_path(), 'r') as ip:
+        return json.load(ip)
+
+
+def open_sessions(hosts):
+    """Ensure a live control master exists for each host, in parallel.
+
+    Existing masters (e.g., left open by a previous eggo command) are reused.
+    Per-host counts of opened and reused sessions are recorded for
+    print_session_stats().
+    """
+    if not enabled() or not hosts:
+        return {}
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+    ensure_dir(control_dir())
+    pool = ThreadPool(min(len(hosts),
+                          eggo_config.getint('execution', 'fleet_pool_size')))
+    try:
+        outcomes = dict(pool.map(_open, hosts))
+    finally:
+        pool.close()
+    stats = load_stats()
+    for (host, outcome) in outcomes.iteritems():
+        counts = stats.setdefault(host, {'opened': 0, 'reused': 0,
+                                         'failed': 0})
+        counts[outcome] += 1
+    with open(_stats_path(), 'w') as op:
+        json.dump(stats, op, indent=2)
+    return outcomes
+
+
+def close_sessions():
+    stats = load_stats()
+    for host in stats:
+        cmd = ['ssh'] + ssh_options() + ['-O', 'exit',
+                                         '{0}@{1}'.format(ssh_user(), host)]
+        with open(os.devnull, 'w') as devnull:
+            call(cmd, stdout=devnull, stderr=devnull)
+    if os.path.exists(_stats_path()):
+        os.remove(_stats_path())
+
+
+def print_session_stats():
+    stats = load_stats()
+    row = '{host:<40}  {alive:<5}  {opened:>6}  {reused:>6}  {failed:>6}'
+    print row.format(host='host', alive='alive', opened='opened',
+                     reused='reused', failed='failed')
+    for host in sorted(stats):
+        counts = stats[host]
+        print row.format(host=host, alive='yes' if _is_alive(host) else 'no',
+                         **counts)
@@ -0,0 +1,368 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resumable HTTP/FTP downloads with stall detection and classified retries.
+
+A failed attempt is retried with exponential backoff if its error is
+transient (a socket error or timeout, a stall, a connection closed early, an
+HTTP 5xx/408/429 or an FTP 4xx reply), and the next attempt resumes from the
+bytes already on disk with a ranged request.  An HTTP resume is conditional
+on the ETag recorded by the preflight (If-Range), so a source that changed
+since is downloaded again from the start.  Any other error (e.g. an HTTP 404,
+an FTP 5xx reply, or a full disk) is permanent and fails immediately.  A source on a local or mounted filesystem
+(a file:// url or an absolute path) is copied instead, with
+eggo.fastcopy.  A stall is a transfer that averages less
+than a minimum rate over a window of time.  Every attempt is logged to
+stderr, which ends up in the task log.
+"""
+
+import os
+import sys
+import time
+import random
+import hashlib
+import socket
+import httplib
+import urllib2
+from ftplib import FTP, error_temp, all_errors as ftp_errors
+from shutil import move
+from urlparse import urlparse
+
+from eggo.config import eggo_config
+from eggo.error import TransferError
+from eggo.fastcopy import copy_file
+from eggo.progress import Progress
+from eggo.scratch import scratch_paths
+from eggo.util import local_path
+
+
+# reads block until this much arrives, so it bounds how late a stall (at
+# rates above chunk size / stall window) is noticed
+CHUNK_SIZE = 64 * 1024
+
+# partial downloads kept under each scratch path for a later task attempt
+PARTIAL_DIR = '.eggo_partial'
+
+# kept partial downloads older than this are deleted, as is the preflight
+# that they would be resumed against
+PARTIAL_MAX_AGE = 24 * 60 * 60  # seconds
+
+
+class StallError(Exception):
+    pass
+
+
+def _in_hadoop_streaming():
+    return 'mapred_task_id' in os.environ or 'mapreduce_task_id' in os.environ
+
+
+def log(message):
+    print >> sys.stderr, 'eggo transfer: {0}'.format(message)
+    if _in_hadoop_streaming():
+        # a status update also tells Hadoop that the task is making progress
+        print >> sys.stderr, 'reporter:status:{0}'.format(message)
+
+
+def is_transient(error):
+    """Whether an error is worth retrying: a network error, not e.g. a
+    missing file or a full disk."""
+    if isinstance(error, TransferError):
+        return error.transient
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code in (408, 429)
+    if isinstance(error, urllib2.URLError):
+        # e.g. connection refused or a DNS failure, but not an unknown scheme
+        return isinstance(error.reason, (socket.error, socket.timeout))
+    # socket.error is an IOError, but other IOErrors (e.g. ENOSPC or EIO of
+    # the partial file) are not transient; EOFError is a connection closed
+    # before the whole file arrived, and HTTPException e.g. an IncompleteRead
+    return isinstance(error, (StallError, socket.error, socket.timeout,
+                              httplib.HTTPException, error_temp, EOFError))
+
+
+def backoff(attempt, base=2.0, cap=300.0):
+    """Seconds to wait before retry number attempt (1, 2, ...), with jitter."""
+    return random.uniform(0.5, 1.0) * min(cap, base * 2 ** (attempt - 1))
+
+
+def retry(func, description, max_attempts=8):
+    """Call func until it succeeds, retrying transient errors with backoff."""
+    for attempt in xrange(1, max_attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if not is_transient(e) or attempt == max_attempts:
+                raise
+            wait = backoff(attempt)
+            log('{0}: attempt {1} failed ({2}: {3}); retrying in '
+                '{4:.0f}s'.format(description, attempt, type(e).__name__, e,
+                                  wait))
+            time.sleep(wait)
+
+
+class Watchdog(object):
+    """Raise StallError if fewer than min_rate bytes/s arrive over any window
+    of stall_seconds."""
+
+    def __init__(self, min_rate, stall_seconds):
+        self.min_rate = min_rate
+        self.stall_seconds = stall_seconds
+        self.window_start = time.time()
+        self.window_bytes = 0
+
+    def update(self, nbytes):
+        self.window_bytes += nbytes
+        elapsed = time.time() - self.window_start
+        if elapsed >= self.stall_seconds:
+            if self.window_bytes < self.min_rate * elapsed:
+                raise StallError(
+                    'only {0} bytes in the last {1:.0f}s'.format(
+                        self.window_bytes, elapsed))
+            self.window_start = time.time()
+            self.window_bytes = 0
+
+
+def _strong_etag(etag):
+    # If-Range takes only a strong HTTP ETag; the preflight records FTP and
+    # local modification times in the same field
+    return etag is not None and etag.startswith('"')
+
+
+def _open_http(url, offset, timeout, etag):
+    # returns (read, close, the offset the data starts at)
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes={0}-'.format(offset)
+        if _strong_etag(etag):
+            # the whole file (a 200) unless it is still the one probed
+            headers['If-Range'] = etag
+    response = urllib2.urlopen(urllib2.Request(url, headers=headers),
+                               timeout=timeout)
+    if offset and response.getcode() != 206:
+        log('{0}: the source changed or the server ignored the range '
+            'request; restarting'.format(url))
+        offset = 0
+    return (response.read, response.close, offset)
+
+
+def ftp_connect(url, timeout):
+    """A logged-in binary-mode FTP session with the server of an ftp url."""
+    parsed = urlparse(url)
+    ftp = FTP(timeout=timeout)
+    try:
+        ftp.connect(parsed.hostname, parsed.port or 21)
+        ftp.login(parsed.username or 'anonymous', parsed.password or '')
+        ftp.voidcmd('TYPE I')
+    except:
+        ftp.close()
+        raise
+    return ftp
+
+
+def ftp_finish(ftp, conn, url):
+    """Close the data connection of a transfer that was read to its end and
+    check the server's final reply, which is where e.g. an aborted transfer
+    is reported."""
+    conn.close()
+    try:
+        ftp.voidresp()
+    except ftp_errors as e:
+        raise TransferError('{0}: transfer failed: {1}: {2}'.format(
+            url, type(e).__name__, e), transient=is_transient(e))
+
+
+def _open_ftp(url, offset, timeout, etag):
+    ftp = ftp_connect(url, timeout)
+    try:
+        conn = ftp.transfercmd('RETR ' + urlparse(url).path,
+                               rest=offset or None)
+    except:
+        ftp.close()
+        raise
+    finished = [False]
+
+    def read(size):
+        data = conn.recv(size)
+        finished[0] = not data
+        return data
+
+    def close():
+        try:
+            if finished[0]:
+                ftp_finish(ftp, conn, url)
+            else:
+                conn.close()
+        finally:
+            ftp.close()
+
+    return (read, close, offset)
+
+
+def _attempt(url, path, size, timeout, watchdog_args, progress, etag):
+    # download the rest of url into path; returns the bytes transferred
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    if size is not None and offset >= size:
+        return 0
+    opener = _open_ftp if url.startswith('ftp:') else _open_http
+    (read, close, offset) = opener(url, offset, timeout, etag)
+    watchdog = Watchdog(*watchdog_args)
+    transferred = 0
+    try:
+        with open(path, 'ab' if offset else 'wb') as op:
+            while True:
+                chunk = read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                op.write(chunk)
+                transferred += len(chunk)
+                watchdog.update(len(chunk))
+                progress.set(offset + transferred)
+    finally:
+        close()
+    if size is not None and offset + transferred < size:
+        raise EOFError('connection closed after {0} of {1} bytes'.format(
+            offset + transferred, size))
+    return transferred
+
+
+def download(url, path, size=None, max_attempts=8, min_rate=64 * 1024,
+             stall_seconds=120, timeout=60, etag=None):
+    """Download url to path, resuming from whatever is already at path if
+    the source still has the given etag (or if no strong HTTP ETag is
+    known).
+
+    Returns a list of per-attempt statistics (dicts); raises TransferError
+    on a permanent error or when max_attempts attempts have failed.
+    """
+    attempts = []
+    progress = Progress(url, 'download', size)
+    for attempt in xrange(1, max_attempts + 1):
+        start = time.time()
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        stats = {'attempt': attempt, 'offset': offset, 'bytes': 0,
+                 'error': None}
+        try:
+            stats['bytes'] = _attempt(url, path, size, timeout,
+                                      (min_rate, stall_seconds), progress,
+                                      etag)
+        except Exception as e:
+            stats['error'] = '{0}: {1}'.format(type(e).__name__, e)
+            if isinstance(e, urllib2.HTTPError) and e.code == 416:
+                # the partial file is not a prefix of the remote one
+                os.remove(path)
+            transient = is_transient(e) or isinstance(e, urllib2.HTTPError) \
+                and e.code == 416
+        stats['seconds'] = time.time() - start
+        # bytes that made it to disk before an error count too
+        if stats['error'] is not None and os.path.exists(path):
+            stats['bytes'] = max(0, os.path.getsize(path) - offset)
+        stats['rate'] = stats['bytes'] / max(stats['seconds'], 1e-3)
+        attempts.append(stats)
+        log('{url}: attempt {attempt} from byte {offset}: {bytes} bytes in '
+            '{seconds:.1f}s ({rate:.0f} B/s){outcome}'.format(
+                url=url, outcome=', ' + stats['error'] if stats['error']
+                else '', **stats))
+        if stats['error'] is None:
+            progress.finish()
+            return attempts
+        if not transient:
+            raise TransferError('{0}: permanent error: {1}'.format(
+                url, stats['error']), transient=False)
+        if attempt < max_attempts:
+            time.sleep(backoff(attempt))
+    raise TransferError('{0}: giving up after {1} attempts: {2}'.format(
+        url, max_attempts, attempts[-1]['error']), transient=True)
+
+
+def _partial_name(url):
+    return hashlib.md5(url).hexdigest()
+
+
+def stash_partial(url, path):
+    """Keep the partial download at path (in a scratch directory) so that a
+    later attempt, e.g. a retry of the task, can resume it."""
+    if not os.path.exists(path):
+        return
+    stash_dir = os.path.join(os.path.dirname(os.path.dirname(path)),
+                             PARTIAL_DIR)
+    if not os.path.isdir(stash_dir):
+        os.makedirs(stash_dir)
+    os.rename(path, os.path.join(stash_dir, _partial_name(url)))
+    log('{0}: kept {1} bytes for resuming'.format(
+        url, os.path.getsize(os.path.join(stash_dir, _partial_name(url)))))
+
+
+def prune_partials(max_age=PARTIAL_MAX_AGE):
+    """Delete the partial downloads that were kept longer than max_age
+    seconds, e.g. those of toasts that were never retried."""
+    for scratch_path in scratch_paths():
+        stash_dir = os.path.join(scratch_path, PARTIAL_DIR)
+        if not os.path.isdir(stash_dir):
+            continue
+        for name in os.listdir(stash_dir):
+            stashed = os.path.join(stash_dir, name)
+            try:
+                if time.time() - os.path.getmtime(stashed) > max_age:
+                    os.remove(stashed)
+            except OSError:
+                pass  # claimed or pruned concurrently
+
+
+def claim_partial(url, path):
+    """Move a stashed partial download of url to path, if there is one, and
+    delete any other (older) ones."""
+    claimed = False
+    for scratch_path in scratch_paths():
+        stashed = os.path.join(scratch_path, PARTIAL_DIR, _partial_name(url))
+        if not os.path.exists(stashed):
+            continue
+        if claimed:
+            os.remove(stashed)
+            continue
+        move(stashed, path)
+        claimed = True
+        log('{0}: resuming from {1} bytes kept by an earlier '
+            'attempt'.format(url, os.path.getsize(path)))
+
+
+def download_source(url, path, size=None, etag=None):
+    """download() with the retry settings of the execution config section,
+    resuming a partial download stashed by an earlier task attempt and
+    stashing this one if it fails with a transient error; stashes older than
+    PARTIAL_MAX_AGE are deleted.  A local source is copied instead."""
+    if local_path(url) is not None:
+        progress = Progress(url, 'download', os.path.getsize(local_path(url)))
+        method = copy_file(local_path(url), path, progress)
+        progress.finish()
+        log('{0}: copied with {1}'.format(url, method))
+        return []
+    prune_partials()
+    claim_partial(url, path)
+    try:
+        return download(
+            url, path, size, etag=etag,
+            max_attempts=eggo_config.getint('execution',
+                                            'download_max_attempts'),
+            min_rate=eggo_config.getint('execution',
+                                        'download_min_rate_kb') * 1024,
+            stall_seconds=eggo_config.getint('execution',
+                                             'download_stall_seconds'))
+    except TransferError as e:
+        if e.transient:
+            stash_partial(url, path)
+        elif os.path.exists(path):
+            os.remove(path)
+        raise
@@ -19,6 +19,8 @@ import re
 import random
 import string
 from hashlib import md5
+from urllib import unquote
+from urlparse import urlparse
 from datetime import datetime
 
 
@@ -50,6 +52,17 @@ def build_dest_filename(source_uri, decompress=False):
     return filename
 
 
+def local_path(url):
+    """The path of a source on a local or mounted (e.g. NFS) filesystem, given
+    as a file:// url or an absolute path, or None for a remote source."""
+    if url.startswith('/'):
+        return url
+    parsed = urlparse(url)
+    if parsed.scheme == 'file' and parsed.netloc in ['', 'localhost']:
+        return unquote(parsed.path)
+    return None
+
+
 def ensure_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
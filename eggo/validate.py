@@ -0,0 +1,237 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checking the row counts of toasted editions against their raw data.
+
+The raw files of a toast are streamed once, in large chunks, and the rows
+their conversion must produce are counted without parsing records: whole
+chunks of text are scanned with str.count and a regular expression, BAM
+records are skipped by their length prefix, and the BGZF blocks of each
+compressed chunk are inflated in parallel (zlib releases the GIL).  An
+edition's rows come from its index, or else from its Parquet footers, so no
+converted data is read back.
+
+The rows expected of a source depend on its format:
+
+* VCF: vcf2adam writes a genotype per sample for each ALT allele of a
+  record (multi-allelic sites are split), so a file with S samples and A
+  ALT alleles in all yields S * A rows; records without an ALT allele (".")
+  yield none.
+* SAM and BAM: a row per alignment record.
+"""
+
+import re
+import struct
+from itertools import chain
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from eggo.bgzf import is_bgzf, block_spans, inflate_block
+from eggo.dfs import open_read, list_files
+from eggo.index import load_index
+from eggo.parquet import read_footers, num_rows
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# raw files counted at once; each inflates its blocks on a shared pool
+FILE_THREADS = 4
+
+# the ALT field of each VCF record (not header) line
+_VCF_ALT = re.compile(r'^(?!#)(?:[^\t\n]*\t){4}([^\t\n]*)', re.M)
+
+_VCF_CHROM_LINE = re.compile(r'^#CHROM\t[^\n]*', re.M)
+
+BAM_MAGIC = 'BAM\x01'
+
+
+class _TextCounter(object):
+    # feeds the complete lines of a stream to count_lines
+
+    def __init__(self):
+        self.rows = 0
+        self.records = 0
+        self._partial = ''
+
+    def feed(self, data):
+        end = data.rfind('\n') + 1
+        if end == 0:
+            self._partial += data
+            return
+        self.count_lines(self._partial + data[:end])
+        self._partial = data[end:]
+
+    def close(self):
+        if self._partial:
+            self.count_lines(self._partial + '\n')
+            self._partial = ''
+
+
+class VcfCounter(_TextCounter):
+    """Counts the genotypes that vcf2adam makes of a VCF stream."""
+
+    def __init__(self):
+        super(VcfCounter, self).__init__()
+        self.samples = None
+        self.alleles = 0
+
+    def count_lines(self, text):
+        if self.samples is None:
+            m = _VCF_CHROM_LINE.search(text)
+            if m is not None:
+                # CHROM POS ID REF ALT QUAL FILTER INFO FORMAT sample...
+                self.samples = max(0, len(m.group(0).split('\t')) - 9)
+        alts = _VCF_ALT.findall(text)
+        # each record has one more allele than commas in its ALT, and none
+        # if its ALT is "."
+        self.records += len(alts)
+        self.alleles += (len(alts) + '\t'.join(alts).count(',') -
+                         alts.count('.'))
+        self.rows = (self.samples or 0) * self.alleles
+
+
+class SamCounter(_TextCounter):
+    """Counts the alignment records of a SAM stream."""
+
+    def count_lines(self, text):
+        # text starts at a line start, so each line but the first follows a
+        # newline; headers start with @
+        lines = text.count('\n')
+        headers = text.count('\n@') + text.startswith('@')
+        blanks = text.count('\n\n') + text.startswith('\n')
+        self.records += lines - headers - blanks
+        self.rows = self.records
+
+
+def _bam_header_end(data):
+    # the offset of the first alignment record, or None if the header is not
+    # all in data
+    if len(data) < 8:
+        return None
+    if data[:4] != BAM_MAGIC:
+        raise ValueError('Not a BAM file')
+    (l_text,) = struct.unpack_from('<i', data, 4)
+    pos = 8 + l_text
+    if pos + 4 > len(data):
+        return None
+    (n_ref,) = struct.unpack_from('<i', data, pos)
+    pos += 4
+    for _ in xrange(n_ref):
+        if pos + 4 > len(data):
+            return None
+        (l_name,) = struct.unpack_from('<i', data, pos)
+        pos += 4 + l_name + 4
+    return pos if pos <= len(data) else None
+
+
+class BamCounter(object):
+    """Counts the alignment records of a (decompressed) BAM stream."""
+
+    def __init__(self):
+        self.rows = 0
+        self.records = 0
+        self._buffer = ''
+        self._in_header = True
+
+    def feed(self, data):
+        data = self._buffer + data
+        pos = 0
+        if self._in_header:
+            pos = _bam_header_end(data)
+            if pos is None:
+                self._buffer = data
+                return
+            self._in_header = False
+        # each record is its int32 block_size and then that many bytes
+        (size, unpack, records) = (len(data), struct.unpack_from, 0)
+        while pos + 4 <= size:
+            end = pos + 4 + unpack('<i', data, pos)[0]
+            if end > size:
+                break
+            pos = end
+            records += 1
+        self.records += records
+        self.rows = self.records
+        self._buffer = data[pos:]
+
+    def close(self):
+        if self._in_header or self._buffer:
+            raise ValueError('Truncated BAM file')
+
+
+COUNTERS = {'vcf': VcfCounter, 'sam': SamCounter, 'bam': BamCounter}
+
+
+def _inflated_chunks(chunks, pool):
+    # the decompressed data of a BGZF stream, a chunk at a time, with the
+    # blocks of each chunk inflated on pool
+    pending = ''
+    for chunk in chunks:
+        data = pending + chunk
+        blocks = [data[start:end] for (start, end) in block_spans(data)]
+        pending = data[sum(len(b) for b in blocks):]
+        yield ''.join(pool.map(inflate_block, blocks, chunksize=16))
+    if pending:
+        raise ValueError('Truncated BGZF block')
+
+
+def count_records(url, format, pool, hadoop_bin='hadoop',
+                  chunk_size=CHUNK_SIZE):
+    """Count the records of the raw file at url (plain or BGZF-compressed);
+    returns its counter, whose rows are those expected of its conversion."""
+    counter = COUNTERS[format]()
+    reader = open_read(url, hadoop_bin=hadoop_bin)
+    try:
+        head = reader.read(chunk_size)
+        chunks = chain([head], iter(lambda: reader.read(chunk_size), ''))
+        if is_bgzf(head):
+            chunks = _inflated_chunks(chunks, pool)
+        elif format == 'bam':
+            raise ValueError('{0} is not BGZF-compressed'.format(url))
+        for data in chunks:
+            counter.feed(data)
+    finally:
+        reader.close()
+    counter.close()
+    return counter
+
+
+def count_raw_files(files, hadoop_bin='hadoop', threads=None):
+    """Count the records of raw files, given as {url: format}.
+
+    Returns {url: {'records': records, 'rows': rows expected}}.
+    """
+    pool = ThreadPool(threads or cpu_count())
+    file_pool = ThreadPool(max(1, min(FILE_THREADS, len(files))))
+    try:
+        urls = sorted(files)
+        counters = file_pool.map(
+            lambda url: count_records(url, files[url], pool, hadoop_bin),
+            urls)
+    finally:
+        file_pool.close()
+        pool.close()
+    return dict((url, {'records': c.records, 'rows': c.rows})
+                for (url, c) in zip(urls, counters))
+
+
+def edition_rows(url, hadoop_bin='hadoop'):
+    """The rows of the edition at url, from its index or its footers."""
+    index = load_index(url, hadoop_bin=hadoop_bin)
+    if index is not None:
+        return sum(entry['rows'] for entry in index['files'])
+    footers = read_footers(url, list_files(url, hadoop_bin=hadoop_bin))
+    return sum(num_rows(footer) for footer in footers.itervalues())
@@ -0,0 +1,275 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-process HDFS client over the WebHDFS (or HttpFS) REST API.
+
+With dfs.hdfs_backend set to webhdfs, eggo.dfs sends its hdfs:// operations
+here instead of starting a hadoop CLI JVM for each one.  Requests go over
+HTTP connections that are kept open and reused (per host, across threads),
+so metadata operations take milliseconds, and file data is streamed in
+chunks.  Reads and writes follow the namenode's redirect to a datanode (or,
+with HttpFS, to itself).
+"""
+
+import json
+import socket
+import httplib
+import threading
+from getpass import getuser
+from urllib import urlencode, quote
+from urlparse import urlparse
+
+from eggo.config import eggo_config
+from eggo.error import WebHdfsError
+
+
+# the default WebHDFS port of a namenode
+WEBHDFS_PORT = 50070
+
+CHUNK_SIZE = 1024 * 1024
+
+# idle connections kept per host
+MAX_IDLE = 16
+
+
+class _ConnectionPool(object):
+    # idle HTTP connections by (scheme, host, port)
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """(connection, whether it was reused)"""
+        with self.lock:
+            if self.idle.get(key):
+                return (self.idle[key].pop(), True)
+        (scheme, host, port) = key
+        if scheme == 'https':
+            return (httplib.HTTPSConnection(host, port, timeout=self.timeout),
+                    False)
+        return (httplib.HTTPConnection(host, port, timeout=self.timeout),
+                False)
+
+    def put(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+class _Response(object):
+    # a response whose body is streamed; its connection goes back to the pool
+    # once the body has been read
+
+    def __init__(self, pool, key, conn, response):
+        (self.pool, self.key, self.conn) = (pool, key, conn)
+        self.response = response
+        self.status = response.status
+
+    def read(self, n=None):
+        data = self.response.read() if n is None else self.response.read(n)
+        if self.response.isclosed() and self.conn is not None:
+            self.pool.put(self.key, self.conn)
+            self.conn = None
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            # unread data would be taken for the next response
+            self.conn.close()
+            self.conn = None
+
+
+class WebHdfsClient(object):
+    """A client of the WebHDFS endpoint base_url (e.g.
+    http://namenode:50070), acting as user."""
+
+    def __init__(self, base_url, user=None, timeout=60):
+        self.base = urlparse(base_url)
+        self.user = user or getuser()
+        self.pool = _ConnectionPool(timeout)
+
+    def _key(self, parsed):
+        return (parsed.scheme, parsed.hostname,
+                parsed.port or (443 if parsed.scheme == 'https' else 80))
+
+    def _url(self, path, op, **params):
+        params = dict(params, op=op)
+        params['user.name'] = self.user
+        return '{0}://{1}/webhdfs/v1{2}?{3}'.format(
+            self.base.scheme, self.base.netloc, quote(path or '/'),
+            urlencode(params))
+
+    def _send(self, method, url, body=None, size=None, progress=None):
+        # returns a _Response; body is a string or a file with read(n)
+        parsed = urlparse(url)
+        key = self._key(parsed)
+        while True:
+            (conn, reused) = self.pool.get(key)
+            try:
+                response = self._request(conn, method, parsed, body, size,
+                                         progress)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # the server may have closed an idle connection; requests
+                # are only sent again if their body can be
+                if reused and not hasattr(body, 'read'):
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            return _Response(self.pool, key, conn, response)
+
+    def _request(self, conn, method, parsed, body, size, progress):
+        conn.putrequest(method, parsed.path + '?' + parsed.query,
+                        skip_accept_encoding=True)
+        if isinstance(body, basestring):
+            size = len(body)
+        if body is not None:
+            conn.putheader('Content-Type', 'application/octet-stream')
+        conn.putheader('Content-Length', str(size or 0))
+        conn.endheaders()
+        if isinstance(body, basestring):
+            conn.send(body)
+        elif body is not None:
+            for chunk in iter(lambda: body.read(CHUNK_SIZE), ''):
+                conn.send(chunk)
+                if progress is not None:
+                    progress.add(len(chunk))
+        return conn.getresponse()
+
+    def _call(self, method, url, ok=(200,), **kwargs):
+        # the decoded JSON of a response with a status in ok
+        response = self._send(method, url, **kwargs)
+        data = response.read()
+        if response.status not in ok:
+            self._raise(url, response.status, data)
+        return json.loads(data) if data else None
+
+    def _raise(self, url, status, data):
+        try:
+            error = json.loads(data)['RemoteException']
+            message = '{0}: {1}'.format(error['exception'], error['message'])
+        except (ValueError, KeyError, TypeError):
+            message = data.strip() or httplib.responses.get(status, '')
+        raise WebHdfsError('{0}: HTTP {1}: {2}'.format(
+            urlparse(url).path, status, message), status)
+
+    def _redirect(self, method, path, op, **params):
+        # the datanode (or HttpFS) url that the data of op goes to or from
+        url = self._url(path, op, **params)
+        response = self._send(method, url)
+        data = response.read()
+        if response.status != 307:
+            self._raise(url, response.status, data)
+        return response.response.getheader('Location')
+
+    def status(self, path):
+        """The FileStatus of path, or None if there is nothing there."""
+        url = self._url(path, 'GETFILESTATUS')
+        response = self._send('GET', url)
+        data = response.read()
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            self._raise(url, response.status, data)
+        return json.loads(data)['FileStatus']
+
+    def exists(self, path):
+        return self.status(path) is not None
+
+    def list_status(self, path):
+        """The FileStatuses of the entries of the directory at path."""
+        return self._call('GET', self._url(path, 'LISTSTATUS'))[
+            'FileStatuses']['FileStatus']
+
+    def walk(self, path):
+        """(path relative to path, size) of every file under path."""
+        status = self.status(path)
+        if status is None:
+            return []
+        if status['type'] == 'FILE':
+            return [('', status['length'])]
+        files = []
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            for entry in self.list_status(path.rstrip('/') + '/' + rel):
+                name = (rel + '/' if rel else '') + entry['pathSuffix']
+                if entry['type'] == 'DIRECTORY':
+                    pending.append(name)
+                else:
+                    files.append((name, entry['length']))
+        return files
+
+    def mkdirs(self, path):
+        if not self._call('PUT', self._url(path, 'MKDIRS'))['boolean']:
+            raise WebHdfsError('{0}: could not create the directory'.format(
+                path))
+
+    def rename(self, src, dst):
+        if not self._call('PUT', self._url(src, 'RENAME',
+                                           destination=dst))['boolean']:
+            raise WebHdfsError('{0}: could not rename to {1}'.format(src,
+                                                                    dst))
+
+    def delete(self, path, recursive=False):
+        """Delete path; returns whether there was anything to delete."""
+        return self._call('DELETE', self._url(
+            path, 'DELETE', recursive=str(recursive).lower()))['boolean']
+
+    def create(self, path, data, size=None, overwrite=False, progress=None):
+        """Write data (a string, or a file of size bytes) to path."""
+        url = self._redirect('PUT', path, 'CREATE',
+                             overwrite=str(overwrite).lower())
+        self._call('PUT', url, ok=(200, 201), body=data, size=size,
+                   progress=progress)
+
+    def open(self, path, offset=0):
+        """The file at path as a stream (with read(n) and close()) from
+        offset."""
+        url = self._redirect('GET', path, 'OPEN', offset=offset)
+        response = self._send('GET', url)
+        if response.status != 200:
+            self._raise(url, response.status, response.read())
+        return response
+
+    def read(self, path, offset=0):
+        return self.open(path, offset).read()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def enabled():
+    return eggo_config.get('dfs', 'hdfs_backend') == 'webhdfs'
+
+
+def client(parsed):
+    """The (shared) client for the hdfs:// url parsed."""
+    base_url = (eggo_config.get('dfs', 'webhdfs_url') or
+                'http://{0}:{1}'.format(parsed.hostname, WEBHDFS_PORT))
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = WebHdfsClient(
+                base_url, eggo_config.get('dfs', 'webhdfs_user') or None)
+        return _clients[base_url]
@@ -14,9 +14,122 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pytest import fixture
+import os
+import json
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from urllib import unquote
+from urlparse import urlparse, parse_qsl
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from pytest import fixture, yield_fixture
 from luigi.hdfs import HdfsClient
 
 @fixture(scope='session')
 def fs():
     return HdfsClient()
+
+
+class _WebHdfsStandIn(BaseHTTPRequestHandler):
+    # the WebHDFS REST API over a local directory, for the webhdfs backend;
+    # data is read and written after a 307 redirect, as with a datanode
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def _reply(self, status, body='', headers={}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, value, status=200):
+        self._reply(status, json.dumps(value))
+
+    def _status(self, path):
+        return {'pathSuffix': os.path.basename(path),
+                'type': 'DIRECTORY' if os.path.isdir(path) else 'FILE',
+                'length': (0 if os.path.isdir(path)
+                           else os.path.getsize(path))}
+
+    def _handle(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        path = self.server.root + unquote(url.path[len('/webhdfs/v1'):])
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        op = params['op']
+        if op in ['CREATE', 'OPEN'] and 'data' not in params:
+            self._reply(307, headers={'Location': 'http://{0}:{1}{2}&data=1'.format(
+                self.server.server_name, self.server.server_port, self.path)})
+        elif op == 'CREATE':
+            if os.path.exists(path) and params.get('overwrite') != 'true':
+                self._json({'RemoteException': {
+                    'exception': 'FileAlreadyExistsException',
+                    'message': path}}, 403)
+                return
+            # like HDFS, create the missing parent directories
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as out:
+                out.write(body)
+            self._reply(201)
+        elif op == 'OPEN':
+            with open(path, 'rb') as ip:
+                ip.seek(int(params.get('offset', 0)))
+                self._reply(200, ip.read())
+        elif not os.path.exists(path) and op != 'MKDIRS':
+            if op in ['RENAME', 'DELETE']:
+                self._json({'boolean': False})
+            else:
+                self._json({'RemoteException': {
+                    'exception': 'FileNotFoundException', 'message': path}},
+                    404)
+        elif op == 'GETFILESTATUS':
+            self._json({'FileStatus': self._status(path)})
+        elif op == 'LISTSTATUS':
+            self._json({'FileStatuses': {'FileStatus': [
+                self._status(os.path.join(path, name))
+                for name in sorted(os.listdir(path))]}})
+        elif op == 'MKDIRS':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._json({'boolean': True})
+        elif op == 'RENAME':
+            os.rename(path, self.server.root + params['destination'])
+            self._json({'boolean': True})
+        elif op == 'DELETE':
+            if os.path.isdir(path):
+                rmtree(path)
+            else:
+                os.remove(path)
+            self._json({'boolean': True})
+
+    do_GET = do_PUT = do_DELETE = _handle
+
+
+class _StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@yield_fixture(scope='module')
+def webhdfs_server():
+    """The url of a WebHDFS stand-in server, and the server (its root
+    directory and connection count)."""
+    server = _StandInServer(('localhost', 0), _WebHdfsStandIn)
+    server.root = mkdtemp()
+    server.connections = 0
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield ('http://localhost:{0}'.format(server.server_port), server)
+    server.shutdown()
+    rmtree(server.root)
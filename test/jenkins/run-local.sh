@@ -33,7 +33,7 @@ cd $WORKSPACE
 virtualenv eggo_client_venv && source eggo_client_venv/bin/activate
 pip install -U pip  # python-daemon only installs with a newer version of pip
 pip install -U setuptools  # http://www.fabfile.org/faq.html#fabric-installs-but-doesn-t-run
-pip install pytest
+pip install pytest pyftpdlib
 pip install fabric luigi boto # depended on by eggo
 pip install .  # install eggo
 
@@ -76,7 +76,10 @@ echo y | eggo teardown  # eggo teardown asks for confirmation
 
 
 # 7. Test result correctness
-py.test $WORKSPACE/test/jenkins/test_results.py
+py.test $WORKSPACE/test/jenkins/test_results.py \
+    $WORKSPACE/test/jenkins/test_regions.py \
+    $WORKSPACE/test/jenkins/test_preflight.py \
+    $WORKSPACE/test/jenkins/test_register.py
 
 # TODO: eventually, load data into CDH cluster and test queries with Impala
 
@@ -0,0 +1,299 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from pytest import importorskip, yield_fixture, raises
+
+from eggo.bgzf import bgzf_compress
+from eggo.error import TransferError
+from eggo.preflight import (
+    probe_source, preflight, load_preflight, failed_sources,
+    source_sizes)
+from eggo.regions import fetch_range
+from eggo.transfer import download
+
+
+# a bgzipped VCF, a plain one, and one shorter than HEAD_SIZE
+FILES = {'small.vcf.gz': bgzf_compress('##fileformat=VCFv4.1\n' * 100),
+         'small.vcf': '##fileformat=VCFv4.1\n' * 100,
+         'tiny.vcf': '##'}
+
+ETAG = '"5eb63bbbe01eeed093cb22bb8f5acdc3"'
+
+
+def _source(url, compression):
+    return {'url': url, 'format': 'vcf', 'compression': compression}
+
+
+# HTTP
+
+class _HttpStandIn(BaseHTTPRequestHandler):
+    # serves FILES, with ranged reads unless the path starts with /norange/,
+    # and reporting 1000 times the real size if it starts with /short/
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        (mode, name) = self.path.lstrip('/').split('/', 1)
+        if name not in FILES:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = FILES[name]
+        size = len(data) * (1000 if mode == 'short' else 1)
+        byte_range = self.headers.get('Range')
+        if byte_range and mode != 'norange':
+            (start, end) = byte_range.split('=')[1].split('-')
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            body = data[int(start):end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, size))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@yield_fixture(scope='module')
+def http_server():
+    """The base url of an HTTP server of FILES."""
+    server = _StandInServer(('localhost', 0), _HttpStandIn)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://localhost:{0}'.format(server.server_port)
+    server.shutdown()
+
+
+def test_probe_http(http_server):
+    result = probe_source(_source(http_server + '/ok/small.vcf.gz', True))
+    assert result['ok'] and result['error'] is None
+    assert result['size'] == len(FILES['small.vcf.gz'])
+    assert result['accepts_ranges']
+    assert result['etag'] == ETAG
+    assert result['bgzf']
+
+
+def test_probe_http_missing(http_server):
+    result = probe_source(_source(http_server + '/ok/missing.vcf', False))
+    assert not result['ok']
+    assert result['error'].startswith('HTTPError')
+    assert '404' in result['error']
+
+
+def test_probe_http_without_ranges(http_server):
+    # the whole file comes back, and its size from the Content-Length
+    result = probe_source(_source(http_server + '/norange/small.vcf', False))
+    assert result['ok']
+    assert result['size'] == len(FILES['small.vcf'])
+    assert not result['accepts_ranges']
+    assert not result['bgzf']
+
+
+def test_probe_http_size_mismatch(http_server):
+    assert probe_source(_source(http_server + '/ok/tiny.vcf', False))['ok']
+    result = probe_source(_source(http_server + '/short/tiny.vcf', False))
+    assert not result['ok']
+    assert result['size'] == 2000
+    assert 'sent 2 bytes, but reports a size of 2000' in result['error']
+
+
+def test_probe_http_compression_mismatch(http_server):
+    result = probe_source(_source(http_server + '/ok/small.vcf', True))
+    assert not result['ok']
+    assert 'not gzip-compressed' in result['error']
+
+
+def test_preflight_sidecar(http_server):
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'test.preflight.json')
+        sources = [_source(http_server + '/ok/small.vcf.gz', True),
+                   _source(http_server + '/ok/small.vcf', False)]
+        sidecar = preflight(sources, path)
+        assert not failed_sources(sidecar)
+        assert source_sizes(sidecar) == dict(
+            (s['url'], len(FILES[os.path.basename(s['url'])]))
+            for s in sources)
+        assert load_preflight(path, sources) == sidecar
+        # a changed registry is probed again
+        assert load_preflight(path, sources[:1]) is None
+    finally:
+        rmtree(directory)
+
+
+# FTP
+
+@yield_fixture(scope='module')
+def ftp_server():
+    """The base url of an anonymous FTP server of FILES, and its handler
+    class, whose rest_supported, size_factor and final_reply (to a
+    completed transfer) can be patched."""
+    importorskip('pyftpdlib')
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    root = mkdtemp()
+    for (name, data) in FILES.iteritems():
+        with open(os.path.join(root, name), 'wb') as op:
+            op.write(data)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+
+    class Handler(FTPHandler):
+        rest_supported = True
+        size_factor = 1
+        final_reply = None
+
+        def respond(self, resp, *args, **kwargs):
+            if resp.startswith('226') and self.final_reply is not None:
+                resp = self.final_reply
+            return FTPHandler.respond(self, resp, *args, **kwargs)
+
+        def ftp_REST(self, line):
+            if not self.rest_supported:
+                self.respond('502 Command not implemented.')
+                return
+            return FTPHandler.ftp_REST(self, line)
+
+        def ftp_SIZE(self, path):
+            if self.size_factor == 1 or not os.path.isfile(path):
+                return FTPHandler.ftp_SIZE(self, path)
+            self.respond('213 {0}'.format(
+                os.path.getsize(path) * self.size_factor))
+
+    Handler.authorizer = authorizer
+    server = ThreadedFTPServer(('localhost', 0), Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield ('ftp://localhost:{0}'.format(server.socket.getsockname()[1]),
+           Handler)
+    server.close_all()
+    rmtree(root)
+
+
+def test_probe_ftp(ftp_server):
+    (url, _) = ftp_server
+    result = probe_source(_source(url + '/small.vcf.gz', True))
+    assert result['ok'] and result['error'] is None
+    assert result['size'] == len(FILES['small.vcf.gz'])
+    assert result['accepts_ranges']
+    assert result['etag'].startswith('mdtm:')
+    assert result['bgzf']
+
+
+def test_probe_ftp_missing(ftp_server):
+    (url, _) = ftp_server
+    result = probe_source(_source(url + '/missing.vcf', False))
+    assert not result['ok']
+    assert result['error'].startswith('error_perm')
+
+
+def test_probe_ftp_without_rest(ftp_server, monkeypatch):
+    (url, handler) = ftp_server
+    monkeypatch.setattr(handler, 'rest_supported', False)
+    result = probe_source(_source(url + '/small.vcf', False))
+    assert result['ok']
+    assert not result['accepts_ranges']
+    assert result['size'] == len(FILES['small.vcf'])
+
+
+def test_probe_ftp_size_mismatch(ftp_server, monkeypatch):
+    (url, handler) = ftp_server
+    assert probe_source(_source(url + '/tiny.vcf', False))['ok']
+    monkeypatch.setattr(handler, 'size_factor', 1000)
+    result = probe_source(_source(url + '/tiny.vcf', False))
+    assert not result['ok']
+    assert result['size'] == 2000
+    assert 'sent 2 bytes, but reports a size of 2000' in result['error']
+
+
+def test_download_ftp(ftp_server):
+    (url, _) = ftp_server
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'small.vcf')
+        # resumed from a partial file
+        with open(path, 'wb') as op:
+            op.write(FILES['small.vcf'][:10])
+        attempts = download(url + '/small.vcf', path,
+                            size=len(FILES['small.vcf']))
+        assert [a['offset'] for a in attempts] == [10]
+        with open(path, 'rb') as ip:
+            assert ip.read() == FILES['small.vcf']
+    finally:
+        rmtree(directory)
+
+
+def test_download_ftp_failed_reply(ftp_server, monkeypatch):
+    (url, handler) = ftp_server
+    monkeypatch.setattr(handler, 'final_reply', '551 Local error.')
+    directory = mkdtemp()
+    try:
+        with raises(TransferError) as e:
+            download(url + '/small.vcf', os.path.join(directory, 'small.vcf'))
+        assert not e.value.transient
+        assert '551 Local error.' in str(e.value)
+    finally:
+        rmtree(directory)
+
+
+def test_fetch_range_ftp(ftp_server, monkeypatch):
+    (url, handler) = ftp_server
+    data = FILES['small.vcf']
+    assert fetch_range(url + '/small.vcf', 5, 25) == data[5:25]
+    assert fetch_range(url + '/small.vcf', 5) == data[5:]
+    # a range short of the end does not wait for the final reply
+    monkeypatch.setattr(handler, 'final_reply', '551 Local error.')
+    assert fetch_range(url + '/small.vcf', 5, 25) == data[5:25]
+    with raises(TransferError):
+        fetch_range(url + '/small.vcf', 5)
+
+
+def test_probe_local():
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'small.vcf.gz')
+        with open(path, 'wb') as op:
+            op.write(FILES['small.vcf.gz'])
+        result = probe_source(_source(path, True))
+        assert result['ok'] and result['bgzf']
+        assert result['size'] == len(FILES['small.vcf.gz'])
+        assert result['etag'].startswith('mtime:')
+        result = probe_source(_source('file://' + path + '.missing', True))
+        assert not result['ok']
+        assert result['error'].startswith('IOError')
+    finally:
+        rmtree(directory)
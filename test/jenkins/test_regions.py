@@ -0,0 +1,258 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pytest import mark, yield_fixture
+
+from eggo import bgzf, regions
+from eggo.bgzf import BGZF_EOF, deflate_block, bgzf_decompress, block_spans
+from eggo.regions import (
+    parse_bai, parse_tbi, region_chunks, merge_chunks, parse_region,
+    subset_bam, subset_vcf)
+
+
+# small blocks, so that the fixtures span many of them
+PAYLOAD_SIZE = 1000
+
+READ_LENGTH = 75
+
+BAM_NAMES = ['1', '2']
+
+VCF_NAMES = ['20', '22']
+
+VCF_HEADER = ('##fileformat=VCFv4.1\n'
+              '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNA1\n')
+
+
+# writing the fixtures
+
+def _bgzf(data):
+    # data as BGZF, and the virtual offset of each position in data
+    blocks = [deflate_block(data[i:i + PAYLOAD_SIZE])
+              for i in xrange(0, len(data), PAYLOAD_SIZE)]
+    offsets = [0]
+    for block in blocks:
+        offsets.append(offsets[-1] + len(block))
+    return (''.join(blocks) + BGZF_EOF,
+            lambda u: (offsets[u // PAYLOAD_SIZE] << 16) | (u % PAYLOAD_SIZE))
+
+
+def _reg2bin(beg, end):
+    end -= 1
+    for (shift, offset) in [(14, 4681), (17, 585), (20, 73), (23, 9),
+                            (26, 1)]:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def _index(n_ref, records, voffset):
+    # the per-reference indexes of records, given as (reference id, beg, end,
+    # start and end positions in the uncompressed data)
+    refs = [({}, {}) for _ in xrange(n_ref)]
+    for (ref_id, beg, end, ustart, uend) in records:
+        (bins, linear) = refs[ref_id]
+        bins.setdefault(_reg2bin(beg, end), []).append(
+            (voffset(ustart), voffset(uend)))
+        for window in xrange(beg >> 14, ((end - 1) >> 14) + 1):
+            linear.setdefault(window, voffset(ustart))
+    data = []
+    for (bins, linear) in refs:
+        data.append(struct.pack('<i', len(bins)))
+        for (bin_, chunks) in sorted(bins.iteritems()):
+            data.append(struct.pack('<Ii', bin_, len(chunks)))
+            data.extend(struct.pack('<QQ', *c) for c in chunks)
+        windows = max(linear) + 1 if linear else 0
+        data.append(struct.pack('<i', windows))
+        data.extend(struct.pack('<Q', linear.get(w, 0))
+                    for w in xrange(windows))
+    return ''.join(data)
+
+
+def _alignments():
+    # (reference id, 0-based start, read name) of the fixture's records
+    return [(ref_id, start, 'read{0}.{1}'.format(ref_id, start))
+            for ref_id in xrange(len(BAM_NAMES))
+            for start in xrange(1000, 40000, 97)]
+
+
+def _bam_record(ref_id, start, name):
+    seq = 'ACGT' * (READ_LENGTH // 4) + 'A' * (READ_LENGTH % 4)
+    packed = ''.join(chr(('=ACMGRSVTWYHKDBN'.index(seq[i]) << 4) |
+                         '=ACMGRSVTWYHKDBN'.index((seq + '=')[i + 1]))
+                     for i in xrange(0, READ_LENGTH, 2))
+    body = ''.join([
+        struct.pack('<iiBBHHHiiii', ref_id, start, len(name) + 1, 60,
+                    _reg2bin(start, start + READ_LENGTH), 1, 0, READ_LENGTH,
+                    -1, -1, 0),
+        name + '\x00', struct.pack('<I', READ_LENGTH << 4), packed,
+        '\xff' * READ_LENGTH])
+    return struct.pack('<i', len(body)) + body
+
+
+def _bam_header():
+    text = ''.join('@SQ\tSN:{0}\tLN:100000\n'.format(n) for n in BAM_NAMES)
+    return ''.join(
+        ['BAM\x01', struct.pack('<i', len(text)), text,
+         struct.pack('<i', len(BAM_NAMES))] +
+        [struct.pack('<i', len(n) + 1) + n + '\x00' + struct.pack('<i', 100000)
+         for n in BAM_NAMES])
+
+
+def _variants():
+    # (contig, 1-based position, REF) of the fixture's records
+    return [(name, pos, 'ACG'[:1 + pos % 3]) for name in VCF_NAMES
+            for pos in xrange(1001, 40000, 89)]
+
+
+def _vcf_line(name, pos, ref):
+    return '{0}\t{1}\t.\t{2}\tT\t50\tPASS\t.\tGT\t0/1\n'.format(name, pos, ref)
+
+
+@yield_fixture(scope='module')
+def fixtures():
+    """Paths of a BGZF BAM and VCF and their .bai and .tbi indexes."""
+    root = mkdtemp()
+
+    header = _bam_header()
+    records = [_bam_record(*a) for a in _alignments()]
+    (data, voffset) = _bgzf(header + ''.join(records))
+    spans = []
+    pos = len(header)
+    for ((ref_id, start, _), record) in zip(_alignments(), records):
+        spans.append((ref_id, start, start + READ_LENGTH, pos,
+                      pos + len(record)))
+        pos += len(record)
+    with open(os.path.join(root, 'small.bam'), 'wb') as op:
+        op.write(data)
+    with open(os.path.join(root, 'small.bam.bai'), 'wb') as op:
+        op.write('BAI\x01' + struct.pack('<i', len(BAM_NAMES)) +
+                 _index(len(BAM_NAMES), spans, voffset))
+
+    lines = [_vcf_line(*v) for v in _variants()]
+    (data, voffset) = _bgzf(VCF_HEADER + ''.join(lines))
+    spans = []
+    pos = len(VCF_HEADER)
+    for ((name, start, ref), line) in zip(_variants(), lines):
+        spans.append((VCF_NAMES.index(name), start - 1, start - 1 + len(ref),
+                      pos, pos + len(line)))
+        pos += len(line)
+    with open(os.path.join(root, 'small.vcf.gz'), 'wb') as op:
+        op.write(data)
+    names = ''.join(n + '\x00' for n in VCF_NAMES)
+    # VCF format, columns 1 and 2, no end column, '#' comments, no skip
+    tbi = ''.join(['TBI\x01', struct.pack('<8i', len(VCF_NAMES), 2, 1, 2, 0,
+                                          ord('#'), 0, len(names)),
+                   names, _index(len(VCF_NAMES), spans, voffset)])
+    with open(os.path.join(root, 'small.vcf.gz.tbi'), 'wb') as op:
+        op.write(bgzf.bgzf_compress(tbi))
+
+    yield dict((name, os.path.join(root, name)) for name in
+               ['small.bam', 'small.bam.bai', 'small.vcf.gz',
+                'small.vcf.gz.tbi'])
+    rmtree(root)
+
+
+def _read(path):
+    with open(path, 'rb') as ip:
+        return ip.read()
+
+
+def _overlapping(items, regions_):
+    spans = [parse_region(r) for r in regions_]
+    return [item for item in items
+            if any(n == item[0] and b < item[2] and item[1] < e
+                   for (n, b, e) in spans)]
+
+
+# tests
+
+REGIONS = ['1:20001-30000', '2:39000', '2:5000-5001', 'X', '20:1-2000',
+           '22:15000-15100']
+
+
+def test_parse_bai(fixtures):
+    ref_indexes = parse_bai(_read(fixtures['small.bam.bai']))
+    assert len(ref_indexes) == len(BAM_NAMES)
+    (bins, linear) = ref_indexes[0]
+    # a 75 bp read starting at 1000 lies in the first 16 kb bin
+    assert 4681 in bins
+    assert len(linear) == (39000 + READ_LENGTH) // 16384 + 1
+
+
+def test_parse_tbi(fixtures):
+    (names, ref_indexes, meta) = parse_tbi(_read(fixtures['small.vcf.gz.tbi']))
+    assert names == VCF_NAMES
+    assert meta == '#'
+    assert len(ref_indexes) == len(VCF_NAMES)
+
+
+def test_region_chunks(fixtures):
+    ref_indexes = parse_bai(_read(fixtures['small.bam.bai']))
+    (name, beg, end) = parse_region('1:20001-30000')
+    chunks = merge_chunks(region_chunks(ref_indexes[0], beg, end))
+    assert chunks
+    # the chunks hold no block before the first that can overlap the region,
+    # and end past the last record in it
+    header = len(_bam_header())
+    records = [len(_bam_record(*a)) for a in _alignments()]
+    starts = [header + sum(records[:i]) for i in xrange(len(records))]
+    overlapping = [i for (i, a) in enumerate(_alignments())
+                   if a[0] == 0 and beg < a[1] + READ_LENGTH and a[1] < end]
+    first = starts[overlapping[0]] // PAYLOAD_SIZE
+    last = (starts[overlapping[-1]] + records[overlapping[-1]] - 1) // \
+        PAYLOAD_SIZE
+    data = _read(fixtures['small.bam'])
+    block_offsets = [start for (start, _) in block_spans(data)]
+    assert chunks[0][0] >> 16 <= block_offsets[first]
+    assert chunks[-1][1] >> 16 >= block_offsets[last]
+
+
+@mark.parametrize('piece_size', [regions.FETCH_PIECE_SIZE, 2500])
+def test_subset_vcf(fixtures, monkeypatch, piece_size):
+    monkeypatch.setattr(regions, 'FETCH_PIECE_SIZE', piece_size)
+    output = fixtures['small.vcf.gz'] + '.subset'
+    subset_vcf(fixtures['small.vcf.gz'], fixtures['small.vcf.gz.tbi'],
+               REGIONS, output, threads=3)
+    variants = [(name, pos - 1, pos - 1 + len(ref), ref)
+                for (name, pos, ref) in _variants()]
+    expected = [_vcf_line(name, beg + 1, ref)
+                for (name, beg, _, ref) in _overlapping(variants, REGIONS)]
+    assert expected
+    assert _read(output) == VCF_HEADER + ''.join(expected)
+
+
+@mark.parametrize('piece_size', [regions.FETCH_PIECE_SIZE, 2500])
+def test_subset_bam(fixtures, monkeypatch, piece_size):
+    monkeypatch.setattr(regions, 'FETCH_PIECE_SIZE', piece_size)
+    # an output of several blocks
+    monkeypatch.setattr(bgzf, 'BGZF_MAX_PAYLOAD_SIZE', 4096)
+    output = fixtures['small.bam'] + '.subset'
+    subset_bam(fixtures['small.bam'], fixtures['small.bam.bai'], REGIONS,
+               output, threads=3)
+    alignments = [(BAM_NAMES[ref_id], start, start + READ_LENGTH, name)
+                  for (ref_id, start, name) in _alignments()]
+    expected = [_bam_record(BAM_NAMES.index(n), start, name)
+                for (n, start, _, name) in _overlapping(alignments, REGIONS)]
+    assert expected
+    data = _read(output)
+    assert len(list(block_spans(data))) > 2
+    assert data.endswith(BGZF_EOF)
+    assert bgzf_decompress(data) == _bam_header() + ''.join(expected)
@@ -0,0 +1,243 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pytest import yield_fixture
+
+from eggo.config import eggo_config
+from eggo.parquet import (
+    MAGIC, parse_footer, read_footer, num_rows, BYTE_ARRAY, INT32, INT64,
+    REQUIRED, OPTIONAL, REPEATED, UTF8, LIST)
+from eggo.register import edition_ddl, dataset_ddl, table_columns
+
+
+# writing the fixtures: Thrift compact protocol values are (type, value)
+# pairs, with structs as {field id: (type, value)} and lists as (element
+# type, [values])
+
+_I32 = 5
+_I64 = 6
+_BINARY = 8
+_LIST = 9
+_STRUCT = 12
+
+
+def _varint(n):
+    data = []
+    while True:
+        if n < 0x80:
+            data.append(chr(n))
+            return ''.join(data)
+        data.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+
+
+def _zigzag(n):
+    return _varint((n << 1) ^ (n >> 63))
+
+
+def _value(type_, value):
+    if type_ in (_I32, _I64):
+        return _zigzag(value)
+    elif type_ == _BINARY:
+        return _varint(len(value)) + value
+    elif type_ == _LIST:
+        (elem_type, values) = value
+        header = (chr(len(values) << 4 | elem_type) if len(values) < 15
+                  else chr(0xf0 | elem_type) + _varint(len(values)))
+        return header + ''.join(_value(elem_type, v) for v in values)
+    elif type_ == _STRUCT:
+        return _struct(value)
+    raise ValueError(type_)
+
+
+def _struct(fields):
+    data = []
+    last = 0
+    for field_id in sorted(fields):
+        (type_, value) = fields[field_id]
+        delta = field_id - last
+        # the long form, a type byte and a zigzag field id, past 15
+        data.append(chr(delta << 4 | type_) if delta <= 15
+                    else chr(type_) + _zigzag(field_id))
+        data.append(_value(type_, value))
+        last = field_id
+    return ''.join(data) + '\x00'
+
+
+def _element(name, type_=None, repetition=OPTIONAL, children=0,
+             converted=None):
+    fields = {4: (_BINARY, name)}
+    if type_ is not None:
+        fields[1] = (_I32, type_)
+    if repetition is not None:
+        fields[3] = (_I32, repetition)
+    if children:
+        fields[5] = (_I32, children)
+    if converted is not None:
+        fields[6] = (_I32, converted)
+    return fields
+
+
+# a record with a string, two longs, a three-level list of strings and a
+# repeated int; the depth-first list of schema elements
+SCHEMA = [_element('Variant', repetition=None, children=5),
+          _element('contig', BYTE_ARRAY, converted=UTF8),
+          _element('start', INT64, REQUIRED),
+          _element('end', INT64),
+          _element('alleles', children=1, converted=LIST),
+          _element('list', repetition=REPEATED, children=1),
+          _element('element', BYTE_ARRAY, converted=UTF8),
+          _element('depths', INT32, REPEATED)]
+
+
+def _column(name, type_, low=None, high=None, nulls=None):
+    statistics = {}
+    if nulls is not None:
+        statistics[3] = (_I64, nulls)
+    if low is not None:
+        statistics[5] = (_BINARY, struct.pack('<q', high))
+        statistics[6] = (_BINARY, struct.pack('<q', low))
+    meta = {1: (_I32, type_), 2: (_LIST, (_I32, [0])),
+            3: (_LIST, (_BINARY, name.split('.'))), 4: (_I32, 1),
+            5: (_I64, 0), 6: (_I64, 0), 7: (_I64, 100), 9: (_I64, 4),
+            12: (_STRUCT, statistics)}
+    return {2: (_I64, 4), 3: (_STRUCT, meta)}
+
+
+def _row_group(rows, start, end, nulls):
+    # the statistics of start; end has only null counts, and the nested
+    # columns have none
+    columns = [_column('contig', BYTE_ARRAY, nulls=0),
+               _column('start', INT64, start, end, 0),
+               _column('end', INT64, nulls=nulls),
+               _column('alleles.list.element', BYTE_ARRAY),
+               _column('depths', INT32)]
+    return {1: (_LIST, (_STRUCT, columns)), 2: (_I64, rows * 100),
+            3: (_I64, rows)}
+
+
+def _parquet(row_groups):
+    # a Parquet file of row_groups, (rows, min start, max start, null ends)
+    footer = _struct({
+        1: (_I32, 1), 2: (_LIST, (_STRUCT, SCHEMA)),
+        3: (_I64, sum(rg[0] for rg in row_groups)),
+        4: (_LIST, (_STRUCT, [_row_group(*rg) for rg in row_groups])),
+        # created_by, past a gap of more than 15 field ids in the long form
+        6: (_BINARY, 'eggo test'), 100: (_I64, -1)})
+    return (MAGIC + '\x00' * 100 + footer + struct.pack('<i', len(footer)) +
+            MAGIC)
+
+
+# the part files of two editions, one of which is partitioned by contig
+EDITIONS = {
+    'basic': {'part-r-00000.parquet': _parquet([(10, 100, 900, 1),
+                                                (20, 1000, 1900, 0)]),
+              'part-r-00001.parquet': _parquet([(5, 50, 5000, 2)]),
+              '_SUCCESS': ''},
+    'flat': {'contig=20/part-r-00000.parquet': _parquet([(7, 10, 70, 0)]),
+             'contig=X/part-r-00000.parquet': _parquet([(3, 300, 600, None)])}}
+
+
+@yield_fixture(scope='module')
+def dfs_root():
+    """A dfs root url holding the editions of the dataset test."""
+    root = mkdtemp()
+    for (edition, files) in EDITIONS.iteritems():
+        for (name, data) in files.iteritems():
+            path = os.path.join(root, 'test', 'bdg', edition, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as op:
+                op.write(data)
+    previous = eggo_config.get('dfs', 'dfs_root_url', raw=True)
+    eggo_config.set('dfs', 'dfs_root_url', 'file://' + root)
+    yield 'file://' + root
+    eggo_config.set('dfs', 'dfs_root_url', previous)
+    rmtree(root)
+
+
+# tests
+
+def test_parse_footer():
+    meta = parse_footer(_parquet([(10, 100, 900, 1), (20, 1000, 1900, 0)]))
+    assert num_rows(meta) == 30
+    assert meta[6] == 'eggo test' and meta[100] == -1
+    assert table_columns(meta) == [
+        ('contig', 'STRING'), ('start', 'BIGINT'), ('end', 'BIGINT'),
+        ('alleles', 'ARRAY<STRING>'), ('depths', 'ARRAY<INT>')]
+
+
+def test_read_footer(dfs_root):
+    url = os.path.join(dfs_root, 'test/bdg/basic/part-r-00001.parquet')
+    assert num_rows(read_footer(url)) == 5
+
+
+def test_edition_ddl_partitioned():
+    files = [(name, len(data)) for (name, data)
+             in EDITIONS['flat'].iteritems()]
+    footers = dict((name, parse_footer(data)) for (name, data)
+                   in EDITIONS['flat'].iteritems())
+    statements = edition_ddl('`t`', 'file:///d', files, footers, 'impala')
+    assert statements[1].endswith("PARTITIONED BY (`contig` STRING)\n"
+                                  "STORED AS PARQUET\nLOCATION 'file:///d'")
+    assert ("ALTER TABLE `t` ADD IF NOT EXISTS PARTITION (`contig`='X') "
+            "LOCATION 'file:///d/contig=X'") in statements
+    assert ("ALTER TABLE `t` PARTITION (`contig`='20') SET TBLPROPERTIES "
+            "('numRows'='7', 'numFiles'='1', 'totalSize'='{0}', "
+            "'STATS_GENERATED_VIA_STATS_TASK'='true')".format(
+                dict(files)['contig=20/part-r-00000.parquet'])) in statements
+    # the null count of end is missing from a row group
+    assert ("ALTER TABLE `t` SET COLUMN STATS `start` ('numNulls'='0')"
+            in statements)
+    assert not [s for s in statements if 'STATS `end`' in s]
+
+
+def test_dataset_ddl(dfs_root):
+    config = {'name': 'test', 'editions': ['basic', 'flat']}
+    statements = dataset_ddl(config, database='eggo', threads=2)
+    assert statements[0] == 'CREATE DATABASE IF NOT EXISTS `eggo`'
+    basic = os.path.join(dfs_root, 'test/bdg/basic')
+    assert statements[1:3] == [
+        'DROP TABLE IF EXISTS `eggo`.`test_basic`',
+        'CREATE EXTERNAL TABLE `eggo`.`test_basic` (\n'
+        '  `contig` STRING,\n  `start` BIGINT,\n  `end` BIGINT,\n'
+        '  `alleles` ARRAY<STRING>,\n  `depths` ARRAY<INT>\n)\n'
+        "STORED AS PARQUET\nLOCATION '{0}'".format(basic)]
+    size = sum(len(data) for (name, data) in EDITIONS['basic'].iteritems()
+               if name.endswith('.parquet'))
+    # the statistics span the row groups of both files
+    assert statements[3:6] == [
+        "ALTER TABLE `eggo`.`test_basic` SET TBLPROPERTIES ('numRows'='35', "
+        "'numFiles'='2', 'totalSize'='{0}')".format(size),
+        'ALTER TABLE `eggo`.`test_basic` UPDATE STATISTICS FOR COLUMN '
+        "`contig` SET ('numNulls'='0')",
+        'ALTER TABLE `eggo`.`test_basic` UPDATE STATISTICS FOR COLUMN '
+        "`start` SET ('numNulls'='0', 'lowValue'='50', 'highValue'='5000')"]
+    assert ('ALTER TABLE `eggo`.`test_basic` UPDATE STATISTICS FOR COLUMN '
+            "`end` SET ('numNulls'='3')") in statements
+    # the column statistics of the flat edition are per partition
+    flat = os.path.join(dfs_root, 'test/bdg/flat')
+    assert [s for s in statements if s.endswith(
+        "PARTITIONED BY (`contig` STRING)\nSTORED AS PARQUET\n"
+        "LOCATION '{0}'".format(flat))]
+    assert ('ALTER TABLE `eggo`.`test_flat` PARTITION (`contig`=\'20\') '
+            "UPDATE STATISTICS FOR COLUMN `start` SET ('numNulls'='0', "
+            "'lowValue'='10', 'highValue'='70')") in statements
@@ -16,8 +16,17 @@
 
 import os
 
-from eggo.config import eggo_config, supported_formats
+from eggo.config import eggo_config, supported_formats, edition_names
 from eggo.dag import ToastConfig, JsonFileParameter
+from eggo.catalog import load_catalog
+from eggo.register import dataset_ddl
+from eggo.index import load_index, overlapping
+from eggo.validate import count_raw_files, edition_rows
+from eggo.dag import create_SUCCESS_file
+from eggo.dfs import (
+    make_dir, put_file, rename, exists, write_file, read_file, read_tail,
+    copy_file, list_files, delete_prefix)
+from eggo import webhdfs
 
 
 def test_config():
@@ -40,7 +49,7 @@ def test_genotypes(fs):
     assert fs.exists(toast_config.raw_data_url())
     assert fs.exists(toast_config.dataset_url())
     for format in supported_formats:
-        for edition in toast_config.config['editions']:
+        for edition in edition_names(toast_config.config):
             assert fs.exists(toast_config.edition_url(format=format,
                                                       edition=edition))
 
@@ -58,11 +67,101 @@ def test_genotypes(fs):
     bdg_basic = listdir(toast_config.edition_url(format='bdg', edition='basic'))
     assert ('part-r-00000.gz.parquet', 124989) in bdg_basic
     assert ('_SUCCESS', 0) in bdg_basic
+    assert ('_COMMITTED', 0) in bdg_basic
+    assert ('_VALIDATED', 0) in bdg_basic
     bdg_flat = listdir(toast_config.edition_url(format='bdg', edition='flat'))
     assert ('part-r-00000.gz.parquet', 22035) in bdg_flat
     assert ('_SUCCESS', 0) in bdg_flat
+    assert ('_COMMITTED', 0) in bdg_flat
+    assert ('_VALIDATED', 0) in bdg_flat
     # TODO: test for _metadata and _common_metadata files?
 
 
+def test_catalog():
+    dataset = load_catalog()['datasets']['test-genotypes']
+    assert set(dataset['editions']) == set(['bdg/basic', 'bdg/flat'])
+    for edition in dataset['editions'].itervalues():
+        assert edition['files'] == 1
+        assert edition['rows'] > 0
+
+
+def test_register():
+    config = JsonFileParameter().parse(
+        os.path.join(os.environ['EGGO_HOME'],
+                     'test/registry/test-genotypes.json'))
+    dataset = load_catalog()['datasets']['test-genotypes']
+    ddl = dataset_ddl(config)
+    for edition in ['basic', 'flat']:
+        table = '`test_genotypes_{0}`'.format(edition)
+        assert any(s.startswith('CREATE EXTERNAL TABLE ' + table)
+                   for s in ddl)
+        assert ("ALTER TABLE {0} SET TBLPROPERTIES ('numRows'='{1}'".format(
+            table, dataset['editions']['bdg/' + edition]['rows'])
+            in '\n'.join(ddl))
+
+
+def test_index():
+    toast_config = ToastConfig(config=JsonFileParameter().parse(
+        os.path.join(os.environ['EGGO_HOME'],
+                     'test/registry/test-genotypes.json')))
+    dataset = load_catalog()['datasets']['test-genotypes']
+    for edition in edition_names(toast_config.config):
+        url = toast_config.edition_url(edition=edition)
+        index = load_index(url)
+        assert (sum(f['rows'] for f in index['files']) ==
+                dataset['editions']['bdg/' + edition]['rows'])
+        assert len(overlapping(url, '22')) == len(index['files'])
+        assert overlapping(url, '1') == []
+
+
+def test_validate():
+    toast_config = ToastConfig(config=JsonFileParameter().parse(
+        os.path.join(os.environ['EGGO_HOME'],
+                     'test/registry/test-genotypes.json')))
+    raw_url = toast_config.raw_data_url()
+    counts = count_raw_files(dict(
+        (os.path.join(raw_url, name), 'vcf')
+        for (name, _) in list_files(raw_url) if name.endswith('.vcf')))
+    assert len(counts) == 1
+    for edition in edition_names(toast_config.config):
+        assert (edition_rows(toast_config.edition_url(edition=edition)) ==
+                counts.values()[0]['rows'])
+
+
 def test_alignments():
     pass
+
+
+def test_webhdfs(webhdfs_server, monkeypatch):
+    (url, server) = webhdfs_server
+    options = {('dfs', 'hdfs_backend'): 'webhdfs',
+               ('dfs', 'webhdfs_url'): url}
+    get = eggo_config.get
+    monkeypatch.setattr(eggo_config, 'get', lambda section, option, **kw:
+                        options.get((section, option)) or
+                        get(section, option, **kw))
+    monkeypatch.setattr(webhdfs, '_clients', {})
+    root = 'hdfs://namenode/eggo'
+    local_file = os.path.join(server.root, 'local')
+    with open(local_file, 'wb') as op:
+        op.write('x' * 3000000)
+    os.makedirs(os.path.join(server.root, 'eggo'))
+
+    make_dir(os.path.join(root, 'staged'))
+    put_file(local_file, os.path.join(root, 'staged/a'))
+    rename(os.path.join(root, 'staged/a'), os.path.join(root, 'a'))
+    assert exists(os.path.join(root, 'a'))
+    assert not exists(os.path.join(root, 'staged/a'))
+    create_SUCCESS_file(root)
+    write_file(os.path.join(root, 'b'), 'hello')
+    write_file(os.path.join(root, 'b'), 'hello again')
+    assert read_file(os.path.join(root, 'b')) == 'hello again'
+    assert read_tail(os.path.join(root, 'b'), 5) == 'again'
+    assert read_file(os.path.join(root, 'missing')) is None
+    copy_file(os.path.join(root, 'a'), os.path.join(root, 'c/a'))
+    assert sorted(list_files(root)) == [
+        ('_SUCCESS', 0), ('a', 3000000), ('b', 11), ('c/a', 3000000)]
+    delete_prefix(os.path.join(root, 'c'))
+    assert not exists(os.path.join(root, 'c'))
+    # the requests reuse the pooled connections
+    assert server.connections < 5
@@ -0,0 +1,72 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from cStringIO import StringIO
+
+from fabric.api import cd, prefix, path, shell_env, settings
+from pytest import yield_fixture
+
+import eggo.ssh
+from eggo.ssh import remote_command, _run_command
+
+
+@yield_fixture
+def local_ssh(monkeypatch):
+    """Runs the commands of eggo.ssh in a local shell instead of over ssh,
+    in a temporary directory."""
+    monkeypatch.setattr(eggo.ssh, '_ssh',
+                        lambda command, pty: ['/bin/sh', '-c', command])
+    directory = mkdtemp()
+    with settings(host_string='localhost', shell='/bin/sh -c'):
+        yield directory
+    rmtree(directory)
+
+
+def test_remote_command():
+    with settings(shell='/bin/bash -l -c', sudo_prompt='pw:'):
+        assert remote_command('ls') == '/bin/bash -l -c "ls"'
+        assert remote_command('ls', shell=False) == 'ls'
+        with cd('/a b'), prefix('source x'), shell_env(A='$1'):
+            assert remote_command('echo "$A"', sudo=True, user='u') == (
+                "sudo -S -p 'pw:'  -u \"u\"  /bin/bash -l -c "
+                "\"export A=\\\"\\\\$1\\\" && cd /a\\ b >/dev/null && "
+                "source x && echo \\\"\\$A\\\"\"")
+        with path('/opt/bin'):
+            assert remote_command('ls') == (
+                '/bin/bash -l -c "export PATH=\\"\\$PATH:\\"/opt/bin\\"\\" '
+                '&& ls"')
+
+
+def test_run_command(local_ssh):
+    with cd(local_ssh), shell_env(GREETING='a  b'):
+        out = _run_command('echo "$GREETING" > f && pwd && cat f', quiet=True)
+    assert out.succeeded and out.return_code == 0
+    assert out.splitlines() == [local_ssh, 'a  b']
+    out = _run_command('exit 3', warn_only=True, quiet=True)
+    assert out.failed and out.return_code == 3
+
+
+def test_put(local_ssh, monkeypatch):
+    monkeypatch.setattr(eggo.ssh, 'PUT_CHUNK_SIZE', 7)
+    monkeypatch.setattr(eggo.ssh, 'enabled', lambda: True)
+    data = ''.join(chr(i % 256) for i in xrange(1000))
+    remote = os.path.join(local_ssh, 'copy')
+    assert eggo.ssh.put(StringIO(data), remote) == [remote]
+    with open(remote, 'rb') as ip:
+        assert ip.read() == data
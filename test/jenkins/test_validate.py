@@ -0,0 +1,68 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from shutil import rmtree
+from subprocess import check_call
+from tempfile import mkdtemp
+
+from pytest import skip
+
+from eggo.config import eggo_config
+from eggo.validate import VcfCounter, edition_rows
+
+
+# two samples, and a biallelic, a multi-allelic and a "." ALT record
+VCF = ('##fileformat=VCFv4.1\n'
+       '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+       '##contig=<ID=22,length=51304566>\n'
+       '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNA1\tNA2\n'
+       '22\t16050075\t.\tA\tG\t100\tPASS\t.\tGT\t0|1\t0|0\n'
+       '22\t16050115\t.\tG\tA,T\t100\tPASS\t.\tGT\t1|2\t0|1\n'
+       '22\t16050213\t.\tC\t.\t100\tPASS\t.\tGT\t0|0\t0|0\n')
+
+
+def test_vcf_counter():
+    counter = VcfCounter()
+    # chunks that end mid-line
+    for start in xrange(0, len(VCF), 100):
+        counter.feed(VCF[start:start + 100])
+    counter.close()
+    assert counter.records == 3
+    assert counter.rows == 2 * (1 + 2 + 0)
+
+
+def test_vcf_counter_matches_vcf2adam():
+    # the count model is only as good as its agreement with the vcf2adam of
+    # the pinned ADAM (versions.adam_fork and adam_branch)
+    adam_submit = os.path.join(eggo_config.get('worker_env', 'adam_home'),
+                               'bin', 'adam-submit')
+    if not os.path.exists(adam_submit):
+        skip('ADAM is not installed at {0}'.format(adam_submit))
+    directory = mkdtemp()
+    try:
+        vcf = os.path.join(directory, 'test.vcf')
+        with open(vcf, 'w') as op:
+            op.write(VCF)
+        adam = os.path.join(directory, 'test.adam')
+        check_call([adam_submit, '--master', 'local[1]', 'vcf2adam', vcf,
+                    adam])
+        counter = VcfCounter()
+        counter.feed(VCF)
+        counter.close()
+        assert edition_rows('file://' + adam) == counter.rows
+    finally:
+        rmtree(directory)